@@ -14,6 +14,16 @@
 
 """\
 Estimate rainfall from radar images. Distributed version.
+
+With --format tif, each map task converts a time-contiguous slice of the
+input images to GeoTIFF rainfall rate images. With --format nc, the input is
+first split into events (see tdm radar_events), whole events are assigned to
+map tasks and each task writes one chunked NetCDF dataset per event,
+optionally averaging rainfall over --resolution windows.
+
+Input images can also be stored in packs (see tdm radar_pack): in this case,
+splits are contiguous byte ranges of the packs, and each map task fetches
+them with a few large reads.
 """
 
 import argparse
@@ -25,47 +35,157 @@ import uuid
 import pydoop.mapreduce.pipes as pipes
 from pydoop import hdfs
 
-from tdm.utils import balanced_split
+from tdm.radar.timestamps import make_parser as make_dt_parser
+from tdm.utils import size_balanced_split
+import tdm.radar.events as events
+import tdm.radar.pack as pack
 
 MODULE = "rainfall_worker"
 DEFAULT_NUM_MAPS = 10
+OUT_FMTS = "nc", "tif"
+IN_FMT = "%Y%m%dT%H%M%S"
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 MODULE_PATH = os.path.join(THIS_DIR, "workers", f"{MODULE}.py")
 LOG_LEVELS = 'CRITICAL', 'DEBUG', 'ERROR', 'INFO', 'WARNING'
 
+parse_in_dt = make_dt_parser(IN_FMT)
+
+
+def parse_size(s):
+    """\
+    Parse a size in bytes, with an optional K, M or G (binary) suffix.
+    """
+    s = s.strip().upper()
+    unit = s[-1:] if s[-1:] in SIZE_UNITS else ""
+    try:
+        size = int(s[:len(s) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {s!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size must be positive")
+    return size
+
 
 def make_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("input", metavar="INPUT_DIR")
     parser.add_argument("output", metavar="OUTPUT_DIR")
     parser.add_argument("footprint", metavar="GEOTIFF_FOOTPRINT")
-    parser.add_argument(
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
         "--num-maps", metavar="INT", type=int, default=DEFAULT_NUM_MAPS,
+        help="number of map tasks (default: %(default)s)",
+    )
+    group.add_argument(
+        "--split-size", metavar="BYTES", type=parse_size,
+        help="target input bytes per map task, e.g., 256M",
     )
+    parser.add_argument("-f", "--format", choices=OUT_FMTS, default="tif",
+                        help="output format")
+    parser.add_argument("-r", "--resolution", metavar="N_SECONDS", type=int,
+                        help="output average rainfall over N_SECONDS windows "
+                        "(nc output)")
+    parser.add_argument("-l", "--min-len", metavar="N_SECONDS", type=int,
+                        default=events.MIN_EVENT_LEN,
+                        help="skip events shorter than N_SECONDS (nc output)")
+    parser.add_argument("--t-chunks", metavar="N", type=int,
+                        help="chunk size along the t dimension (nc output)")
+    parser.add_argument("--prefetch", metavar="N", type=int,
+                        help="number of images each map task reads ahead")
     parser.add_argument("--log-level", metavar="|".join(LOG_LEVELS),
                         choices=LOG_LEVELS, default="INFO")
     return parser
 
 
+def list_packed_images(pack_path, pack_size):
+    with hdfs.open(pack.get_index_path(pack_path), "rb") as f:
+        index = pack.parse_index(f.read(), data_size=pack_size)
+    return [(dt, image, image.size)
+            for dt, image in pack.get_members(pack_path, index)]
+
+
 def list_images(input_dir):
-    rval = []
+    """\
+    List images in input_dir, sorted by the timestamp encoded in their
+    names. Return a list of (timestamp, path, size) tuples. Images stored in
+    packs (see tdm.radar.pack) are included, with a PackedImage as the path;
+    loose images take precedence over packed ones with the same timestamp.
+    """
+    rval, packed = [], []
     logging.info("scanning %s", input_dir)
     for entry in hdfs.lsl(input_dir):
-        if all((entry["kind"] != "directory",
-                not entry["name"].startswith("_"),
-                entry["name"].endswith(".png"))):
-            rval.append(entry["name"])
-    logging.info("found %d images", len(rval))
+        bn = os.path.basename(entry["name"])
+        if entry["kind"] == "directory" or bn.startswith("_"):
+            continue
+        if pack.is_pack(bn):
+            packed.extend(list_packed_images(entry["name"], entry["size"]))
+        elif bn.endswith(".png"):
+            try:
+                dt = parse_in_dt(os.path.splitext(bn)[0])
+            except ValueError:
+                logging.warning("%s: bad timestamp, skipping", entry["name"])
+                continue
+            rval.append((dt, entry["name"], entry["size"]))
+    if packed:
+        loose_dts = {_[0] for _ in rval}
+        rval.extend(_ for _ in packed if _[0] not in loose_dts)
+    rval.sort(key=lambda _: _[0])
+    logging.info("found %d images (%d packed)", len(rval), len(packed))
     return rval
 
 
+def plan_splits(items, sizes, num_maps=None, split_size=None):
+    """\
+    Partition items into time-contiguous groups with approximately the same
+    total size, where sizes[i] is the size of items[i]. If split_size is
+    given, it determines the number of groups; otherwise, there are
+    min(num_maps, len(items)) groups.
+    """
+    if not items:
+        return []
+    if split_size is None:
+        num_maps = min(num_maps, len(items))
+    else:
+        num_maps = None
+    return list(size_balanced_split(
+        items, sizes, N=num_maps, target_size=split_size
+    ))
+
+
+def get_events(images, min_len=events.MIN_EVENT_LEN):
+    """\
+    Split the (timestamp, path, size) list returned by list_images into
+    events. Return a list of path lists and the corresponding total sizes.
+    """
+    bounds = events.split_bounds([_[0] for _ in images], min_len=min_len)
+    paths = [[p for _, p, _ in images[b: e]] for b, e in bounds]
+    sizes = [sum(s for _, _, s in images[b: e]) for b, e in bounds]
+    return paths, sizes
+
+
 def main():
     parser = make_parser()
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log_level)
+    if args.format != "nc":
+        for opt in "resolution", "t_chunks":
+            if getattr(args, opt) is not None:
+                parser.error(f"--{opt.replace('_', '-')} requires -f nc")
     images = list_images(args.input)
-    splits = balanced_split(images, args.num_maps)
+    if not images:
+        parser.error(f"no images found in {args.input}")
+    if args.format == "nc":
+        items, sizes = get_events(images, min_len=args.min_len)
+        if not items:
+            parser.error(f"no events found in {args.input}")
+        logging.info("found %d events", len(items))
+    else:
+        items, sizes = [_[1] for _ in images], [_[2] for _ in images]
+    splits = plan_splits(items, sizes, args.num_maps, args.split_size)
+    logging.info("%d splits, %d bytes per split on average", len(splits),
+                 sum(sizes) // len(splits))
     uri = os.path.join(args.input, "_" + uuid.uuid4().hex)
     logging.debug("saving input splits to: %s", uri)
     with hdfs.open(uri, "wb") as f:
@@ -79,10 +199,17 @@ def main():
         "--num-reducers", "0",
         "--upload-file-to-cache", MODULE_PATH,
         "--upload-file-to-cache", args.footprint,
-        "-D", f"mapreduce.job.maps={args.num_maps}",
+        "-D", f"mapreduce.job.maps={len(splits)}",
         "-D", f"{pipes.EXTERNALSPLITS_URI_KEY}={uri}",
         "-D", f"tdm.radar.footprint.name={os.path.basename(args.footprint)}",
+        "-D", f"tdm.radar.format={args.format}",
     ]
+    if args.resolution:
+        cmd.extend(["-D", f"tdm.radar.resolution={args.resolution}"])
+    if args.prefetch:
+        cmd.extend(["-D", f"tdm.radar.prefetch={args.prefetch}"])
+    if args.t_chunks:
+        cmd.extend(["-D", f"tdm.radar.t_chunks={args.t_chunks}"])
     subprocess.check_call(cmd)
     hdfs.rmr(uri)
 
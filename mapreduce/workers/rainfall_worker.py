@@ -14,61 +14,188 @@
 
 """\
 Estimate rainfall rate for all images in the input stream.
+
+If tdm.radar.format is "tif" (the default), each input split is a list of
+image paths and each image is converted to a GeoTIFF rainfall rate image.
+If it's "nc", each input split is a list of events, where each event is a
+time-ordered list of image paths, and each event is stored to a NetCDF
+dataset, averaging rainfall over tdm.radar.resolution seconds if set.
 """
 
-from datetime import datetime
-import io
+from concurrent import futures
+import collections
+import datetime
 import os
 
 import pydoop.hdfs as hdfs
 import pydoop.mapreduce.api as api
 import pydoop.mapreduce.pipes as pp
 
+from tdm.radar.timestamps import make_parser
+from tdm.utils import ordered_map
+import tdm.radar.cfio as cfio
+import tdm.radar.pack as pack
 import tdm.radar.tiffio as tiffio
 import tdm.radar.utils as utils
 
 IN_FMT = "%Y%m%dT%H%M%S"
+parse_in_dt = make_parser(IN_FMT)
+strftime = datetime.datetime.strftime
+
+# max number of images read ahead of the mapper
+PREFETCH = 8
+PREFETCH_THREADS = 1
+
+# max number of bytes fetched with a single read from a pack
+MAX_RUN_SIZE = 1 << 22
+
+
+def path_to_dt(path):
+    if isinstance(path, pack.PackedImage):
+        return path.dt
+    return parse_in_dt(os.path.splitext(hdfs.path.basename(path))[0])
+
+
+def get_runs(paths, max_size=MAX_RUN_SIZE):
+    """\
+    Group consecutive images stored in increasing order in the same pack into
+    runs that can be fetched with a single read. Other images form
+    single-element runs.
+    """
+    run = []
+    for p in paths:
+        if run:
+            last = run[-1]
+            if not (isinstance(p, pack.PackedImage) and
+                    isinstance(last, pack.PackedImage) and
+                    p.path == last.path and
+                    p.offset >= last.offset + last.size and
+                    p.offset + p.size - run[0].offset <= max_size):
+                yield run
+                run = []
+        run.append(p)
+    if run:
+        yield run
+
+
+def fetch_run(run):
+    """\
+    Get the raw (encoded) data for all images in a run.
+    """
+    if isinstance(run[0], pack.PackedImage):
+        with hdfs.open(run[0].path, "rb") as f:
+            return pack.read_range(f, run)
+    with hdfs.open(run[0], "rb") as f:
+        return [f.read()]
 
 
 class Reader(api.RecordReader):
+    """\
+    Images are fetched and decoded in the background (by
+    tdm.radar.prefetch.threads threads), up to tdm.radar.prefetch images
+    ahead of the mapper. Since input files are small, this mostly hides the
+    latency of opening them on HDFS. Images stored in packs are fetched in
+    runs of up to MAX_RUN_SIZE bytes, with one request per run.
+    """
 
     def __init__(self, context):
         super().__init__(context)
-        self.paths = context.input_split.payload
-        self.n_paths = len(self.paths)
+        jc = context.job_conf
+        self.format = jc.get("tdm.radar.format", "tif")
+        payload = context.input_split.payload
+        if self.format == "nc":
+            self.events = collections.deque(payload)
+            paths = [p for event in payload for p in event]
+        else:
+            paths = payload
+        self.paths = paths
+        self.n_paths = len(paths)
+        self.n_read = 0
+        prefetch = max(1, int(jc.get("tdm.radar.prefetch", PREFETCH)))
+        n_threads = int(jc.get("tdm.radar.prefetch.threads", PREFETCH_THREADS))
+        self.executor = futures.ThreadPoolExecutor(max_workers=n_threads)
+        runs = ordered_map(
+            self.executor, fetch_run, get_runs(paths), prefetch + 1
+        )
+        self.signals = ordered_map(
+            self.executor, utils.get_image_data,
+            (data for run in runs for data in run), prefetch + 1
+        )
+
+    def read(self):
+        signal = next(self.signals)
+        self.n_read += 1
+        return signal
 
     def next(self):
-        try:
-            path = self.paths.pop()
-        except IndexError:
+        if self.format == "nc":
+            try:
+                paths = self.events.popleft()
+            except IndexError:
+                raise StopIteration
+            return paths, (self.read() for _ in paths)
+        if self.n_read >= self.n_paths:
             raise StopIteration
-        with hdfs.open(path, "rb") as f:
-            signal = utils.get_image_data(f)
-        return path, signal
+        path = self.paths[self.n_read]
+        return path, self.read()
 
     def get_progress(self):
-        return 1 - float(len(self.paths) / self.n_paths)
+        return float(self.n_read / self.n_paths) if self.n_paths else 1.0
+
+    def close(self):
+        self.signals.close()
+        self.executor.shutdown()
 
 
 class Mapper(api.Mapper):
 
     def __init__(self, context):
         super().__init__(context)
-        footprint_name = context.job_conf["tdm.radar.footprint.name"]
+        jc = context.job_conf
+        footprint_name = jc["tdm.radar.footprint.name"]
         self.ga = utils.GeoAdapter(footprint_name)
+        self.format = jc.get("tdm.radar.format", "tif")
+        self.resolution = int(jc.get("tdm.radar.resolution", 0))
+        self.t_chunks = int(jc.get("tdm.radar.t_chunks", cfio.T_CHUNKS))
 
     def map(self, context):
-        # TODO: look for a way to avoid the local write
+        if self.format == "nc":
+            self.map_event(context)
+        else:
+            self.map_image(context)
+
+    def map_image(self, context):
         path, signal = context.key, context.value
         rr = utils.estimate_rainfall(signal)
-        dt_string = os.path.splitext(hdfs.path.basename(path))[0]
-        out_name = "%s.tif" % dt_string
-        dt = datetime.strptime(dt_string, IN_FMT)
+        dt = path_to_dt(path)
+        out_name = "%s.tif" % strftime(dt, IN_FMT)
         metadata = {tiffio.DT_TAG: dt.strftime(tiffio.DT_FMT)}
-        self.ga.save_as_gtiff(out_name, rr, metadata=metadata)
-        with io.open(out_name, "rb") as f:
-            value = f.read()
-        context.emit(out_name, value)
+        context.emit(out_name, self.ga.to_gtiff_bytes(rr, metadata=metadata))
+
+    def map_event(self, context):
+        paths, signals = context.key, context.value
+        dts = [path_to_dt(_) for _ in paths]
+        rr_stream = zip(dts, map(utils.estimate_rainfall, signals))
+        if self.resolution:
+            out_dts = [dt for dt, _ in
+                       utils.group_images(zip(dts, dts), self.resolution)]
+            groups = utils.group_images(rr_stream, self.resolution)
+            rr_stream = utils.avg_rr(groups)
+        else:
+            out_dts = dts
+        nt, t0 = len(out_dts), out_dts[0]
+        out_name = "%s.nc" % strftime(t0, utils.FMT)
+        # netCDF4 can't write to HDFS: the writer uploads the local file
+        local_path = os.path.abspath(out_name)
+        writer = cfio.NCWriter(local_path, self.ga, nt, t0,
+                               t_chunks=self.t_chunks)
+        try:
+            for i, (dt, rr) in enumerate(rr_stream):
+                writer.write(i, dt, rr)
+                context.set_status(f"{out_name}: {i + 1}/{nt}")
+        finally:
+            writer.close()
+        context.emit(out_name, local_path)
 
 
 class Writer(api.RecordWriter):
@@ -76,10 +203,16 @@ class Writer(api.RecordWriter):
     def __init__(self, context):
         super().__init__(context)
         self.d = context.get_work_path()
+        self.format = context.job_conf.get("tdm.radar.format", "tif")
 
     def emit(self, key, value):
-        with hdfs.open(hdfs.path.join(self.d, key), "wb") as f:
-            f.write(value)
+        out_path = hdfs.path.join(self.d, key)
+        if self.format == "nc":
+            hdfs.put(value, out_path)
+            os.unlink(value)
+        else:
+            with hdfs.open(out_path, "wb") as f:
+                f.write(value)
 
 
 factory = pp.Factory(mapper_class=Mapper, record_reader_class=Reader,
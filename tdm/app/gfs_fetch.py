@@ -18,9 +18,11 @@ Fetch GFS files from a remote production service.
 
 import argparse
 import os
+import sys
 from datetime import datetime
 
 from tdm.gfs.noaa import noaa_fetcher
+from tdm.gfs.noaa.noaa_fetcher import DEFAULT_SUBSET
 
 
 NOW = datetime.now()
@@ -28,9 +30,15 @@ NOW = datetime.now()
 
 def main(args):
     nf = noaa_fetcher(args.year, args.month, args.day, args.hour)
-    os.mkdir(args.target_directory)
-    nf.fetch(args.requested_resolution, args.target_directory,
-             nthreads=args.n_download_threads)
+    if args.resume:
+        os.makedirs(args.target_directory, exist_ok=True)
+    else:
+        os.mkdir(args.target_directory)
+    missing = nf.fetch(args.requested_resolution, args.target_directory,
+                       nthreads=args.n_download_threads, resume=args.resume,
+                       timeout=args.max_wait, variables=args.variables)
+    if missing:
+        sys.exit("ERROR: %d files could not be fetched" % len(missing))
     with open(args.semaphore_file, "w") as f:
         f.close()
 
@@ -81,4 +89,26 @@ def add_parser(subparsers):
         type=str, default='0p50',
         help="Requested resolution in fraction of degree. Defaults to '0p50'"
     )
+    parser.add_argument(
+        '--max-wait', metavar='SECONDS', type=int,
+        help="Give up waiting for the dataset to be complete after SECONDS, "
+        "defaults to waiting indefinitely"
+    )
+    parser.add_argument(
+        '--subset', dest='variables', action='store_const',
+        const=DEFAULT_SUBSET,
+        help="Only fetch the fields used by map_to_tree (%s)" %
+        ", ".join(sorted(DEFAULT_SUBSET))
+    )
+    parser.add_argument(
+        '--variables', metavar='NAME[,NAME...]',
+        type=lambda s: frozenset(s.split(',')),
+        help="Only fetch these fields, named as in wgrib2 NetCDF output "
+        "(e.g., TMP_2maboveground)"
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Reuse an existing target directory, fetching only files that "
+        "are missing or incomplete"
+    )
     parser.set_defaults(func=main)
@@ -16,16 +16,35 @@
 Convert a sequence of grib2 files to a single NetCDF4 dataset using the
 NetCDF Climate and Forecast (CF) Metadata Conventions
 (http://cfconventions.org) Version 1.6.
+
+With the default wgrib2 engine, each file is converted with wgrib2 and the
+results are concatenated. The eccodes engine (available if the ecCodes
+Python bindings are installed) decodes the files in process and writes the
+output directly, without intermediate files (see tdm.gfs.gribcf).
 """
 
+from concurrent import futures
+from datetime import datetime
+import argparse
 import os
 import sys
-import cdo
 import subprocess
 import shutil
 import tempfile
+import time
 import uuid
 
+from netCDF4 import Dataset
+try:
+    import cdo
+except ImportError:
+    cdo = None
+
+from tdm.utils import ordered_map
+from tdm.gfs import gribcf
+
+TIME_DIM = "time"
+
 
 def get_files(files_dir, ext):
     files = []
@@ -36,23 +55,152 @@ def get_files(files_dir, ext):
     return files
 
 
-def convert_to_nc(gribs, writable_dir):
+def grib_to_nc(grib, ncs_dir):
+    """\
+    Convert a single grib2 file to NetCDF4 in ncs_dir with wgrib2. Return
+    the path to the NetCDF file and the time it took, in seconds.
+    """
+    nc = os.path.join(ncs_dir,
+                      os.path.splitext(os.path.basename(grib))[0] + '.nc')
+    start = time.time()
+    cp = subprocess.run(["wgrib2", grib, '-nc4', '-netcdf', nc],
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if cp.returncode:
+        raise RuntimeError("wgrib2 failed on %s (exit status %d):\n%s" % (
+            grib, cp.returncode, cp.stdout.decode(errors="replace")
+        ))
+    return nc, time.time() - start
+
+
+def iconvert(gribs, ncs_dir, jobs=1):
+    """\
+    Convert gribs to NetCDF in ncs_dir with up to jobs parallel wgrib2
+    processes. Yield the path to each NetCDF file, in the same order as
+    gribs, as soon as it's ready.
+    """
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for grib, (nc, elapsed) in zip(gribs, ordered_map(
+                executor, lambda g: grib_to_nc(g, ncs_dir), gribs, 2 * jobs
+        )):
+            print("  %s: %.2f s" % (os.path.basename(grib), elapsed))
+            yield nc
+
+
+def convert_to_nc(gribs, writable_dir, jobs=1):
     ncs_dir = tempfile.mkdtemp(dir=writable_dir)
-    for g in gribs:
-        nc = os.path.join(ncs_dir,
-                          os.path.splitext(os.path.basename(g))[0] + '.nc')
-        subprocess.run(["wgrib2", g, '-nc4', '-netcdf', nc])
+    try:
+        for _ in iconvert(gribs, ncs_dir, jobs=jobs):
+            pass
+    except BaseException:
+        shutil.rmtree(ncs_dir)
+        raise
     return ncs_dir
 
 
 def concatenate(ncs_dir, output_nc):
+    if cdo is None:
+        raise RuntimeError("cdo not available, use --stream")
     ncs = sorted(get_files(ncs_dir, '.nc'))
     c = cdo.Cdo()
     c.cat(input=' '.join(ncs), output=output_nc,  options='-r -f nc')
 
 
-def annotate(ncfile, annotations):
-    pass
+class NCConcatenator(object):
+    """\
+    Concatenate NetCDF files along the (unlimited) time dimension, one file
+    at a time. Variables that do not depend on time are copied from the
+    first file where they appear; variables missing from some of the files
+    are left at their fill value for the corresponding time steps.
+    """
+
+    def __init__(self, path, complevel=4):
+        self.ds = Dataset(path, "w")
+        self.complevel = complevel
+        self.nt = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.ds.close()
+
+    def __create_variable(self, var):
+        chunks = None
+        if var.dimensions and var.dimensions[0] == TIME_DIM:
+            chunks = [1] + [len(self.ds.dimensions[_])
+                            for _ in var.dimensions[1:]]
+        attrs = var.__dict__.copy()
+        out = self.ds.createVariable(
+            var.name, var.datatype, var.dimensions, zlib=True,
+            complevel=self.complevel, chunksizes=chunks,
+            fill_value=attrs.pop("_FillValue", None)
+        )
+        out.setncatts(attrs)
+        return out
+
+    def append(self, path):
+        with Dataset(path) as src:
+            src.set_auto_maskandscale(False)
+            if self.nt == 0:
+                self.ds.setncatts(src.__dict__)
+            for name, dim in src.dimensions.items():
+                if name not in self.ds.dimensions:
+                    size = None if name == TIME_DIM else len(dim)
+                    self.ds.createDimension(name, size)
+            nt = len(src.dimensions[TIME_DIM])
+            for name, var in src.variables.items():
+                created = name not in self.ds.variables
+                if created:
+                    out = self.__create_variable(var)
+                else:
+                    out = self.ds.variables[name]
+                out.set_auto_maskandscale(False)
+                if var.dimensions and var.dimensions[0] == TIME_DIM:
+                    out[self.nt: self.nt + nt] = var[:]
+                elif created:
+                    out[...] = var[...]
+            self.nt += nt
+
+
+def convert_and_stream(gribs, output_nc, writable_dir, jobs=1):
+    """\
+    Convert gribs and append each converted file to output_nc (see
+    NCConcatenator) as soon as it's ready, deleting it right away.
+    """
+    ncs_dir = tempfile.mkdtemp(dir=writable_dir)
+    try:
+        with NCConcatenator(output_nc) as concat:
+            for nc in iconvert(gribs, ncs_dir, jobs=jobs):
+                concat.append(nc)
+                os.unlink(nc)
+    finally:
+        shutil.rmtree(ncs_dir)
+
+
+def annotate(ncfile, annotations, history=None):
+    """\
+    Add annotations (a dict) to the global attributes of ncfile, skipping
+    None values. If history is given, append it, with a timestamp, to the
+    history attribute.
+    """
+    with Dataset(ncfile, "a") as ds:
+        ds.setncatts({k: v for k, v in annotations.items() if v is not None})
+        if history:
+            stamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            line = "%s: %s" % (stamp, history)
+            old = getattr(ds, "history", None)
+            ds.history = "%s\n%s" % (old, line) if old else line
+
+
+def get_engine(name):
+    if name == "auto":
+        return "wgrib2" if gribcf.eccodes is None else "eccodes"
+    if name == "eccodes" and gribcf.eccodes is None:
+        raise RuntimeError("ecCodes Python bindings not available")
+    return name
 
 
 def main(args):
@@ -64,19 +212,42 @@ def main(args):
         os.makedirs(args.output)
     except FileExistsError:
         pass
-    ncs_dir = convert_to_nc(gribs, args.output)
+    gribs.sort()
     if args.product_class and args.name and args.instance_uid:
         tag = '{}_{}_{}'.format(args.product_class, args.name,
                                 args.instance_uid)
     else:
         tag = '{}_{}'.format(os.path.basename(args.input), uuid.uuid4())
     out_fn = os.path.join(args.output, "%s.nc" % tag)
-    concatenate(ncs_dir, out_fn)
-    shutil.rmtree(ncs_dir)
-    # annotations = {'product': 'meteosim',
-    #                'product_class': args.product_class,
-    #                'uid': args.instance_uid}
-    # annotate(out_fn, annotations)
+    engine = get_engine(args.engine)
+    start = time.time()
+    if engine == "eccodes":
+        gribcf.convert(gribs, out_fn)
+    elif args.stream:
+        convert_and_stream(gribs, out_fn, args.output, jobs=args.jobs)
+    else:
+        ncs_dir = convert_to_nc(gribs, args.output, jobs=args.jobs)
+        concatenate(ncs_dir, out_fn)
+        shutil.rmtree(ncs_dir)
+    print("'%s' written in %.2f s" % (out_fn, time.time() - start))
+    annotations = {'product': args.product_group,
+                   'product_class': args.product_class,
+                   'name': args.name,
+                   'uid': args.instance_uid,
+                   'source_files': ' '.join(os.path.basename(_)
+                                            for _ in gribs)}
+    annotate(out_fn, annotations,
+             history="tdm grib2cf (%s engine) %s" % (engine, args.input))
+
+
+def positive_int(s):
+    try:
+        n = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: %r" % (s,))
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return n
 
 
 def add_parser(subparsers):
@@ -90,4 +261,13 @@ def add_parser(subparsers):
     parser.add_argument('--name', metavar="STRING")
     parser.add_argument("--instance-uid", metavar="UID",
                         help="an unique identifier for this dataset")
+    parser.add_argument("--engine", choices=["wgrib2", "eccodes", "auto"],
+                        default="wgrib2", help="conversion engine; auto "
+                        "selects eccodes if available")
+    parser.add_argument("-j", "--jobs", metavar="N", type=positive_int,
+                        default=1,
+                        help="number of parallel wgrib2 conversions")
+    parser.add_argument("--stream", action="store_true",
+                        help="append converted files to the output with "
+                        "netCDF4 as they are ready, instead of using cdo cat")
     parser.set_defaults(func=main)
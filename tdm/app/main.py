@@ -28,6 +28,8 @@ SUB_COMMANDS = [
     'map_to_tree',
     'radar_events',
     'radar_nc_to_geo',
+    'radar_pack',
+    'radar_unpack',
     'rainfall',
     'wrf_configurator',
     'grib2cf',
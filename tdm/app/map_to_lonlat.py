@@ -12,9 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""\
+Map a NetCDF dataset to a regular lon/lat grid with bilinear interpolation.
+
+Interpolation weights depend only on the source and target grids, so they
+are computed once and stored in the "remap" subdirectory of the tdm cache
+(see tdm.utils.get_cache_dir), under a key derived from the description of
+both grids. With the cdo engine, weights are generated with cdo genbil and
+applied with cdo remap. The numpy engine, which does not require cdo,
+supports source datasets with 1D latitude and longitude coordinates.
+Target longitudes are taken modulo 360 degrees, so that, e.g., a region
+given in -180..180 can be extracted from a GFS dataset (0..360); global
+source grids wrap around.
+"""
+
+import hashlib
 import os
+import shutil
 import tempfile
-import cdo
+
+import numpy as np
+from netCDF4 import Dataset
+try:
+    import cdo
+except ImportError:
+    cdo = None
+
+from tdm.utils import cache_key, get_cache_dir
 
 GRID_DESC = """\
 gridtype = lonlat
@@ -26,16 +50,258 @@ yfirst = {}
 yinc = {}
 """
 
+LAT_UNITS = frozenset(["degrees_north", "degree_north", "degree_N",
+                       "degrees_N", "degreeN", "degreesN"])
+LON_UNITS = frozenset(["degrees_east", "degree_east", "degree_E",
+                       "degrees_E", "degreeE", "degreesE"])
+FILL_VALUE = np.float32(9.999e20)
+
+
+def get_grid_desc(xfirst, xinc, xsize, yfirst, yinc, ysize):
+    return GRID_DESC.format(int(xsize), int(ysize), float(xfirst),
+                            float(xinc), float(yfirst), float(yinc))
+
+
+def get_target_coords(xfirst, xinc, xsize, yfirst, yinc, ysize):
+    lons = float(xfirst) + float(xinc) * np.arange(int(xsize))
+    lats = float(yfirst) + float(yinc) * np.arange(int(ysize))
+    return lats, lons
+
+
+def _get_weights_path(key, ext):
+    cache_dir = get_cache_dir("remap")
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, key + ext)
+
+
+# -- cdo engine --
+
+def get_cdo_weights(c, fin, grid_desc_path, wd):
+    """\
+    Get the path to the cdo bilinear weights for remapping fin to the grid
+    described in grid_desc_path, generating them if they are not cached
+    (or if caching is disabled, in which case they are stored in wd).
+    """
+    with open(grid_desc_path) as f:
+        target = f.read()
+    source = "\n".join(c.griddes(input=fin))
+    path = _get_weights_path(cache_key("genbil", source, target), ".nc")
+    if path is None:
+        path = os.path.join(wd, "weights.nc")
+    elif os.path.exists(path):
+        return path
+    fd, tmp_path = tempfile.mkstemp(suffix=".nc",
+                                    dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        c.genbil(grid_desc_path, input=fin, output=tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def cdo_map_to_region(fin, fout, grid_desc):
+    if cdo is None:
+        raise RuntimeError("cdo not available, use the numpy engine")
+    c = cdo.Cdo()
+    wd = tempfile.mkdtemp(prefix="tdm_")
+    try:
+        gfname = os.path.join(wd, "grid.txt")
+        with open(gfname, 'w') as o:
+            o.write(grid_desc)
+        weights = get_cdo_weights(c, fin, gfname, wd)
+        c.remap("%s,%s" % (gfname, weights), input=fin, output=fout)
+    finally:
+        shutil.rmtree(wd)
+
+
+# -- numpy engine --
+
+def _axis_weights(src, tgt):
+    """\
+    For each value in tgt, get the indices of the two surrounding values in
+    the monotonic array src, the corresponding linear interpolation weights
+    and whether the value is within the range of src.
+    """
+    src = np.asarray(src, dtype=np.float64)
+    n = src.size
+    if n < 2:
+        raise ValueError("need at least two points along each axis")
+    rev = src[0] > src[-1]
+    if rev:
+        src = src[::-1]
+    i = np.clip(np.searchsorted(src, tgt, side="right") - 1, 0, n - 2)
+    w1 = (tgt - src[i]) / (src[i + 1] - src[i])
+    valid = (tgt >= src[0]) & (tgt <= src[-1])
+    i0, i1 = i, i + 1
+    if rev:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+    return i0, i1, 1 - w1, w1, valid
+
+
+def _wrap_lons(src_lons, lons):
+    """\
+    Map lons to the range of the (ascending) src_lons, modulo 360. If
+    src_lons cover the whole globe, also append the first one plus 360, to
+    close the gap between the last one and the first one. Returns the
+    (possibly extended) source longitudes and the mapped target ones.
+    """
+    src_lons = np.asarray(src_lons, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if src_lons.size < 2 or src_lons[0] > src_lons[-1]:
+        return src_lons, lons
+    start = src_lons[0]
+    lons = start + np.mod(lons - start, 360)
+    step = (src_lons[-1] - start) / (src_lons.size - 1)
+    if np.isclose(src_lons.size * step, 360):
+        src_lons = np.append(src_lons, start + 360)
+    return src_lons, lons
+
+
+def compute_weights(src_lats, src_lons, lats, lons):
+    """\
+    Compute bilinear interpolation weights from a rectilinear (lat, lon)
+    grid to another one. Returns an (n, 4) array of indices into the
+    flattened source grid, the corresponding (n, 4) array of weights and a
+    boolean array of size n that is False for target points outside of the
+    source grid, where n = len(lats) * len(lons). Target longitudes are
+    taken modulo 360 (see _wrap_lons).
+
+    >>> idx, w, valid = compute_weights([0, 1], [0, 1], [0.5], [0.25, 2])
+    >>> idx[0].tolist(), w[0].tolist(), valid.tolist()
+    ([0, 1, 2, 3], [0.375, 0.125, 0.375, 0.125], [True, False])
+    """
+    nx = len(src_lons)
+    y0, y1, wy0, wy1, vy = _axis_weights(src_lats, np.asarray(lats))
+    x0, x1, wx0, wx1, vx = _axis_weights(*_wrap_lons(src_lons, lons))
+    x0, x1 = x0 % nx, x1 % nx
+    idx = np.stack([
+        np.add.outer(y0 * nx, x0), np.add.outer(y0 * nx, x1),
+        np.add.outer(y1 * nx, x0), np.add.outer(y1 * nx, x1),
+    ], axis=-1).reshape(-1, 4)
+    w = np.stack([
+        np.outer(wy0, wx0), np.outer(wy0, wx1),
+        np.outer(wy1, wx0), np.outer(wy1, wx1),
+    ], axis=-1).reshape(-1, 4)
+    valid = np.logical_and.outer(vy, vx).ravel()
+    return idx, w, valid
+
+
+def get_weights(src_lats, src_lons, lats, lons):
+    """\
+    Same as compute_weights, but cached.
+    """
+    # "bil2": weights computed with longitude wrapping
+    key = cache_key("bil2", *(hashlib.sha1(
+        np.ascontiguousarray(_, dtype=np.float64).tobytes()
+    ).hexdigest() for _ in (src_lats, src_lons, lats, lons)))
+    path = _get_weights_path(key, ".npz")
+    if path is not None and os.path.exists(path):
+        with np.load(path) as data:
+            return data["idx"], data["w"], data["valid"]
+    idx, w, valid = compute_weights(src_lats, src_lons, lats, lons)
+    if path is not None:
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz",
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, idx=idx, w=w, valid=valid)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return idx, w, valid
+
+
+def apply_weights(a, weights, shape):
+    """\
+    Interpolate a (..., lat, lon) array with weights (as returned by
+    compute_weights) to a target grid with the given (lat, lon) shape.
+    Target points that are outside the source grid, or that depend on a
+    masked source point (with a nonzero weight), are masked.
+    """
+    idx, w, valid = weights
+    flat = a.reshape(a.shape[:-2] + (-1,))
+    out = (np.ma.filled(flat, 0)[..., idx] * w).sum(axis=-1)
+    mask = (np.ma.getmaskarray(flat)[..., idx] & (w != 0)).any(axis=-1)
+    mask |= ~valid
+    return np.ma.masked_array(out, mask=mask).reshape(a.shape[:-2] + shape)
+
+
+def _find_coord(ds, units):
+    for name, var in ds.variables.items():
+        if var.ndim == 1 and getattr(var, "units", None) in units:
+            return name, var
+    raise ValueError("numpy engine requires 1D lat/lon coordinates")
+
+
+def numpy_map_to_region(fin, fout, lats, lons):
+    with Dataset(fin) as src, Dataset(fout, "w") as dst:
+        lat_name, src_lat = _find_coord(src, LAT_UNITS)
+        lon_name, src_lon = _find_coord(src, LON_UNITS)
+        ydim, xdim = src_lat.dimensions[0], src_lon.dimensions[0]
+        weights = get_weights(src_lat[:], src_lon[:], lats, lons)
+        shape = (len(lats), len(lons))
+        dst.setncatts(src.__dict__)
+        for name, dim in src.dimensions.items():
+            if name not in (ydim, xdim):
+                dst.createDimension(
+                    name, None if dim.isunlimited() else len(dim)
+                )
+        dst.createDimension("lon", len(lons))
+        dst.createDimension("lat", len(lats))
+        for name, values, var in (("lon", lons, src_lon),
+                                  ("lat", lats, src_lat)):
+            out = dst.createVariable(name, "f8", (name,))
+            out.setncatts({k: v for k, v in var.__dict__.items()
+                           if k != "_FillValue"})
+            out[:] = values
+        for name, var in src.variables.items():
+            if name in (lat_name, lon_name):
+                continue
+            dims = var.dimensions
+            if ydim not in dims and xdim not in dims:
+                out = dst.createVariable(
+                    name, var.datatype, dims,
+                    fill_value=getattr(var, "_FillValue", None)
+                )
+                out.setncatts({k: v for k, v in var.__dict__.items()
+                               if k != "_FillValue"})
+                out[...] = var[...]
+                continue
+            if dims[-2:] != (ydim, xdim):
+                continue  # not a (..., lat, lon) field
+            out = dst.createVariable(name, "f4", dims[:-2] + ("lat", "lon"),
+                                     zlib=True, fill_value=FILL_VALUE)
+            out.setncatts({k: v for k, v in var.__dict__.items()
+                           if k not in ("_FillValue", "missing_value",
+                                        "scale_factor", "add_offset")})
+            if var.ndim > 2:
+                # one leading index at a time, to bound memory usage
+                for i in range(var.shape[0]):
+                    out[i] = apply_weights(var[i], weights, shape)
+            else:
+                out[...] = apply_weights(var[...], weights, shape)
+
 
 def map_to_region(fin, fout,
                   xfirst, xinc, xsize,
-                  yfirst, yinc, ysize):
-    gfname = tempfile.mktemp()
-    with open(gfname, 'w') as o:
-        o.write(GRID_DESC.format(xsize, ysize, xfirst, xinc, yfirst, yinc))
-    c = cdo.Cdo()
-    c.remapbil(gfname, input=fin, output=fout)
-    os.unlink(gfname)
+                  yfirst, yinc, ysize, engine="auto"):
+    if engine == "auto":
+        engine = "numpy" if cdo is None else "cdo"
+    if engine == "cdo":
+        cdo_map_to_region(fin, fout, get_grid_desc(
+            xfirst, xinc, xsize, yfirst, yinc, ysize
+        ))
+    elif engine == "numpy":
+        lats, lons = get_target_coords(xfirst, xinc, xsize,
+                                       yfirst, yinc, ysize)
+        numpy_map_to_region(fin, fout, lats, lons)
+    else:
+        raise ValueError("unknown engine: %r" % (engine,))
 
 
 def main(args):
@@ -48,15 +314,18 @@ def main(args):
     fout = os.path.join(args.out_dir, ''.join([root, '-lonlat', ext]))
     xfirst, xsize, xinc = args.lon_range.split(':')
     yfirst, ysize, yinc = args.lat_range.split(':')
-    map_to_region(fin, fout, xfirst, xinc, xsize, yfirst, yinc, ysize)
+    map_to_region(fin, fout, xfirst, xinc, xsize, yfirst, yinc, ysize,
+                  engine=args.engine)
 
 
 def add_parser(subparsers):
-    parser = subparsers.add_parser("map_to_lonlat")
+    parser = subparsers.add_parser("map_to_lonlat", description=__doc__)
     parser.add_argument("nc_path", metavar="NETCDF_FILE")
     parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
     parser.add_argument("--lat-range", metavar="LAT_RANGE",
                         help="<startlat>:<steps>:<inc> in degrees")
     parser.add_argument("--lon-range", metavar="LON_RANGE",
                         help="<startlon>:<steps>:<inc> in degrees")
+    parser.add_argument("--engine", choices=["auto", "cdo", "numpy"],
+                        default="auto", help="auto uses cdo if available")
     parser.set_defaults(func=main)
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
 from datetime import datetime
 from urllib.parse import urljoin
 import io
@@ -19,13 +20,32 @@ import json
 import os
 
 import gdal
+import numpy as np
 import osr
 import xarray as xr
 
 from tdm import __version__ as version
+from tdm.utils import ordered_map
+import tdm.geotiff as geotiff
 
 gdal.UseExceptions()
 
+# (name, description, variables, offset)
+FIELDS = [
+    ('tcov', "Total cloud coverage [percent]", ['TCDC_surface'], 0),
+    ('tprec', "Total precipitation [kg/m^2]", ['APCP_surface'], 0),
+    ('temp2m', "Temperature 2m above ground [C]", ['TMP_2maboveground'],
+     -273.15),
+    ('uv10', "Wind velocity at 10m [m/s]",
+     ['UGRD_10maboveground', 'VGRD_10maboveground'], 0),
+]
+
+# number of time steps read at once for each variable
+T_BATCH = 24
+
+# max number of pending GeoTIFF encoding tasks per worker process
+READ_AHEAD = 4
+
 
 def to_datetime(t):
     ns = 1e-9  # nanosecs in a sec
@@ -52,15 +72,17 @@ def create_res_description(name, desc, url, dt, lonlat, fname):
             }
 
 
+# NOTE: it is coordinated with the permutation that we impose in
+# MemMasterBuilder.build()
+def get_geotransform(lons, lats):
+    return (float(lons[0]), float(lons[-1] - lons[0])/len(lons), 0,
+            float(lats[-1]), 0, -float(lats[-1] - lats[0])/len(lats))
+
+
 class MemMasterBuilder(object):
-    def __init__(self, lons, lats):
+    def __init__(self, geotransform):
         self.driver = gdal.GetDriverByName("MEM")
-        self.geotransform = self.get_geotransform(lons, lats)
-
-    # NOTE: it is coordinated with the permutation that we impose in build()
-    def get_geotransform(self, lons, lats):
-        return (lons[0], (lons[-1] - lons[0])/len(lons), 0,
-                lats[-1], 0, -(lats[-1] - lats[0])/len(lats))
+        self.geotransform = geotransform
 
     def setup_raster(self, data):
         rows, cols = data[0].shape
@@ -123,37 +145,67 @@ def get_simulation_details(args, dataset):
     return simulation_details
 
 
-def dump_to_tree(out_dir, dataset, simulation_details, url_root):
+def save_tiff(task):
+    (out_path, geotransform, fdata, metadata, profile), res_info = task
+    rbuilder = MemMasterBuilder(geotransform)
+    raster = rbuilder.build(fdata, metadata)
+    profile.save(out_path, raster)
+    return out_path, res_info
+
+
+def get_tasks(dataset, pbuilder, lonlat, t_batch, profile):
+    """\
+    Generate GeoTIFF encoding tasks for save_tiff, in time-major order. For
+    each batch of t_batch time steps, each variable is read with a single
+    slice. Tasks carry the geotransform of the grid rather than its
+    coordinates, since they are pickled when sent to worker processes.
+    """
     times = dataset.coords['time']
-    lons = dataset.coords['lon']
-    lats = dataset.coords['lat']
-    out_driver = gdal.GetDriverByName("GTiff")
-    rbuilder = MemMasterBuilder(lons, lats)
+    geotransform = get_geotransform(dataset.coords['lon'].values,
+                                    dataset.coords['lat'].values)
+    for start in range(0, len(times), t_batch):
+        stop = min(start + t_batch, len(times))
+        batch = {}
+        for fname, desc, var_names, offset in FIELDS:
+            batch[fname] = []
+            for name in var_names:
+                da = dataset[name].isel(time=slice(start, stop))
+                values = np.moveaxis(da.values, da.get_axis_num('time'), 0)
+                batch[fname].append(values + offset)
+        for i in range(stop - start):
+            ts = to_datetime(times[start + i])
+            path = pbuilder.build(ts, lonlat)
+            os.makedirs(path, exist_ok=True)
+            for fname, desc, var_names, offset in FIELDS:
+                out_path = os.path.join(path, "%s.tif" % fname)
+                fdata = [_[i] for _ in batch[fname]]
+                yield ((out_path, geotransform, fdata,
+                        {"TIFFTAG_DATETIME": ts}, profile),
+                       (fname, desc, ts))
+
+
+def dump_to_tree(out_dir, dataset, simulation_details, url_root,
+                 workers=1, t_batch=T_BATCH, profile=geotiff.DEFAULT_PROFILE):
     pbuilder = PathBuilder(out_dir, simulation_details)
     lonlat = '_'.join(simulation_details[x + '_range'] for x in ['lon', 'lat'])
+    tasks = get_tasks(dataset, pbuilder, lonlat, t_batch, profile)
     resources = []
-    for t in times:
-        ds = dataset.sel({'time': t})
-        ts = to_datetime(t)
-        path = pbuilder.build(ts, lonlat)
-        os.makedirs(path, exist_ok=True)
-        for fname, desc, fdata in [
-            ('tcov', "Total cloud coverage [percent]",
-             [ds['TCDC_surface'].values]),
-            ('tprec', "Total precipitation [kg/m^2]",
-             [ds['APCP_surface'].values]),
-            ('temp2m', "Temperature 2m above ground [C]",
-             [ds['TMP_2maboveground'].values - 273.15]),
-            ('uv10', "Wind velocity at 10m [m/s]",
-             [ds['UGRD_10maboveground'].values,
-              ds['VGRD_10maboveground'].values])]:
-            raster = rbuilder.build(fdata, {"TIFFTAG_DATETIME": ts})
-            out_path = os.path.join(path, "%s.tif" % fname)
-            out_driver.CreateCopy(out_path, raster)
+    if workers > 1:
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+        results = ordered_map(executor, save_tiff, tasks,
+                              READ_AHEAD * workers)
+    else:
+        executor = None
+        results = map(save_tiff, tasks)
+    try:
+        for out_path, (fname, desc, ts) in results:
             url = urljoin(url_root, out_path)
             resources.append(create_res_description(fname, desc, url, ts,
                                                     lonlat, out_path))
             print('created %s' % out_path)
+    finally:
+        if executor:
+            executor.shutdown()
     desc = {'description': simulation_details,
             'result': {"resources": resources}}
     desc_path = pbuilder.build("description.json")
@@ -164,7 +216,9 @@ def dump_to_tree(out_dir, dataset, simulation_details, url_root):
 def main(args):
     dataset = xr.open_dataset(args.nc_path)
     simulation_details = get_simulation_details(args, dataset)
-    dump_to_tree(args.out_dir, dataset, simulation_details, args.url_root)
+    dump_to_tree(args.out_dir, dataset, simulation_details, args.url_root,
+                 workers=args.workers, t_batch=args.t_batch,
+                 profile=geotiff.from_args(args))
 
 
 def add_parser(subparsers):
@@ -180,4 +234,9 @@ def add_parser(subparsers):
     parser.add_argument("--url-root", metavar="URL_ROOT",
                         help="the url root of the data tree",
                         default="https://rest.tdm-project.it")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=1,
+                        help="encode GeoTIFFs with N parallel processes")
+    parser.add_argument("--t-batch", metavar="N", type=int, default=T_BATCH,
+                        help="number of time steps to read at once")
+    geotiff.add_arguments(parser)
     parser.set_defaults(func=main)
@@ -16,11 +16,14 @@
 Split raw radar images into per-event directories.
 """
 
+from concurrent import futures
 import argparse
 import datetime
 import os
 
+from tdm.utils import copy_file, LINK_MODES
 import tdm.radar.events as events
+import tdm.radar.pack as pack
 import tdm.radar.utils as utils
 
 join = os.path.join
@@ -29,20 +32,31 @@ strftime = datetime.datetime.strftime
 
 def main(args):
     print("scanning %s" % args.in_dir)
-    dt_path_pairs = utils.get_images(args.in_dir)
+    dt_path_pairs = utils.get_images(args.in_dir, include_packs=True)
     fmt = utils.FMT
-    for event in events.split(dt_path_pairs, min_len=args.min_len):
-        start_str = strftime(event[0][0], fmt)
-        out_subdir = join(args.out_dir, start_str)
-        try:
-            os.makedirs(out_subdir)
-        except FileExistsError:
-            pass
-        print("  event from: %s (%d time points)" % (start_str, len(event)))
-        for dt, p in event:
-            out_p = join(out_subdir, strftime(dt, fmt))
-            with open(p, "rb") as fi, open(out_p, "wb") as fo:
-                fo.write(fi.read())
+
+    def copy(src_dst):
+        src, dst = src_dst
+        if isinstance(src, pack.PackedImage):
+            return pack.extract(src, dst)
+        return copy_file(src, dst, mode=args.link_mode)
+
+    with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for event in events.split(dt_path_pairs, min_len=args.min_len):
+            start_str = strftime(event[0][0], fmt)
+            out_subdir = join(args.out_dir, start_str)
+            try:
+                os.makedirs(out_subdir)
+            except FileExistsError:
+                pass
+            print("  event from: %s (%d time points)" %
+                  (start_str, len(event)))
+            src_dst = [(p, join(out_subdir, strftime(dt, fmt)))
+                       for dt, p in event]
+            n_written = sum(executor.map(copy, src_dst))
+            if n_written < len(src_dst):
+                print("    %d files already present, skipped" %
+                      (len(src_dst) - n_written))
 
 
 def add_parser(subparsers):
@@ -56,4 +70,9 @@ def add_parser(subparsers):
                         default=events.MIN_EVENT_LEN,
                         help="skip events shorter than N_SECONDS")
     parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
+    parser.add_argument("--link-mode", choices=LINK_MODES, default="copy",
+                        help="how to materialize event files (files that "
+                        "already exist with the same size are skipped)")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=4,
+                        help="number of parallel copy threads")
     parser.set_defaults(func=main)
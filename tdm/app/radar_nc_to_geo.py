@@ -15,11 +15,15 @@
 from netCDF4 import Dataset
 import datetime
 import os
+import tempfile
 
 import cf_units
 import gdal
+import numpy as np
 
 from tdm.radar import utils
+from tdm.utils import cache_key, get_cache_dir
+import tdm.geotiff as geotiff
 
 gdal.UseExceptions()
 strftime = datetime.datetime.strftime
@@ -35,22 +39,94 @@ Y_NAME = "projection_y_coordinate"
 TIME_NAME = "time"
 
 
-class MemRasterBuilder(object):
+class WarpPlan(object):
+    """\
+    Nearest neighbour mapping from source to target pixels.
 
-    def __init__(self, geo_tr, wkt):
-        self.driver = gdal.GetDriverByName("MEM")
-        self.geo_tr = geo_tr
+    The mapping is computed once, by warping a raster whose values are the
+    source pixel indices, so that warping each frame reduces to a gather
+    that gives the same result as gdal.Warp with the default (nearest
+    neighbour) resampling.
+    """
+
+    def __init__(self, index, geo_tr, wkt):
+        self.index = index
+        self.valid = index >= 0
+        self.safe_index = np.where(self.valid, index, 0)
+        self.geo_tr = tuple(float(_) for _ in geo_tr)
         self.wkt = wkt
 
-    def build(self, data):
+    @classmethod
+    def compute(cls, geo_tr, wkt, shape, t_srs):
+        rows, cols = shape
+        driver = gdal.GetDriverByName("MEM")
+        raster = driver.Create("", cols, rows, 1, gdal.GDT_Int32)
+        raster.GetRasterBand(1).WriteArray(
+            np.arange(rows * cols, dtype=np.int32).reshape(rows, cols)
+        )
+        raster.SetGeoTransform(geo_tr)
+        raster.SetProjection(wkt)
+        warped = gdal.Warp("", raster, format="MEM", dstSRS=t_srs,
+                           dstNodata=-1)
+        index = warped.GetRasterBand(1).ReadAsArray().astype(np.int32)
+        return cls(index, warped.GetGeoTransform(), warped.GetProjectionRef())
+
+    @classmethod
+    def get(cls, geo_tr, wkt, shape, t_srs):
+        """\
+        Same as compute, but cache the plan on disk (see
+        tdm.utils.get_cache_dir).
+        """
+        cache_dir = get_cache_dir("warp")
+        if cache_dir is None:
+            return cls.compute(geo_tr, wkt, shape, t_srs)
+        key = cache_key(tuple(geo_tr), wkt, tuple(shape), t_srs)
+        path = os.path.join(cache_dir, f"{key}.npz")
+        try:
+            with np.load(path) as cached:
+                return cls(cached["index"], cached["geo_tr"],
+                           str(cached["wkt"]))
+        except (OSError, KeyError, ValueError):
+            pass
+        plan = cls.compute(geo_tr, wkt, shape, t_srs)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, index=plan.index, geo_tr=np.array(plan.geo_tr),
+                         wkt=np.array(plan.wkt))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return plan
+
+    def apply(self, data):
+        """\
+        Warp a (masked) 2D array. Target pixels that fall outside the source
+        grid or map to masked source pixels are set to the fill value.
+        """
+        fill_value = float(data.fill_value)
+        out = data.filled().ravel().take(self.safe_index)
+        out[~self.valid] = fill_value
+        return out, fill_value
+
+
+class RasterBuilder(object):
+
+    def __init__(self, plan):
+        self.driver = gdal.GetDriverByName("MEM")
+        self.plan = plan
+
+    def build(self, data, fill_value, metadata=None):
         rows, cols = data.shape
         raster = self.driver.Create("", cols, rows, 1, gdal.GDT_Float32)
+        raster.SetGeoTransform(self.plan.geo_tr)
+        raster.SetProjection(self.plan.wkt)
+        if metadata:
+            raster.SetMetadata(metadata)
         band = raster.GetRasterBand(1)
-        band.WriteArray(data.filled())
-        band.SetNoDataValue(float(data.fill_value))
-        band.FlushCache()  # useless?
-        raster.SetGeoTransform(self.geo_tr)
-        raster.SetProjection(self.wkt)
+        band.WriteArray(data)
+        band.SetNoDataValue(fill_value)
         return raster
 
 
@@ -89,22 +165,26 @@ def main(args):
         grid_mapping = ds.variables[rf_rate.grid_mapping]
     except (AttributeError, KeyError):
         raise RuntimeError("rainfall rate: grid mapping not found")
-    raster_builder = MemRasterBuilder(geo_tr, grid_mapping.crs_wkt)
-    out_driver = gdal.GetDriverByName("GTiff")
+    wkt = grid_mapping.crs_wkt
+    shape = rf_rate.shape[1:]
+    plan = WarpPlan.get(geo_tr, wkt, shape, t_srs)
+    raster_builder = RasterBuilder(plan)
+    profile = geotiff.from_args(args)
     nt = len(dts)
     print("saving to %s" % args.out_dir)
     for i, (dt, data) in enumerate(zip(dts, rf_rate)):
         out_dt = strftime(dt, utils.FMT)
         print("  %s (%d/%d)" % (out_dt, i + 1, nt))
-        raster = raster_builder.build(data)
-        warped_raster = gdal.Warp("", raster, format="MEM", dstSRS=t_srs)
-        warped_raster.SetMetadata({"TIFFTAG_DATETIME": strftime(dt, FMT)})
+        warped, fill_value = plan.apply(np.ma.asarray(data))
         out_path = os.path.join(args.out_dir, "%s.tif" % out_dt)
-        out_driver.CreateCopy(out_path, warped_raster)
+        metadata = {"TIFFTAG_DATETIME": strftime(dt, FMT)}
+        raster = raster_builder.build(warped, fill_value, metadata=metadata)
+        profile.save(out_path, raster)
 
 
 def add_parser(subparsers):
     parser = subparsers.add_parser("radar_nc_to_geo")
     parser.add_argument("nc_path", metavar="NETCDF_FILE")
     parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
+    geotiff.add_arguments(parser)
     parser.set_defaults(func=main)
@@ -0,0 +1,68 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""\
+Pack raw radar images into per-day or per-event containers.
+"""
+
+import argparse
+import datetime
+import os
+
+import tdm.radar.events as events
+import tdm.radar.pack as pack
+import tdm.radar.utils as utils
+
+strftime = datetime.datetime.strftime
+
+GROUP_BY = "day", "event"
+
+
+def main(args):
+    try:
+        os.makedirs(args.out_dir)
+    except FileExistsError:
+        pass
+    print("scanning %s" % args.in_dir)
+    dt_path_pairs = utils.get_images(args.in_dir, include_packs=True)
+    if args.by == "event":
+        names = {}
+        pairs = []
+        for event in events.split(dt_path_pairs, min_len=args.min_len):
+            name = "%s%s" % (strftime(event[0][0], utils.FMT), pack.PACK_EXT)
+            names.update((dt, name) for dt, _ in event)
+            pairs.extend(event)
+        dt_path_pairs = pairs
+        get_name = names.__getitem__
+    else:
+        get_name = pack.get_pack_name
+    n = pack.pack_images(dt_path_pairs, args.out_dir, get_name=get_name)
+    print("  %d images packed, %d already present" %
+          (n, len(dt_path_pairs) - n))
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser(
+        "radar_pack",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=f"{__doc__}\n{pack.__doc__}"
+    )
+    parser.add_argument("in_dir", metavar="INPUT_DIR")
+    parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
+    parser.add_argument("--by", choices=GROUP_BY, default="day",
+                        help="create one pack per day or per event")
+    parser.add_argument("-l", "--min-len", metavar="N_SECONDS", type=int,
+                        default=events.MIN_EVENT_LEN,
+                        help="skip events shorter than N_SECONDS (--by event)")
+    parser.set_defaults(func=main)
@@ -0,0 +1,39 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""\
+Extract raw radar images from packs created with radar_pack.
+"""
+
+import os
+
+import tdm.radar.pack as pack
+import tdm.radar.utils as utils
+
+
+def main(args):
+    try:
+        os.makedirs(args.out_dir)
+    except FileExistsError:
+        pass
+    for path in pack.find_packs(args.in_path):
+        n = pack.unpack(path, args.out_dir, utils.FMT)
+        print("  %s: %d images extracted" % (os.path.basename(path), n))
+
+
+def add_parser(subparsers):
+    parser = subparsers.add_parser("radar_unpack", description=__doc__)
+    parser.add_argument("in_path", metavar="PACK_OR_DIR")
+    parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
+    parser.set_defaults(func=main)
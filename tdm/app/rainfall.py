@@ -16,9 +16,12 @@
 Estimate rainfall from radar images.
 """
 
+from concurrent import futures
 import datetime
 import os
 
+from tdm.utils import ordered_map
+import tdm.geotiff as geotiff
 import tdm.radar.utils as utils
 import tdm.radar.cfio as cfio
 import tdm.radar.tiffio as tiffio
@@ -28,6 +31,9 @@ strftime = datetime.datetime.strftime
 OUT_FMTS = frozenset(("nc", "tif"))
 T_CHUNKS = cfio.T_CHUNKS
 
+# max number of pending tasks per worker process
+READ_AHEAD = 2
+
 
 def get_rr_stream(dt_path_pairs):
     for dt, path in dt_path_pairs:
@@ -35,35 +41,86 @@ def get_rr_stream(dt_path_pairs):
         yield dt, utils.estimate_rainfall(signal)
 
 
+def estimate_task(dt_path):
+    dt, path = dt_path
+    return dt, utils.estimate_rainfall(utils.get_image_data(path))
+
+
+def avg_task(dt_paths):
+    dt, paths = dt_paths
+    acc = utils.RainfallAccumulator()
+    for p in paths:
+        acc.add(utils.estimate_rainfall(utils.get_image_data(p)))
+    return dt, acc.mean()
+
+
+def get_parallel_rr_stream(executor, n_workers, dt_path_pairs, delta=None):
+    """\
+    Same as get_rr_stream (or avg_rainfall, if delta is set), but decode
+    images and estimate rainfall in executor. Results are yielded in the
+    same order as the input, with at most READ_AHEAD * n_workers pending.
+    """
+    max_pending = READ_AHEAD * n_workers
+    if delta:
+        groups = utils.group_images(dt_path_pairs, delta)
+        tasks = ((dt, [p for _, p in g]) for dt, g in groups)
+        return ordered_map(executor, avg_task, tasks, max_pending)
+    return ordered_map(executor, estimate_task, dt_path_pairs, max_pending)
+
+
 def main(args):
     try:
         os.makedirs(args.out_dir)
     except FileExistsError:
         pass
     ga = utils.GeoAdapter(args.footprint)
-    dt_path_pairs = utils.get_images(args.img_dir)
-    groups = None
-    if args.resolution:
-        group_gen = utils.group_images(dt_path_pairs, args.resolution)
-        groups = [(dt, list(g)) for dt, g in group_gen]
-        nt, t0 = len(groups), groups[0][0]
-        rr_stream = utils.avg_rainfall(groups)
-        report_int = 1
-    else:
-        nt, t0 = len(dt_path_pairs), dt_path_pairs[0][0]
-        rr_stream = get_rr_stream(dt_path_pairs)
-        report_int = 100
-    if args.format == "nc":
-        ds_path = os.path.join(args.out_dir, "%s.nc" % strftime(t0, utils.FMT))
-        writer = cfio.NCWriter(ds_path, ga, nt, t0, t_chunks=args.t_chunks)
-    elif args.format == "tif":
-        writer = tiffio.GTiffWriter(args.out_dir, ga)
-    print("  0/%d" % nt)
-    for i, (dt, rr) in enumerate(rr_stream):
-        if ((i + 1) % report_int == 0):
-            print("  %d/%d" % (i + 1, nt))
-        writer.write(i, dt, rr)
-    writer.close()
+    dt_path_pairs = utils.get_images(args.img_dir, include_packs=True)
+    executor = None
+    if args.workers > 1:
+        executor = futures.ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        if args.cache_signal:
+            dt_path_pairs = utils.cache_images(dt_path_pairs,
+                                               executor=executor)
+        if args.resolution:
+            group_dts = [dt for dt, _ in
+                         utils.group_images(dt_path_pairs, args.resolution)]
+            nt, t0 = len(group_dts), group_dts[0]
+            if executor:
+                rr_stream = get_parallel_rr_stream(
+                    executor, args.workers, dt_path_pairs, args.resolution
+                )
+            else:
+                groups = utils.group_images(dt_path_pairs, args.resolution)
+                rr_stream = utils.avg_rainfall(groups)
+            report_int = 1
+        else:
+            nt, t0 = len(dt_path_pairs), dt_path_pairs[0][0]
+            if executor:
+                rr_stream = get_parallel_rr_stream(
+                    executor, args.workers, dt_path_pairs
+                )
+            else:
+                rr_stream = get_rr_stream(dt_path_pairs)
+            report_int = 100
+        if args.format == "nc":
+            ds_path = os.path.join(args.out_dir,
+                                   "%s.nc" % strftime(t0, utils.FMT))
+            writer = cfio.NCWriter(ds_path, ga, nt, t0, t_chunks=args.t_chunks)
+        elif args.format == "tif":
+            writer = tiffio.GTiffWriter(args.out_dir, ga,
+                                        profile=geotiff.from_args(args))
+        print("  0/%d" % nt)
+        try:
+            for i, (dt, rr) in enumerate(rr_stream):
+                if ((i + 1) % report_int == 0):
+                    print("  %d/%d" % (i + 1, nt))
+                writer.write(i, dt, rr)
+        finally:
+            writer.close()
+    finally:
+        if executor:
+            executor.shutdown()
 
 
 def add_parser(subparsers):
@@ -77,4 +134,11 @@ def add_parser(subparsers):
                         help="output format")
     parser.add_argument("--t-chunks", metavar="N", type=int, default=T_CHUNKS,
                         help="chunk size along the t dimension (nc output)")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=1,
+                        help="decode images and estimate rainfall with N "
+                        "parallel processes")
+    parser.add_argument("--cache-signal", action="store_true",
+                        help="read the decoded signal from memory-mapped "
+                        "per-day cubes, building them if necessary")
+    geotiff.add_arguments(parser)
     parser.set_defaults(func=main)
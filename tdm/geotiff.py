@@ -0,0 +1,151 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""\
+GeoTIFF output profiles: tiling, compression, internal overviews and
+Cloud Optimized GeoTIFF (COG) layout.
+
+Tiled, compressed files with overviews are much cheaper to serve over HTTP,
+since clients can fetch only the blocks (and the resolution level) they need.
+"""
+
+import gdal
+
+gdal.UseExceptions()
+
+COMPRESSIONS = "NONE", "DEFLATE", "ZSTD", "LZW"
+PREDICTORS = {"auto": None, "none": 1, "horizontal": 2, "float": 3}
+# the COG driver uses names instead of TIFF predictor codes
+COG_PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+BLOCK_SIZE = 256
+OVERVIEW_RESAMPLING = "AVERAGE"
+
+FLOAT_TYPES = frozenset((gdal.GDT_Float32, gdal.GDT_Float64))
+
+
+class OutputProfile(object):
+    """\
+    How to write GeoTIFF files. The default profile writes plain, striped,
+    uncompressed files. Setting cog implies tiling and overviews.
+    """
+
+    def __init__(self, tiled=False, block_size=BLOCK_SIZE, compress="NONE",
+                 predictor="auto", overviews=False, cog=False):
+        if compress not in COMPRESSIONS:
+            raise ValueError(f"unsupported compression: {compress!r}")
+        if predictor not in PREDICTORS:
+            raise ValueError(f"unsupported predictor: {predictor!r}")
+        if block_size % 16:
+            raise ValueError("block size must be a multiple of 16")
+        self.tiled = tiled or cog
+        self.block_size = block_size
+        self.compress = compress
+        self.predictor = predictor
+        self.overviews = overviews or cog
+        self.cog = cog
+
+    def get_predictor(self, data_type):
+        if self.compress == "NONE":
+            return None
+        p = PREDICTORS[self.predictor]
+        if p is None:
+            p = 3 if data_type in FLOAT_TYPES else 2
+        return p
+
+    def creation_options(self, data_type=gdal.GDT_Float32):
+        opts = []
+        if self.tiled:
+            opts.extend(("TILED=YES",
+                         f"BLOCKXSIZE={self.block_size}",
+                         f"BLOCKYSIZE={self.block_size}"))
+        if self.compress != "NONE":
+            opts.append(f"COMPRESS={self.compress}")
+            opts.append(f"PREDICTOR={self.get_predictor(data_type)}")
+        return opts
+
+    def overview_levels(self, cols, rows):
+        levels, f = [], 2
+        while min(cols, rows) / f >= self.block_size / 2:
+            levels.append(f)
+            f *= 2
+        return levels
+
+    def save(self, path, raster):
+        """\
+        Write raster (typically a MEM dataset) to path as a GeoTIFF.
+        """
+        data_type = raster.GetRasterBand(1).DataType
+        opts = self.creation_options(data_type)
+        levels = []
+        if self.overviews:
+            levels = self.overview_levels(raster.RasterXSize,
+                                          raster.RasterYSize)
+        if not self.cog:
+            out = gdal.GetDriverByName("GTiff").CreateCopy(
+                path, raster, options=opts
+            )
+            if levels:
+                out.BuildOverviews(OVERVIEW_RESAMPLING, levels)
+            out.FlushCache()
+            return out
+        cog_driver = gdal.GetDriverByName("COG")
+        if cog_driver is not None:
+            # the COG driver compresses with LZW by default
+            cog_opts = [f"BLOCKSIZE={self.block_size}",
+                        f"OVERVIEW_RESAMPLING={OVERVIEW_RESAMPLING}",
+                        f"COMPRESS={self.compress}"]
+            if self.compress != "NONE":
+                p = COG_PREDICTORS[self.get_predictor(data_type)]
+                cog_opts.append(f"PREDICTOR={p}")
+            return cog_driver.CreateCopy(path, raster, options=cog_opts)
+        # GDAL < 3.1: build overviews on an in-memory copy first, then let
+        # the GTiff driver lay out the file with overviews before data
+        mem = gdal.GetDriverByName("MEM").CreateCopy("", raster)
+        if levels:
+            mem.BuildOverviews(OVERVIEW_RESAMPLING, levels)
+        opts.append("COPY_SRC_OVERVIEWS=YES")
+        return gdal.GetDriverByName("GTiff").CreateCopy(path, mem,
+                                                        options=opts)
+
+
+DEFAULT_PROFILE = OutputProfile()
+
+
+def add_arguments(parser):
+    """\
+    Add GeoTIFF output profile options to an argparse parser.
+    """
+    group = parser.add_argument_group("GeoTIFF output")
+    group.add_argument("--tiled", action="store_true",
+                       help="write tiled (instead of striped) GeoTIFFs")
+    group.add_argument("--block-size", metavar="N", type=int,
+                       default=BLOCK_SIZE, help="tile size in pixels")
+    group.add_argument("--compress", choices=COMPRESSIONS, default="NONE",
+                       help="GeoTIFF compression")
+    group.add_argument("--predictor", choices=list(PREDICTORS),
+                       default="auto", help="predictor for compression "
+                       "(auto: float for floating point data)")
+    group.add_argument("--overviews", action="store_true",
+                       help="add internal overviews")
+    group.add_argument("--cog", action="store_true",
+                       help="write Cloud Optimized GeoTIFFs (implies "
+                       "--tiled and --overviews)")
+    return group
+
+
+def from_args(args):
+    return OutputProfile(tiled=args.tiled, block_size=args.block_size,
+                         compress=args.compress, predictor=args.predictor,
+                         overviews=args.overviews, cog=args.cog)
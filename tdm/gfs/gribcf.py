@@ -0,0 +1,299 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""\
+Convert GRIB2 files to a CF-1.6 NetCDF4 dataset in process, with ecCodes.
+
+Each GRIB message is decoded once and written directly to its slot in the
+output dataset. A first pass over the message headers (which does not
+decode any data) determines the variables and time steps, so that the
+output can be laid out in advance: the time dimension is unlimited, but its
+coordinate is written before any data. Variables are named as in the
+output of wgrib2 -netcdf (<VARIABLE>_<level, without spaces>, e.g.,
+TMP_2maboveground), so that the result can be used in place of the one
+produced by the wgrib2 + cdo pipeline.
+
+Since names do not include the statistical processing interval, some
+messages can map to the same variable and time: e.g., GFS files for step
+12 contain both the 6-12 and the 0-12 hour precipitation accumulation. As
+with wgrib2 -netcdf, where later messages overwrite earlier ones, the last
+such message is kept (for GFS accumulations, the one since the start of the
+run).
+
+Only regular lat/lon grids are supported.
+"""
+
+from datetime import datetime
+import collections
+import logging
+
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    import eccodes
+except ImportError:
+    eccodes = None
+
+LOGGER = logging.getLogger("tdm.gfs.gribcf")
+
+EPOCH = datetime(1970, 1, 1)
+TIME_UNITS = "seconds since 1970-01-01 00:00:00.0"
+FILL_VALUE = np.float32(9.999e20)
+
+GLOBAL_ATTRIBUTES = {
+    "Conventions": "CF-1.6",
+    "source": "GFS",
+    "references": "http://www.tdm-project.it",
+}
+
+# wgrib2 abbreviations for (discipline, category, number)
+PARAM_NAMES = {
+    (0, 0, 0): "TMP",
+    (0, 0, 6): "DPT",
+    (0, 1, 1): "RH",
+    (0, 1, 7): "PRATE",
+    (0, 1, 8): "APCP",
+    (0, 2, 2): "UGRD",
+    (0, 2, 3): "VGRD",
+    (0, 2, 22): "GUST",
+    (0, 3, 0): "PRES",
+    (0, 3, 1): "PRMSL",
+    (0, 3, 5): "HGT",
+    (0, 6, 1): "TCDC",
+    (0, 7, 6): "CAPE",
+}
+
+# wgrib2 level descriptions (without spaces) for fixed surface types
+LEVEL_NAMES = {
+    1: "surface",
+    8: "topofatmosphere",
+    10: "entireatmosphere",
+    101: "meansealevel",
+    200: "entireatmosphere",
+}
+
+# (scale, suffix) for fixed surface types with a value, which is encoded
+# in SI units (Pa for pressure, m for height and depth): wgrib2 shows
+# pressure in mb
+LEVEL_UNITS = {
+    100: (0.01, "mb"),
+    103: (1, "maboveground"),
+    106: (1, "mbelowground"),
+    108: (0.01, "mbaboveground"),
+}
+
+Field = collections.namedtuple("Field", "name time attrs")
+
+
+def _format_value(v):
+    return "%g" % round(v, 6)
+
+
+def get_level_name(type_, value, value2=None):
+    """\
+    Get the wgrib2 level name (without spaces) for a fixed surface of the
+    given type. value (and value2, for layers) must be in the units used
+    in GRIB2, e.g., Pa for isobaric levels:
+
+    >>> get_level_name(100, 40), get_level_name(100, 4000)
+    ('0.4mb', '40mb')
+    >>> get_level_name(106, 0, 0.1)
+    '0-0.1mbelowground'
+    """
+    if type_ in LEVEL_NAMES:
+        return LEVEL_NAMES[type_]
+    if value is None:
+        return "level%d" % type_
+    if type_ in LEVEL_UNITS:
+        scale, suffix = LEVEL_UNITS[type_]
+        name = _format_value(scale * value)
+        if value2 is not None:
+            name = "%s-%s" % (name, _format_value(scale * value2))
+        return name + suffix
+    return "level%d_%s" % (type_, _format_value(value))
+
+
+def get_surface(gid, which):
+    """\
+    Get the type and value (None if missing) of the "First" or "Second"
+    fixed surface of a message. Values are computed from the scaled value
+    and scale factor, rather than read from the "level" key, whose units
+    depend on the type of level as defined by ecCodes.
+    """
+    type_ = eccodes.codes_get(gid, "typeOf%sFixedSurface" % which)
+    scaled_key = "scaledValueOf%sFixedSurface" % which
+    factor_key = "scaleFactorOf%sFixedSurface" % which
+    if type_ == 255 or eccodes.codes_is_missing(gid, scaled_key):
+        return type_, None
+    value = eccodes.codes_get(gid, scaled_key)
+    if not eccodes.codes_is_missing(gid, factor_key):
+        value *= 10.0 ** -eccodes.codes_get(gid, factor_key)
+    return type_, value
+
+
+def get_field(gid):
+    """\
+    Get the name, valid time and attributes of the field in a message.
+    """
+    get = eccodes.codes_get
+    key = tuple(get(gid, _) for _ in
+                ("discipline", "parameterCategory", "parameterNumber"))
+    var = PARAM_NAMES.get(key) or get(gid, "shortName").upper()
+    type_, value = get_surface(gid, "First")
+    type2, value2 = get_surface(gid, "Second")
+    level = get_level_name(type_, value, value2 if type2 == type_ else None)
+    vdate, vtime = get(gid, "validityDate"), get(gid, "validityTime")
+    dt = datetime.strptime("%08d%04d" % (vdate, vtime), "%Y%m%d%H%M")
+    attrs = {"short_name": "%s_%s" % (var, level),
+             "long_name": get(gid, "name"),
+             "level": level,
+             "units": get(gid, "units")}
+    return Field("%s_%s" % (var, level), dt, attrs)
+
+
+def iter_messages(paths, headers_only=False):
+    """\
+    Yield (path, message handle) pairs for all messages in paths. Handles
+    are released after the consumer gets the next one.
+    """
+    if eccodes is None:
+        raise RuntimeError("ecCodes Python bindings not available")
+    for path in paths:
+        with open(path, "rb") as f:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(
+                    f, headers_only=headers_only
+                )
+                if gid is None:
+                    break
+                try:
+                    yield path, gid
+                finally:
+                    eccodes.codes_release(gid)
+
+
+def get_grid(gid):
+    """\
+    Latitudes and longitudes of a regular lat/lon grid, with latitudes in
+    ascending order.
+    """
+    grid_type = eccodes.codes_get(gid, "gridType")
+    if grid_type != "regular_ll":
+        raise ValueError("unsupported grid type: %s" % grid_type)
+    lats = eccodes.codes_get_array(gid, "distinctLatitudes")
+    lons = eccodes.codes_get_array(gid, "distinctLongitudes")
+    return np.sort(lats), lons
+
+
+def get_values(gid, n_lat, n_lon):
+    """\
+    Decode the data in a message into a (lat, lon) float32 array, with
+    latitudes in ascending order and FILL_VALUE for missing points.
+    """
+    values = eccodes.codes_get_values(gid).reshape(n_lat, n_lon)
+    missing = None
+    if eccodes.codes_get(gid, "bitmapPresent"):
+        missing = values == eccodes.codes_get(gid, "missingValue")
+    values = values.astype(np.float32)
+    if missing is not None:
+        values[missing] = FILL_VALUE
+    if eccodes.codes_get(gid, "jScansPositively") == 0:
+        values = values[::-1]
+    return values
+
+
+class CFWriter(object):
+    """\
+    CF-1.6 NetCDF4 dataset with the given time steps and variables on a
+    regular lat/lon grid. Each variable is stored as (time, lat, lon),
+    chunked by time step and compressed.
+    """
+
+    def __init__(self, path, times, fields, lats, lons, complevel=4):
+        self.ds = Dataset(path, "w")
+        self.ds.setncatts(GLOBAL_ATTRIBUTES)
+        self.t_index = {t: i for i, t in enumerate(times)}
+        self.ds.createDimension("time", None)
+        self.ds.createDimension("latitude", len(lats))
+        self.ds.createDimension("longitude", len(lons))
+        t = self.ds.createVariable("time", "f8", ("time",))
+        t.setncatts({"units": TIME_UNITS, "standard_name": "time",
+                     "long_name": "verification time", "axis": "T",
+                     "calendar": "standard"})
+        t[:] = [(_ - EPOCH).total_seconds() for _ in times]
+        lat = self.ds.createVariable("latitude", "f8", ("latitude",))
+        lat.setncatts({"units": "degrees_north", "axis": "Y",
+                       "standard_name": "latitude", "long_name": "latitude"})
+        lat[:] = lats
+        lon = self.ds.createVariable("longitude", "f8", ("longitude",))
+        lon.setncatts({"units": "degrees_east", "axis": "X",
+                       "standard_name": "longitude",
+                       "long_name": "longitude"})
+        lon[:] = lons
+        for name, attrs in fields.items():
+            v = self.ds.createVariable(
+                name, "f4", ("time", "latitude", "longitude"), zlib=True,
+                complevel=complevel, chunksizes=(1, len(lats), len(lons)),
+                fill_value=FILL_VALUE
+            )
+            v.setncatts(attrs)
+            v.set_auto_maskandscale(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, name, time, values):
+        self.ds.variables[name][self.t_index[time]] = values
+
+    def close(self):
+        self.ds.close()
+
+
+def convert(paths, output_nc, complevel=4):
+    """\
+    Convert the GRIB2 files in paths to a single CF NetCDF dataset. If
+    more than one message maps to the same variable and time, only the last
+    one is converted, with a warning.
+    """
+    fields, grid = {}, None
+    selected = {}  # (name, time) -> position of the message to convert
+    # grid geometry is in the headers, so this does not decode any data
+    for i, (path, gid) in enumerate(iter_messages(paths, headers_only=True)):
+        if grid is None:
+            grid = get_grid(gid)
+            n_points = grid[0].size * grid[1].size
+        elif eccodes.codes_get(gid, "numberOfDataPoints") != n_points:
+            raise ValueError("%s: grid mismatch" % path)
+        f = get_field(gid)
+        if (f.name, f.time) in selected:
+            LOGGER.warning("%s: duplicate field %s at %s, keeping the last "
+                           "one", path, f.name, f.time)
+        selected[(f.name, f.time)] = i
+        fields.setdefault(f.name, f.attrs)
+    if grid is None:
+        raise ValueError("no GRIB messages found")
+    lats, lons = grid
+    times = sorted(set(t for _, t in selected))
+    positions = set(selected.values())
+    with CFWriter(output_nc, times, fields, lats, lons,
+                  complevel=complevel) as writer:
+        for i, (_, gid) in enumerate(iter_messages(paths)):
+            if i not in positions:
+                continue
+            f = get_field(gid)
+            writer.write(f.name, f.time, get_values(gid, lats.size, lons.size))
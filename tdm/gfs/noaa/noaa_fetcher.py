@@ -12,10 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import functools
+import io
+import json
 import os
+import queue
+import random
+import threading
 import time
-from ftplib import FTP
+from ftplib import FTP, error_perm, error_reply, error_temp
 from concurrent import futures
 import logging
 
@@ -23,60 +32,556 @@ logging.basicConfig()
 LOGGER = logging.getLogger('tdm.gfs.noaa')
 LOGGER.setLevel(logging.DEBUG)
 
+BLOCK_SIZE = 1024 * 1024
+
+# Forecast hours published for each resolution: hourly up to 120 and every
+# three hours up to 384 for 0p25, every three hours for the others
+FORECAST_HOURS = {
+    '0p25': list(range(0, 121)) + list(range(123, 385, 3)),
+    '0p50': list(range(0, 385, 3)),
+    '1p00': list(range(0, 385, 3)),
+}
+
+# Fields used by map_to_tree, named as in the NetCDF files written by
+# wgrib2: <VARIABLE>_<level, without spaces>
+DEFAULT_SUBSET = frozenset((
+    'TCDC_surface', 'APCP_surface', 'TMP_2maboveground',
+    'UGRD_10maboveground', 'VGRD_10maboveground',
+))
+
+GRIB_MAGIC = b'GRIB'
+
+# Errors that do not mean the request itself was wrong: connection dropped
+# or timed out, server busy, etc.
+TRANSIENT_ERRORS = (error_temp, error_reply, EOFError, OSError)
+
+
+def parse_list_line(line):
+    """\
+    Get the name and size of a file from a line of Unix-style LIST output.
+    """
+    fields = line.split(None, 8)
+    return fields[8], int(fields[4])
+
+
+# Reserve space without changing the apparent file size, so that the size
+# of a partially downloaded file is always the number of bytes received
+FALLOC_FL_KEEP_SIZE = 1
+try:
+    _fallocate = ctypes.CDLL(ctypes.util.find_library("c")).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+
+def _preallocate(fd, offset, size):
+    if _fallocate is not None and size > offset:
+        _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, size - offset)
+
+
+class FTPPool(object):
+    """\
+    Pool of logged-in connections to an FTP server. Connections are opened
+    on demand, up to size, and reused by subsequent operations, saving a
+    connection handshake and login for each file. A connection that raises
+    an error is closed instead of being returned to the pool. Idle
+    connections are checked with a NOOP before being reused, since the
+    server might have closed them in the meantime: dead ones are replaced
+    with new ones.
+    """
+
+    def __init__(self, host, port=0, size=4, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.n_connects = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __connect(self):
+        ftp = FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login()
+        self.n_connects += 1
+        return ftp
+
+    def __get(self):
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                return self.__connect()
+            try:
+                ftp.voidcmd("NOOP")
+                return ftp
+            except TRANSIENT_ERRORS as e:
+                LOGGER.debug('discarding stale FTP connection: %s', e)
+                ftp.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.slots:
+            ftp = self.__get()
+            try:
+                yield ftp
+            except BaseException:
+                ftp.close()
+                raise
+            self.idle.put(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+
+def get_part_path(target):
+    tdir, fname = os.path.split(target)
+    return os.path.join(tdir, f".{fname}.part")
+
+
+def download(pool, path, target, size=None, resume=True,
+             blocksize=BLOCK_SIZE):
+    """\
+    Download the remote file at path to target, using a connection from
+    pool. Data goes to a partial file in the same directory as target, which
+    is renamed to target when the transfer is complete. If size is not None,
+    the transfer is considered complete only if exactly size bytes have been
+    received.
+
+    If resume is true and a partial file from a previous attempt exists,
+    the transfer restarts from its end (with a REST command); partial files
+    are kept on failure, so that a later call can resume.
+    """
+    part = get_part_path(target)
+    offset = 0
+    if resume:
+        try:
+            offset = os.stat(part).st_size
+        except FileNotFoundError:
+            pass
+        if size is not None and offset > size:
+            offset = 0
+    with io.open(part, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        if size:
+            _preallocate(f.fileno(), offset, size)
+        try:
+            if size is None or offset < size:
+                with pool.connection() as ftp:
+                    ftp.retrbinary(f"RETR {path}", f.write,
+                                   blocksize=blocksize, rest=offset or None)
+        finally:
+            n = f.tell()
+            f.truncate(n)
+    if size is not None and n != size:
+        if n > size:
+            os.unlink(part)
+        raise IOError(f"{path}: expected {size} bytes, got {n}")
+    os.replace(part, target)
+    return target
+
+
+def parse_idx(text, size):
+    """\
+    Parse a wgrib2-style GRIB2 inventory (.idx file), where each line is:
+
+      <msg_num>[.<submsg_num>]:<offset>:d=<date>:<VARIABLE>:<level>:...
+
+    size is the size of the GRIB2 file. Returns (name, start, end) tuples,
+    where name is <VARIABLE>_<level, without spaces> and [start, end) is
+    the byte range of the message that contains the field.
+    """
+    records = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 5:
+            continue
+        name = '%s_%s' % (fields[3], fields[4].replace(' ', ''))
+        records.append((name, int(fields[1])))
+    offsets = sorted({_[1] for _ in records}) + [size]
+    end = dict(zip(offsets, offsets[1:]))
+    return [(name, start, end[start]) for name, start in records]
+
+
+def select_ranges(records, names):
+    """\
+    Get the sorted, merged byte ranges of the records whose name is in
+    names.
+    """
+    ranges = []
+    for start, end in sorted({(s, e) for n, s, e in records if n in names}):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [tuple(_) for _ in ranges]
+
+
+def read_range(ftp, path, start, end, callback, blocksize=BLOCK_SIZE):
+    """\
+    Retrieve bytes [start, end) of the remote file at path, using REST to
+    skip to start and closing the data connection after end.
+    """
+    remaining = end - start
+    with ftp.transfercmd('RETR %s' % path, rest=start or None) as conn:
+        while remaining > 0:
+            data = conn.recv(min(blocksize, remaining))
+            if not data:
+                break
+            callback(data)
+            remaining -= len(data)
+    try:
+        ftp.voidresp()
+    except (error_reply, error_temp):
+        # transfer aborted because we closed the data connection early
+        pass
+    if remaining:
+        raise IOError('%s: expected %d bytes at offset %d, got %d' %
+                      (path, end - start, start, end - start - remaining))
+
+
+def download_ranges(pool, path, target, ranges, resume=True,
+                    blocksize=BLOCK_SIZE):
+    """\
+    Download the given byte ranges of the remote file at path and store
+    them, concatenated, to target. Each range must be a sequence of whole
+    GRIB messages, so that the result is a valid GRIB file.
+
+    The ranges are recorded next to the partial file. If resume is true and
+    a partial file for the same ranges exists, the download restarts from
+    its end, skipping ranges that are already complete. As in download,
+    partial files are kept on transfer failure.
+    """
+    part = get_part_path(target)
+    ranges_path = f"{part}.ranges"
+    ranges = [[start, end] for start, end in ranges]
+    total = sum(end - start for start, end in ranges)
+    offset = 0
+    if resume:
+        try:
+            with io.open(ranges_path, "rt") as f:
+                if json.load(f) == ranges:
+                    offset = os.stat(part).st_size
+        except (FileNotFoundError, ValueError):
+            pass
+        if offset > total:
+            offset = 0
+    if not offset:
+        with io.open(ranges_path, "wt") as f:
+            json.dump(ranges, f)
+    with io.open(part, "r+b" if offset else "w+b") as f:
+        f.seek(offset)
+        try:
+            with pool.connection() as ftp:
+                ftp.voidcmd('TYPE I')
+                pos = 0
+                for start, end in ranges:
+                    if pos + end - start > offset:
+                        skip = max(offset - pos, 0)
+                        read_range(ftp, path, start + skip, end, f.write,
+                                   blocksize)
+                        f.seek(pos)
+                        if f.read(len(GRIB_MAGIC)) != GRIB_MAGIC:
+                            f.seek(0)  # discard the partial file
+                            raise IOError('%s: no GRIB message at offset %d'
+                                          % (path, start))
+                        f.seek(0, io.SEEK_END)
+                    pos += end - start
+        finally:
+            f.truncate(f.tell())
+    os.replace(part, target)
+    os.unlink(ranges_path)
+    return target
+
+
+def read_remote(pool, path):
+    buf = io.BytesIO()
+    with pool.connection() as ftp:
+        ftp.retrbinary('RETR %s' % path, buf.write)
+    return buf.getvalue()
+
+
+class Manifest(object):
+    """\
+    Record of the files downloaded to a directory, with their sizes. The
+    manifest is saved to disk after each update.
+    """
+
+    NAME = ".tdm_gfs_manifest.json"
+
+    def __init__(self, tdir):
+        self.tdir = tdir
+        self.path = os.path.join(tdir, self.NAME)
+        self.lock = threading.Lock()
+        try:
+            with io.open(self.path, "rt") as f:
+                self.files = json.load(f)["files"]
+        except (FileNotFoundError, ValueError, KeyError):
+            self.files = {}
+
+    def is_complete(self, fname, size):
+        """\
+        True if fname has been downloaded with the given size and is still
+        there, with the same size.
+        """
+        if self.files.get(fname) != size:
+            return False
+        try:
+            return os.stat(os.path.join(self.tdir, fname)).st_size == size
+        except FileNotFoundError:
+            return False
+
+    def add(self, fname, size):
+        with self.lock:
+            self.files[fname] = size
+            tmp_path = f"{self.path}.tmp"
+            with io.open(tmp_path, "wt") as f:
+                json.dump({"files": self.files}, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class CycleWatcher(object):
+    """\
+    Watch a remote directory where files are being written, reporting each
+    file as soon as its size has not changed for stable_polls consecutive
+    polls. list_files must return a {name: size} dict.
+
+    The interval between polls starts at min_sleep and grows by a factor of
+    backoff, up to max_sleep, while nothing changes; it goes back to
+    min_sleep as soon as a file appears or grows. Each interval is
+    randomized by +/- jitter (a fraction of the interval).
+    """
+
+    def __init__(self, list_files, min_sleep=10, max_sleep=300, backoff=1.5,
+                 jitter=0.25, stable_polls=2, sleep=time.sleep,
+                 clock=time.monotonic):
+        self.list_files = list_files
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.backoff = backoff
+        self.jitter = jitter
+        self.stable_polls = stable_polls
+        self.sleep = sleep
+        self.clock = clock
+        self.interval = min_sleep
+        self.sizes = {}
+        self.n_unchanged = {}
+        self.reported = set()
+
+    def poll(self):
+        """\
+        List the directory once. Return a list of (name, size) pairs for
+        the files that became stable, and whether anything changed. A
+        listing that fails with a transient error (see TRANSIENT_ERRORS)
+        counts as no change.
+        """
+        changed = False
+        stable = []
+        try:
+            listing = self.list_files()
+        except TRANSIENT_ERRORS as e:
+            LOGGER.warning('listing failed, will retry: %r', e)
+            return stable, changed
+        for name, size in sorted(listing.items()):
+            if name in self.reported:
+                continue
+            if self.sizes.get(name) != size:
+                self.sizes[name] = size
+                self.n_unchanged[name] = 1
+                changed = True
+            else:
+                self.n_unchanged[name] += 1
+            if size > 0 and self.n_unchanged[name] >= self.stable_polls:
+                self.reported.add(name)
+                stable.append((name, size))
+        return stable, changed
+
+    def wait(self):
+        j = self.jitter * (2 * random.random() - 1)
+        self.sleep(self.interval * (1 + j))
+
+    def watch(self, expected=None, timeout=None):
+        """\
+        Yield (name, size) pairs for files as they become stable, until all
+        names in expected have been reported (or, if expected is None,
+        until the first poll that finds nothing new or changed after
+        something was reported). If timeout (in seconds) expires first,
+        stop and log the missing files.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            stable, changed = self.poll()
+            for p in stable:
+                yield p
+            if expected is not None:
+                if self.reported.issuperset(expected):
+                    return
+            elif self.reported and not changed and not stable and \
+                    self.reported.issuperset(self.sizes):
+                return
+            if changed or stable:
+                self.interval = self.min_sleep
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_sleep)
+            if deadline is not None and self.clock() + self.interval > \
+                    deadline:
+                missing = sorted(set(expected or self.sizes) - self.reported)
+                LOGGER.error('Timed out waiting for %d files: %s',
+                             len(missing), ', '.join(missing))
+                return
+            self.wait()
+
 
 class noaa_fetcher(object):
     NOAA_FTP_SERVER = 'ftp.ncep.noaa.gov'
+    NOAA_FTP_PORT = 0
     NOAA_BASE_PATH = '/pub/data/nccf/com/gfs/prod/'
     NOAA_DATASET_FOLDER_SIZE = 196608
     FETCH_ATTEMPTS = 3
+    FTP_TIMEOUT = 120
+    POLL_MIN = 10
+    POLL_BACKOFF = 1.5
+    POLL_JITTER = 0.25
+
+    @classmethod
+    def get_pool(cls, size):
+        return FTPPool(cls.NOAA_FTP_SERVER, port=cls.NOAA_FTP_PORT,
+                       size=size, timeout=cls.FTP_TIMEOUT)
 
     @classmethod
-    def list_files_in_path(cls, path):
+    def list_files_in_path(cls, path, pool=None):
         entries = {}
 
         def add_clean_entry(x):
-            size, name = [x.split()[i] for i in (4, 8)]
-            entries[name] = {'size': int(size), 'name': name}
+            name, size = parse_list_line(x)
+            entries[name] = {'size': size, 'name': name}
 
-        with FTP(cls.NOAA_FTP_SERVER) as ftp:
-            ftp.login()
-            ftp.cwd(path)
-            ftp.retrlines('LIST', callback=add_clean_entry)
+        with contextlib.ExitStack() as stack:
+            if pool is None:
+                pool = stack.enter_context(cls.get_pool(1))
+            with pool.connection() as ftp:
+                ftp.cwd(path)
+                ftp.retrlines('LIST', callback=add_clean_entry)
 
         return entries
 
     @classmethod
-    def list_available_dataset_groups(cls):
-        return cls.list_files_in_path(cls.NOAA_BASE_PATH)
+    def list_available_dataset_groups(cls, pool=None):
+        return cls.list_files_in_path(cls.NOAA_BASE_PATH, pool=pool)
 
     def __init__(self, year, month, day, hour):
         self.date = datetime.datetime(year, month, day, hour, 0)
         self.ds = 'gfs.%s' % self.date.strftime("%Y%m%d%H")
         LOGGER.info('Initialized for dataset %s', self.ds)
 
-    def is_dataset_ready(self):
-        available_groups = self.list_available_dataset_groups()
+    def is_dataset_ready(self, pool=None):
+        available_groups = self.list_available_dataset_groups(pool=pool)
         return (self.ds in available_groups and
                 available_groups[self.ds]['size']
                 <= self.NOAA_DATASET_FOLDER_SIZE)
 
-    def fetch_file(self, ds_path, fname, tdir):
+    def fetch_file(self, ds_path, fname, tdir, size=None, pool=None,
+                   resume=True, manifest=None):
         LOGGER.info('Fetching %s/%s into %s', self.ds, fname, tdir)
         begin = datetime.datetime.now()
         target = os.path.join(tdir, fname)
-        with FTP(self.NOAA_FTP_SERVER) as ftp:
-            ftp.login()
-            ftp.cwd(ds_path)
-            cmd = 'RETR %s' % fname
-            ftp.retrbinary(cmd, open(target, 'wb').write,
-                           blocksize=1024*1024)
+        path = '%s/%s' % (ds_path.rstrip('/'), fname)
+        with contextlib.ExitStack() as stack:
+            if pool is None:
+                pool = stack.enter_context(self.get_pool(1))
+            download(pool, path, target, size=size, resume=resume)
+        if manifest is not None:
+            manifest.add(fname, os.stat(target).st_size)
         dt = datetime.datetime.now() - begin
         LOGGER.info('It took %s secs to fetch %s',
                     dt.total_seconds(), fname)
         return target
 
+    def fetch_subset(self, ds_path, fname, tdir, size, pool, resume=True,
+                     manifest=None, variables=DEFAULT_SUBSET):
+        """\
+        Fetch only the GRIB messages for the given variables (see
+        parse_idx for naming) from ds_path/fname, as listed in its .idx
+        inventory, and store them to tdir/fname.
+        """
+        LOGGER.info('Fetching %s/%s (subset) into %s', self.ds, fname, tdir)
+        begin = datetime.datetime.now()
+        target = os.path.join(tdir, fname)
+        path = '%s/%s' % (ds_path.rstrip('/'), fname)
+        idx = read_remote(pool, path + '.idx').decode('ascii', 'replace')
+        ranges = select_ranges(parse_idx(idx, size), variables)
+        if not ranges:
+            raise ValueError('%s: no messages for %s' %
+                             (fname, ', '.join(sorted(variables))))
+        subset_size = sum(e - s for s, e in ranges)
+        if resume and manifest is not None and \
+                manifest.is_complete(fname, subset_size):
+            LOGGER.info('%s already fetched', fname)
+            return target
+        download_ranges(pool, path, target, ranges, resume=resume)
+        if manifest is not None:
+            manifest.add(fname, subset_size)
+        dt = datetime.datetime.now() - begin
+        LOGGER.info('It took %s secs to fetch %d of %d bytes of %s',
+                    dt.total_seconds(), subset_size, size, fname)
+        return target
+
+    def list_cycle(self, ds_path, prefix, pool=None, indexed=False):
+        """\
+        Return {name: size} for files in ds_path whose name starts with
+        prefix (.idx files excluded), or an empty dict if ds_path does not
+        exist (yet). If indexed is true, only include files whose .idx
+        inventory is also available.
+        """
+        try:
+            entries = self.list_files_in_path(ds_path, pool=pool)
+        except error_perm:
+            return {}
+        return {f: e['size'] for f, e in entries.items()
+                if f.startswith(prefix) and not f.endswith('.idx') and
+                (not indexed or f + '.idx' in entries)}
+
+    def get_watcher(self, list_files, tsleep):
+        return CycleWatcher(list_files, min_sleep=min(self.POLL_MIN, tsleep),
+                            max_sleep=tsleep, backoff=self.POLL_BACKOFF,
+                            jitter=self.POLL_JITTER)
+
     def fetch(self, res, tdir, pattern='gfs.t%Hz.pgrb2',
-              nthreads=4, tsleep=300):
+              nthreads=4, tsleep=300, resume=False, hours=None,
+              timeout=None, variables=None):
+        """\
+        Fetch all files for resolution res to tdir. Completed files are
+        recorded in a Manifest in tdir. If resume is true, files that the
+        manifest lists as complete, with the same size as the remote ones,
+        are skipped, and partial downloads left by a previous run are
+        resumed. Failed transfers are always resumed on retry.
+
+        The cycle directory is polled (see CycleWatcher, tsleep is the
+        maximum interval between polls) and each file is downloaded as soon
+        as its size is stable, until the files for all forecast hours
+        (FORECAST_HOURS[res], unless given) have been fetched or timeout
+        seconds have passed.
+
+        If variables is not None, fetch only the GRIB messages for those
+        variables (see fetch_subset), waiting for each file's inventory.
+
+        Returns the sorted names of the files that could not be fetched.
+        """
         def recover_results(fut_by_name):
             failed = []
             for fut in futures.as_completed(fut_by_fname):
@@ -92,30 +597,58 @@ class noaa_fetcher(object):
             return failed
         ds_path = os.path.join(self.NOAA_BASE_PATH, self.ds)
         pre = self.date.strftime(pattern) + '.' + res
+        if hours is None:
+            hours = FORECAST_HOURS.get(res)
+        expected = None
+        if hours is not None:
+            expected = {'%s.f%03d' % (pre, h) for h in hours}
         LOGGER.info('Fetching %s/%s into %s', self.ds, pre, tdir)
-        while not self.is_dataset_ready():
-            LOGGER.info('Dataset %s not ready, sleeping for %d sec',
-                        self.ds, tsleep)
-            time.sleep(tsleep)
-        files = [f for f in self.list_files_in_path(ds_path)
-                 if f.startswith(pre) and not f.endswith('.idx')]
-        begin = datetime.datetime.now()
-        with futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
-            for i in range(self.FETCH_ATTEMPTS):
-                fut_by_fname = {executor.submit(self.fetch_file,
-                                                ds_path, fname, tdir): fname
-                                for fname in files}
-                files = recover_results(fut_by_fname)
+        with self.get_pool(nthreads) as pool, \
+                futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+            manifest = Manifest(tdir)
+            indexed = variables is not None
+            watcher = self.get_watcher(
+                lambda: self.list_cycle(ds_path, pre, pool=pool,
+                                        indexed=indexed), tsleep
+            )
+            if indexed:
+                fetch_file = functools.partial(self.fetch_subset,
+                                               variables=variables)
+            else:
+                fetch_file = self.fetch_file
+            begin = datetime.datetime.now()
+            sizes, fut_by_fname, n_skipped = {}, {}, 0
+            for fname, size in watcher.watch(expected, timeout=timeout):
+                sizes[fname] = size
+                if resume and not indexed and \
+                        manifest.is_complete(fname, size):
+                    n_skipped += 1
+                    continue
+                LOGGER.info('%s is ready', fname)
+                fut = executor.submit(fetch_file, ds_path, fname, tdir,
+                                      size, pool, resume, manifest)
+                fut_by_fname[fut] = fname
+            if n_skipped:
+                LOGGER.info('%d files already fetched', n_skipped)
+            files = recover_results(fut_by_fname)
+            for i in range(1, self.FETCH_ATTEMPTS):
                 if len(files) == 0:
-                    dt = datetime.datetime.now() - begin
-                    LOGGER.info('It took %s secs to fetch %s.',
-                                dt.total_seconds(), self.ds)
                     break
-                else:
-                    LOGGER.info(
-                        'At fetch iteration %d of %d, %d files missing.',
-                        i, self.FETCH_ATTEMPTS, len(files))
+                LOGGER.info(
+                    'At fetch iteration %d of %d, %d files missing.',
+                    i, self.FETCH_ATTEMPTS, len(files))
+                fut_by_fname = {executor.submit(fetch_file,
+                                                ds_path, fname, tdir,
+                                                sizes[fname], pool,
+                                                True, manifest): fname
+                                for fname in files}
+                files = recover_results(fut_by_fname)
+            if len(files) == 0:
+                dt = datetime.datetime.now() - begin
+                LOGGER.info('It took %s secs to fetch %s.',
+                            dt.total_seconds(), self.ds)
             else:
                 LOGGER.error(
                     'Still %d files missing after %d iteration.',
                     len(files), self.FETCH_ATTEMPTS)
+        return sorted(set(files) | (expected or set()) - set(sizes))
@@ -0,0 +1,214 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""\
+Persistent, incrementally updated index of the images in a radar archive
+directory.
+
+Listing a directory with hundreds of thousands of images and parsing the
+timestamp out of each name takes a long time. An ImageCatalog stores
+(timestamp, name) entries in a SQLite database, refreshes them only when the
+directory's mtime changes (parsing only new names) and answers time range
+queries through an index on the timestamp column. Names of other files (e.g.,
+image packs) are also recorded, so that they can be looked up without
+scanning the directory.
+
+The database is stored in the "catalog" subdirectory of the tdm cache (see
+tdm.utils.get_cache_dir), under a key derived from the real path of the
+archive directory: keeping it out of the archive means that updating it
+does not change the directory's mtime (and leaves users' data untouched).
+"""
+
+from datetime import datetime, timedelta
+import itertools as it
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from tdm.utils import cache_key, get_cache_dir
+
+EPOCH = datetime(1970, 1, 1)
+ONE_SEC = timedelta(seconds=1)
+
+# Directory changes that happen less than this many ns before a refresh
+# might not be reflected in the directory's mtime (coarse timestamps), so a
+# catalog refreshed within this window is rescanned the next time it's used.
+RACY_WINDOW_NS = 2 * 10**9
+
+# Catalogs written with a different version are rescanned
+VERSION = 2
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS images (
+  name TEXT PRIMARY KEY,
+  ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_ts ON images (ts, name);
+CREATE TABLE IF NOT EXISTS others (
+  name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+"""
+
+
+def to_seconds(dt):
+    """\
+    Convert a naive datetime to integer seconds since the epoch, rounding
+    towards negative infinity.
+    """
+    return (dt - EPOCH) // ONE_SEC
+
+
+def from_seconds(ts):
+    return EPOCH + timedelta(seconds=ts)
+
+
+def get_db_path(root):
+    cache_dir = get_cache_dir("catalog")
+    if cache_dir is None:
+        return None
+    key = cache_key(os.path.realpath(root))
+    return os.path.join(cache_dir, f"{key}.sqlite")
+
+
+class ImageCatalog(object):
+    """\
+    Catalog of the images in root. The parse function must convert a list
+    of image names to a datetime64[s] array, with NaT for names that should
+    be ignored. The database is stored in db_path, which must not be inside
+    root (by default, it's given by get_db_path).
+    """
+
+    def __init__(self, root, parse, db_path=None):
+        self.root = root
+        self.parse = parse
+        self.db_path = db_path or get_db_path(root)
+        if self.db_path is None:
+            raise ValueError("caching is disabled, no db_path available")
+        self.conn = sqlite3.connect(self.db_path, timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __get_meta(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def is_fresh(self):
+        mtime = os.stat(self.root).st_mtime_ns
+        scan_time = self.__get_meta("scan_time_ns")
+        return (scan_time is not None and
+                self.__get_meta("version") == VERSION and
+                self.__get_meta("mtime_ns") == mtime and
+                scan_time - mtime > RACY_WINDOW_NS)
+
+    def refresh(self, force=False):
+        """\
+        Update the catalog if the directory has changed since the last scan.
+        Only names not already in the catalog are parsed.
+        """
+        if not force and self.is_fresh():
+            return
+        scan_time = int(time.time() * 10**9)
+        mtime = os.stat(self.root).st_mtime_ns
+        names = set()
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                names.add(entry.name)
+        with self.conn:
+            # take the write lock before reading, so that concurrent
+            # refreshes do not try to insert the same names
+            self.conn.execute("BEGIN IMMEDIATE")
+            known = set()
+            for table in "images", "others":
+                table_known = {_[0] for _ in self.conn.execute(
+                    f"SELECT name FROM {table}"
+                )}
+                self.conn.executemany(
+                    f"DELETE FROM {table} WHERE name = ?",
+                    ((_,) for _ in table_known - names)
+                )
+                known |= table_known
+            new_names = sorted(names - known)
+            ts = self.parse(new_names)
+            matching = ~np.isnat(ts)
+            new_rows = zip(it.compress(new_names, matching),
+                           ts[matching].astype(np.int64).tolist())
+            self.conn.executemany(
+                "INSERT INTO images (name, ts) VALUES (?, ?)", new_rows
+            )
+            self.conn.executemany(
+                "INSERT INTO others (name) VALUES (?)",
+                ((_,) for _ in it.compress(new_names, ~matching))
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("mtime_ns", mtime), ("scan_time_ns", scan_time),
+                 ("version", VERSION)]
+            )
+
+    def query(self, after, before):
+        """\
+        Return sorted (datetime, path) pairs for all images whose timestamp
+        is in the [after, before] interval.
+        """
+        lo, hi = -((EPOCH - after) // ONE_SEC), to_seconds(before)
+        join = os.path.join
+        return [(from_seconds(ts), join(self.root, name))
+                for ts, name in self.conn.execute(
+                    "SELECT ts, name FROM images WHERE ts BETWEEN ? AND ? "
+                    "ORDER BY ts, name", (lo, hi)
+                )]
+
+    def find(self, ext):
+        """\
+        Return the sorted paths of all non-image files whose name ends with
+        ext.
+        """
+        return [os.path.join(self.root, name)
+                for name, in self.conn.execute(
+                    "SELECT name FROM others ORDER BY name"
+                ) if name.endswith(ext)]
+
+
+def open_catalog(root, parse):
+    """\
+    Open and refresh the catalog for root. Return None if there's no
+    suitable location for the catalog database.
+    """
+    db_path = get_db_path(root)
+    if db_path is None:
+        return None
+    catalog = ImageCatalog(root, parse, db_path=db_path)
+    try:
+        catalog.refresh()
+    except BaseException:
+        catalog.close()
+        raise
+    return catalog
@@ -21,6 +21,8 @@ from netCDF4 import Dataset
 import datetime
 import os
 
+import numpy as np
+
 from . import utils
 from .io import RainfallWriter
 
@@ -47,6 +49,11 @@ def setncattr(dataset, attrs):
 
 
 class NCWriter(RainfallWriter):
+    """\
+    Frames passed to write are buffered and stored in slabs aligned to the
+    HDF5 chunks along the time dimension, so that each chunk is compressed
+    and written only once. Call close to flush any remaining frames.
+    """
 
     def __init__(self, path, ga, nt, t0, t_chunks=T_CHUNKS):
         self.path = path
@@ -54,6 +61,10 @@ class NCWriter(RainfallWriter):
         self.nt = nt
         self.t0 = t0
         self.t_chunks = min(t_chunks, nt)
+        self.t_buf = np.empty(self.t_chunks, dtype=np.float64)
+        self.rr_buf = np.empty((self.t_chunks, ga.cols, ga.rows),
+                               dtype=np.float32)
+        self.buf_start = self.buf_len = 0
         try:
             os.unlink(self.path)
         except FileNotFoundError:
@@ -65,10 +76,11 @@ class NCWriter(RainfallWriter):
         self.__create_variables()
         self.__attach_crs()
         xpos, ypos = ga.xpos(), ga.ypos()
-        lat_, lon_ = utils.get_lat_lon(ga.sr, xpos, ypos)
+        lat_, lon_ = ga.get_lat_lon()
         self.x[:], self.y[:], self.lat[:], self.lon[:] = xpos, ypos, lat_, lon_
 
     def close(self):
+        self.flush()
         self.ds.close()
 
     # CF conventions, sections 4.4 & 5.1
@@ -157,5 +169,30 @@ class NCWriter(RainfallWriter):
         })
 
     def write(self, i, dt, rr):
-        self.t[i] = (dt - self.t0).total_seconds()
-        self.rf_rate[i, :, :] = rr
+        if self.buf_len and i != self.buf_start + self.buf_len:
+            self.flush()
+        if not self.buf_len:
+            self.buf_start = i
+        self.t_buf[self.buf_len] = (dt - self.t0).total_seconds()
+        self.rr_buf[self.buf_len] = np.ma.filled(rr, utils.RAINFALL_FILL_VALUE)
+        self.buf_len += 1
+        if any(((i + 1) % self.t_chunks == 0,
+                i + 1 >= self.nt,
+                self.buf_len >= self.t_chunks)):
+            self.flush()
+
+    def write_block(self, start, dts, stack):
+        self.flush()
+        if not isinstance(stack, np.ndarray):
+            stack = np.ma.stack(stack)
+        stop = start + len(dts)
+        self.t[start:stop] = [(_ - self.t0).total_seconds() for _ in dts]
+        self.rf_rate[start:stop, :, :] = stack
+
+    def flush(self):
+        if not self.buf_len:
+            return
+        start, stop = self.buf_start, self.buf_start + self.buf_len
+        self.t[start:stop] = self.t_buf[:self.buf_len]
+        self.rf_rate[start:stop, :, :] = self.rr_buf[:self.buf_len]
+        self.buf_start = self.buf_len = 0
@@ -0,0 +1,149 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""\
+Cache of decoded radar signal, stored as memory-mapped cubes.
+
+Decoding PNG images is the most expensive step of reading raw radar data.
+A cube holds the decoded signal and mask of all images for a given day as
+two (time, rows, cols) arrays in NumPy's .npy format, plus a datetime64[s]
+array with the timestamp of each image. Cubes are located in the "cube"
+subdirectory of the tdm cache (see tdm.utils.get_cache_dir) and named after
+a hash of their source images (path, size and modification time), so a
+cube is rebuilt whenever the set of images it was built from changes.
+
+Images read from a cube are masked arrays backed by the memory-mapped
+arrays (no data is copied). They are read-only.
+"""
+
+from functools import lru_cache
+import collections
+import itertools as it
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from tdm.utils import cache_key, get_cache_dir
+from . import pack
+
+SIGNAL_NAME = "signal.npy"
+MASK_NAME = "mask.npy"
+INDEX_NAME = "index.npy"
+
+DAY_FMT = "%Y-%m-%d"
+
+# An image stored in a cube: path is the path to the cube's directory,
+# index is the position of the image along the time axis
+CubeImage = collections.namedtuple("CubeImage", "path index")
+
+
+def get_source_id(path):
+    if isinstance(path, pack.PackedImage):
+        st = os.stat(path.path)
+        return (path.path, path.offset, path.size, st.st_mtime_ns)
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def get_cube_path(cache_dir, day, dt_path_pairs):
+    key = cache_key(*((dt.isoformat(), get_source_id(p))
+                      for dt, p in dt_path_pairs))
+    return os.path.join(cache_dir, f"{day}-{key}")
+
+
+def build_cube(path, dt_path_pairs, decode):
+    """\
+    Decode the images in dt_path_pairs with decode (which must return a
+    masked uint8 array) and store them as a cube in path.
+    """
+    parent = os.path.dirname(path)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp", dir=parent)
+    try:
+        dts = np.array([dt for dt, _ in dt_path_pairs], dtype="datetime64[s]")
+        np.save(os.path.join(tmp_path, INDEX_NAME), dts)
+        signal = mask = None
+        for i, (_, p) in enumerate(dt_path_pairs):
+            s = decode(p)
+            if signal is None:
+                shape = (len(dt_path_pairs),) + s.shape
+                signal = open_memmap(os.path.join(tmp_path, SIGNAL_NAME),
+                                     mode="w+", dtype=np.uint8, shape=shape)
+                mask = open_memmap(os.path.join(tmp_path, MASK_NAME),
+                                   mode="w+", dtype=np.bool_, shape=shape)
+            signal[i] = np.ma.getdata(s)
+            mask[i] = np.ma.getmaskarray(s)
+        signal.flush()
+        mask.flush()
+        del signal, mask
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # built concurrently by another process
+            if not os.path.isdir(path):
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+@lru_cache(maxsize=4)
+def open_cube(path):
+    """\
+    Return the signal, mask and index arrays of the cube in path. Signal and
+    mask are memory-mapped.
+    """
+    signal = np.load(os.path.join(path, SIGNAL_NAME), mmap_mode="r")
+    mask = np.load(os.path.join(path, MASK_NAME), mmap_mode="r")
+    index = np.load(os.path.join(path, INDEX_NAME))
+    return signal, mask, index
+
+
+def read_image(image):
+    """\
+    Get the signal for a CubeImage, as a masked array view of the cube.
+    """
+    signal, mask, _ = open_cube(image.path)
+    i = image.index
+    return np.ma.masked_array(signal[i], mask=mask[i], copy=False)
+
+
+def cache_images(dt_path_pairs, decode, executor=None):
+    """\
+    Make sure the images in dt_path_pairs (sorted by datetime) are stored in
+    cubes, building any missing ones, and return the corresponding (dt,
+    CubeImage) pairs. If an executor is given, missing cubes are built in
+    parallel. If caching is disabled, return dt_path_pairs unchanged.
+    """
+    cache_dir = get_cache_dir("cube")
+    if cache_dir is None:
+        return dt_path_pairs
+    days = [(day, list(g)) for day, g in it.groupby(
+        dt_path_pairs, lambda _: _[0].strftime(DAY_FMT)
+    )]
+    cube_paths = [get_cube_path(cache_dir, day, g) for day, g in days]
+    missing = [(p, g) for p, (_, g) in zip(cube_paths, days)
+               if not os.path.isdir(p)]
+    if executor is None:
+        for p, g in missing:
+            build_cube(p, g, decode)
+    else:
+        fs = [executor.submit(build_cube, p, g, decode) for p, g in missing]
+        for f in fs:
+            f.result()
+    rval = []
+    for p, (_, g) in zip(cube_paths, days):
+        rval.extend((dt, CubeImage(p, i)) for i, (dt, _) in enumerate(g))
+    return rval
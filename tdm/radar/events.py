@@ -34,22 +34,110 @@ EVENT_THRESHOLD = 200
 MIN_EVENT_LEN = 24 * 60 * 60
 
 
+def _seconds(x):
+    return x.total_seconds() if isinstance(x, timedelta) else x
+
+
+def split_bounds(dts, min_len=MIN_EVENT_LEN, threshold=EVENT_THRESHOLD):
+    """\
+    Split a sorted datetime64 array into "events".
+
+    Returns an (n_events, 2) integer array of [begin, end) index ranges,
+    so that dts[begin:end] are the time points of each event.
+    """
+    dts = np.asarray(dts)
+    if not np.issubdtype(dts.dtype, np.datetime64):
+        dts = dts.astype("datetime64[us]")
+    min_len, threshold = _seconds(min_len), _seconds(threshold)
+    N = dts.size
+    if N == 0:
+        return np.empty((0, 2), dtype=np.intp)
+    one_sec = np.timedelta64(1, "s")
+    deltas = np.diff(dts) / one_sec
+    big_delta_idx = np.flatnonzero(deltas > threshold)
+    begin = np.insert(1 + big_delta_idx, 0, 0)
+    end = np.append(1 + big_delta_idx, N)
+    keep = (dts[end - 1] - dts[begin]) / one_sec >= min_len
+    return np.column_stack((begin[keep], end[keep]))
+
+
 def split(dt_path_pairs, min_len=MIN_EVENT_LEN, threshold=EVENT_THRESHOLD):
     """\
     Split a sequence of (datetime, path) pairs into "events".
     """
-    if not isinstance(min_len, timedelta):
-        min_len = timedelta(seconds=min_len)
-    p, N = dt_path_pairs, len(dt_path_pairs)
-    if N == 0:
-        return
-    deltas = np.array([(p[i+1][0] - p[i][0]).total_seconds()
-                       for i in range(N - 1)])
-    big_delta_idx = np.argwhere(deltas > threshold)[:, 0]
-    dts_idx = np.insert(1 + big_delta_idx, 0, 0)
-    dts_idx = np.append(dts_idx, N)
-    for i in range(dts_idx.size - 1):
-        b, e = dts_idx[i], dts_idx[i+1]
-        if p[e - 1][0] - p[b][0] < min_len:
-            continue
+    p = dt_path_pairs
+    dts = np.array([_[0] for _ in p], dtype="datetime64[us]")
+    for b, e in split_bounds(dts, min_len=min_len, threshold=threshold):
         yield p[b: e]
+
+
+class EventSplitter(object):
+    """\
+    Incrementally split a time-ordered feed of (datetime, item) pairs into
+    "events", without knowing the whole sequence in advance.
+
+    An event is complete as soon as a gap larger than threshold follows
+    it: this happens either when a later item is added, or when the caller
+    declares, via check, that no item arrived up to a given time.
+    """
+
+    def __init__(self, min_len=MIN_EVENT_LEN, threshold=EVENT_THRESHOLD):
+        if not isinstance(min_len, timedelta):
+            min_len = timedelta(seconds=min_len)
+        if not isinstance(threshold, timedelta):
+            threshold = timedelta(seconds=threshold)
+        self.min_len = min_len
+        self.threshold = threshold
+        self.current = []
+
+    def __close(self):
+        event, self.current = self.current, []
+        if event and event[-1][0] - event[0][0] >= self.min_len:
+            return event
+        return None
+
+    def add(self, dt, item):
+        """\
+        Add an item. Return the event closed by this item, if any.
+        """
+        event = None
+        if self.current:
+            last = self.current[-1][0]
+            if dt < last:
+                raise ValueError(f"{dt} is earlier than {last}")
+            if dt - last > self.threshold:
+                event = self.__close()
+        self.current.append((dt, item))
+        return event
+
+    def check(self, now):
+        """\
+        Close the current event if more than threshold has passed between
+        its last item and now. Return the closed event, if any.
+        """
+        if self.current and now - self.current[-1][0] > self.threshold:
+            return self.__close()
+        return None
+
+    def flush(self):
+        """\
+        Close the current event regardless of time. Return it, if long
+        enough.
+        """
+        return self.__close()
+
+
+def split_stream(dt_item_pairs, min_len=MIN_EVENT_LEN,
+                 threshold=EVENT_THRESHOLD):
+    """\
+    Streaming version of split: consume (datetime, item) pairs lazily,
+    yielding each event (as a list of pairs) as soon as it's complete.
+    """
+    splitter = EventSplitter(min_len=min_len, threshold=threshold)
+    for dt, item in dt_item_pairs:
+        event = splitter.add(dt, item)
+        if event is not None:
+            yield event
+    event = splitter.flush()
+    if event is not None:
+        yield event
@@ -24,5 +24,16 @@ class RainfallWriter(ABC):
         """
         pass
 
+    def write_block(self, start, dts, stack):
+        """\
+        Write consecutive rainfall rate arrays, starting at index start.
+
+        dts is a sequence of datetimes and stack is an array (or sequence of
+        arrays) with one element per datetime. Subclasses that can store
+        multiple time points at once should override this.
+        """
+        for i, (dt, rr) in enumerate(zip(dts, stack)):
+            self.write(start + i, dt, rr)
+
     def close(self):
         pass
@@ -0,0 +1,317 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""\
+Packed radar image archives.
+
+Raw radar images are small (one PNG per minute), so storing each one in its
+own file makes listing, copying and opening them expensive, especially on
+HDFS. A pack stores a sequence of images in a single append-only data file
+(PACK_EXT) with a companion index file (INDEX_EXT) that holds a (timestamp,
+offset, size) record for each image:
+
+  data:   PACK_MAGIC image_0 image_1 ...
+  index:  INDEX_MAGIC record_0 record_1 ...
+
+Timestamps are seconds since the epoch, all fields are little endian 64-bit
+integers. Image data is written before the corresponding index record, so an
+interrupted append leaves at most some unreferenced bytes at the end of the
+data file; index records pointing past the end of the data file are ignored.
+PackWriter removes any such leftovers (including partial index records)
+before appending, so that new records are always consistent with the data.
+"""
+
+from datetime import datetime
+import collections
+import io
+import os
+
+import numpy as np
+
+PACK_EXT = ".tdmpack"
+INDEX_EXT = ".tdmidx"
+PACK_MAGIC = b"TDMPACK1"
+INDEX_MAGIC = b"TDMIDX01"
+INDEX_DTYPE = np.dtype([("ts", "<i8"), ("offset", "<i8"), ("size", "<i8")])
+
+# name format for per-day packs
+DAY_FMT = "%Y-%m-%d"
+
+MIN_DT, MAX_DT = datetime.min, datetime.max
+
+# An image stored in a pack: path is the path to the pack's data file
+PackedImage = collections.namedtuple("PackedImage", "path offset size dt")
+
+
+def get_index_path(path):
+    return os.path.splitext(path)[0] + INDEX_EXT
+
+
+def is_pack(path):
+    return os.path.splitext(path)[1] == PACK_EXT
+
+
+def parse_index(buf, data_size=None):
+    """\
+    Parse the contents of an index file. If data_size (the size of the data
+    file) is given, drop records that point past the end of the data.
+    Returns a structured array of INDEX_DTYPE records, sorted by timestamp.
+    """
+    buf = memoryview(buf)
+    if buf[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError("not a tdm pack index")
+    buf = buf[len(INDEX_MAGIC):]
+    n = len(buf) // INDEX_DTYPE.itemsize
+    index = np.frombuffer(buf[:n * INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+    if data_size is not None:
+        index = index[index["offset"] + index["size"] <= data_size]
+    return np.sort(index, order="ts", kind="stable")
+
+
+def read_index(path):
+    """\
+    Read the index of the pack whose data file is path.
+    """
+    with io.open(get_index_path(path), "rb") as f:
+        buf = f.read()
+    return parse_index(buf, data_size=os.stat(path).st_size)
+
+
+def get_members(path, index, after=MIN_DT, before=MAX_DT):
+    """\
+    Convert index records to sorted (datetime, PackedImage) pairs for all
+    images whose timestamp is in the [after, before] interval.
+    """
+    dts = index["ts"].astype("datetime64[s]")
+    selected = (dts >= np.datetime64(after)) & (dts <= np.datetime64(before))
+    return [(dt, PackedImage(path, offset, size, dt))
+            for dt, offset, size in zip(dts[selected].tolist(),
+                                        index["offset"][selected].tolist(),
+                                        index["size"][selected].tolist())]
+
+
+def find_packs(root):
+    """\
+    Return the sorted paths of all packs in root. If root is itself a pack,
+    return a list containing only root.
+    """
+    if is_pack(root) and os.path.isfile(root):
+        return [root]
+    return sorted(e.path for e in os.scandir(root)
+                  if is_pack(e.name) and not e.is_dir())
+
+
+def get_images(root, after=MIN_DT, before=MAX_DT):
+    """\
+    Same as tdm.radar.utils.get_images, but for packed images: return sorted
+    (datetime, PackedImage) pairs for all images in the packs found in root
+    (or in root itself, if it's a pack).
+    """
+    return get_packed_images(find_packs(root), after, before)
+
+
+def get_packed_images(paths, after=MIN_DT, before=MAX_DT):
+    """\
+    Return sorted (datetime, PackedImage) pairs for all images in the packs
+    at paths whose timestamp is in the [after, before] interval.
+    """
+    ls = []
+    for path in paths:
+        ls.extend(get_members(path, read_index(path), after, before))
+    ls.sort(key=lambda _: _[0])
+    return ls
+
+
+def read_image(image):
+    """\
+    Read the raw (encoded) data of a PackedImage.
+    """
+    with io.open(image.path, "rb") as f:
+        f.seek(image.offset)
+        return f.read(image.size)
+
+
+def open_image(path):
+    """\
+    Open an image, either a regular file or a PackedImage, for reading.
+    """
+    if isinstance(path, PackedImage):
+        return io.BytesIO(read_image(path))
+    return io.open(path, "rb")
+
+
+def get_image_size(path):
+    if isinstance(path, PackedImage):
+        return path.size
+    return os.stat(path).st_size
+
+
+def read_range(f, images):
+    """\
+    Read the data for a run of images stored contiguously in the pack open
+    as f, with a single seek and read. Return a list of bytes objects.
+    """
+    if not images:
+        return []
+    start = images[0].offset
+    end = images[-1].offset + images[-1].size
+    f.seek(start)
+    buf = f.read(end - start)
+    return [buf[_.offset - start: _.offset - start + _.size] for _ in images]
+
+
+class PackWriter(object):
+    """\
+    Append images to a pack, creating it if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = io.open(path, "ab")
+        self.index = io.open(get_index_path(path), "ab")
+        try:
+            if self.index.tell() == 0:
+                self.index.write(INDEX_MAGIC)
+                self.data.truncate(0)
+            else:
+                self.__recover()
+            if self.data.tell() == 0:
+                self.data.write(PACK_MAGIC)
+        except BaseException:
+            self.close()
+            raise
+        self.offset = self.data.tell()
+
+    def __recover(self):
+        """\
+        Drop partial index records, records that point past the end of the
+        data file and data not referenced by any record, all of which can
+        be left over by an interrupted append.
+        """
+        self.index.flush()
+        with io.open(self.index.name, "rb") as f:
+            buf = f.read()
+        index = parse_index(buf, data_size=self.data.tell())
+        n = (len(buf) - len(INDEX_MAGIC)) // INDEX_DTYPE.itemsize
+        if index.size < n:
+            self.index.truncate(len(INDEX_MAGIC))
+            self.index.write(index.tobytes())
+        else:
+            self.index.truncate(len(INDEX_MAGIC) + n * INDEX_DTYPE.itemsize)
+        self.index.seek(0, io.SEEK_END)
+        end = 0
+        if index.size:
+            end = int((index["offset"] + index["size"]).max())
+        self.data.truncate(end)
+        self.data.seek(0, io.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __append(self, dt, data):
+        ts = int(np.datetime64(dt, "s").astype(np.int64))
+        self.data.write(data)
+        rec = np.array([(ts, self.offset, len(data))], dtype=INDEX_DTYPE)
+        self.offset += len(data)
+        return rec
+
+    def add(self, dt, data):
+        return self.add_many([(dt, data)])
+
+    def add_many(self, dt_data_pairs):
+        """\
+        Add (datetime, data) pairs, writing the index records only after
+        all data has been written. Returns the number of images added.
+        """
+        recs = [self.__append(dt, data) for dt, data in dt_data_pairs]
+        self.data.flush()
+        if recs:
+            self.index.write(np.concatenate(recs).tobytes())
+            self.index.flush()
+        return len(recs)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+def _read_all(path):
+    with open_image(path) as f:
+        return f.read()
+
+
+def get_pack_name(dt):
+    return f"{dt.strftime(DAY_FMT)}{PACK_EXT}"
+
+
+def pack_images(dt_path_pairs, out_dir, get_name=get_pack_name,
+                batch_size=256):
+    """\
+    Append the images in dt_path_pairs to packs in out_dir. The pack each
+    image goes to is determined by get_name(dt), by default one pack per
+    day. Images whose timestamp is already in the target pack are skipped.
+    Returns the number of images added.
+    """
+    by_pack = collections.OrderedDict()
+    for dt, path in dt_path_pairs:
+        by_pack.setdefault(get_name(dt), []).append((dt, path))
+    n_added = 0
+    for name, pairs in by_pack.items():
+        path = os.path.join(out_dir, name)
+        try:
+            known = set(read_index(path)["ts"].tolist())
+        except FileNotFoundError:
+            known = set()
+        pairs = [(dt, p) for dt, p in pairs
+                 if int(np.datetime64(dt, "s").astype(np.int64)) not in known]
+        if not pairs:
+            continue
+        with PackWriter(path) as writer:
+            for i in range(0, len(pairs), batch_size):
+                batch = pairs[i: i + batch_size]
+                n_added += writer.add_many(
+                    (dt, _read_all(p)) for dt, p in batch
+                )
+    return n_added
+
+
+def extract(image, dst, skip_existing=True):
+    """\
+    Write the data of a PackedImage to dst. Behaves like tdm.utils.copy_file
+    with respect to skip_existing and the return value.
+    """
+    if os.path.lexists(dst):
+        if (skip_existing and os.path.exists(dst) and
+                os.path.getsize(dst) == image.size):
+            return False
+        os.unlink(dst)
+    data = read_image(image)
+    with io.open(dst, "wb") as f:
+        f.write(data)
+    return True
+
+
+def unpack(path, out_dir, fmt, ext=".png", after=MIN_DT, before=MAX_DT):
+    """\
+    Extract the images in the pack at path to out_dir, naming each one
+    after its timestamp, formatted according to fmt, plus ext. Files that
+    already exist with the right size are skipped. Returns the number of
+    images extracted.
+    """
+    members = get_members(path, read_index(path), after, before)
+    return sum(extract(image, os.path.join(out_dir, dt.strftime(fmt) + ext))
+               for dt, image in members)
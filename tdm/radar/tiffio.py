@@ -30,11 +30,13 @@ DT_FMT = "%Y-%m-%d %H:%M:%S"
 
 class GTiffWriter(RainfallWriter):
 
-    def __init__(self, out_dir, ga):
+    def __init__(self, out_dir, ga, profile=None):
         self.out_dir = out_dir
         self.ga = ga
+        self.profile = profile
 
     def write(self, i, dt, rr):
         path = join(self.out_dir, f"{dt.strftime(ORIG_FMT)}.tif")
         metadata = {DT_TAG: dt.strftime(DT_FMT)}
-        self.ga.save_as_gtiff(path, rr, metadata=metadata)
+        self.ga.save_as_gtiff(path, rr, metadata=metadata,
+                              profile=self.profile)
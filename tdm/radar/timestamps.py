@@ -0,0 +1,166 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""\
+Fast parsing of fixed-width timestamps, such as the ones found in radar
+image names.
+
+Only formats consisting of %Y, %m, %d, %H, %M, %S directives and literal
+characters are supported. Parsers are compiled once per format and produce
+the same results as datetime.strptime on strings where all fields are
+zero-padded to their full width (other strings are rejected).
+"""
+
+from datetime import datetime
+from functools import lru_cache
+import re
+
+import numpy as np
+
+# directive -> (field name, width)
+DIRECTIVES = {
+    "Y": ("year", 4),
+    "m": ("month", 2),
+    "d": ("day", 2),
+    "H": ("hour", 2),
+    "M": ("minute", 2),
+    "S": ("second", 2),
+}
+FIELD_NAMES = "year", "month", "day", "hour", "minute", "second"
+# same as datetime.strptime
+DEFAULTS = {"year": 1900, "month": 1, "day": 1,
+            "hour": 0, "minute": 0, "second": 0}
+# inclusive bounds, day validity is checked separately
+BOUNDS = {"year": (1, 9999), "month": (1, 12), "day": (1, 31),
+          "hour": (0, 23), "minute": (0, 59), "second": (0, 59)}
+
+
+@lru_cache(maxsize=None)
+def compile_format(fmt):
+    """\
+    Return (length, fields, literals) for fmt, where fields is a tuple of
+    (name, start, stop) triples and literals is a tuple of (pos, char) pairs.
+    """
+    fields, literals = [], []
+    pos, i = 0, 0
+    while i < len(fmt):
+        c = fmt[i]
+        if c == "%":
+            try:
+                code = fmt[i + 1]
+            except IndexError:
+                raise ValueError(f"{fmt!r}: stray %% at end of format")
+            if code == "%":
+                literals.append((pos, "%"))
+                pos += 1
+            else:
+                try:
+                    name, width = DIRECTIVES[code]
+                except KeyError:
+                    raise ValueError(f"{fmt!r}: unsupported directive %{code}")
+                fields.append((name, pos, pos + width))
+                pos += width
+            i += 2
+        else:
+            literals.append((pos, c))
+            pos += 1
+            i += 1
+    names = [_[0] for _ in fields]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{fmt!r}: repeated directive")
+    return pos, tuple(fields), tuple(literals)
+
+
+@lru_cache(maxsize=None)
+def make_parser(fmt):
+    """\
+    Return a function that converts a string to a datetime according to fmt,
+    raising ValueError if the string does not match.
+
+    >>> parse = make_parser("%Y-%m-%d_%H:%M:%S")
+    >>> parse("2018-05-01_23:00:04")
+    datetime.datetime(2018, 5, 1, 23, 0, 4)
+    """
+    length, fields, literals = compile_format(fmt)
+    lit = dict(literals)
+    parts = []
+    field_iter = iter(fields)
+    field = next(field_iter, None)
+    pos = 0
+    while pos < length:
+        if field is not None and field[1] == pos:
+            parts.append(r"(\d{%d})" % (field[2] - field[1]))
+            pos = field[2]
+            field = next(field_iter, None)
+        else:
+            parts.append(re.escape(lit[pos]))
+            pos += 1
+    match = re.compile("".join(parts), re.ASCII).fullmatch
+    names = [_[0] for _ in fields]
+    defaults = {k: v for k, v in DEFAULTS.items() if k not in names}
+
+    def parse(s):
+        m = match(s)
+        if m is None:
+            raise ValueError(f"time data {s!r} does not match format {fmt!r}")
+        kwargs = dict(zip(names, map(int, m.groups())), **defaults)
+        return datetime(**kwargs)
+
+    def parse_all_fields(s):
+        m = match(s)
+        if m is None:
+            raise ValueError(f"time data {s!r} does not match format {fmt!r}")
+        return datetime(*map(int, m.groups()))
+
+    return parse_all_fields if tuple(names) == FIELD_NAMES else parse
+
+
+def parse_array(strings, fmt):
+    """\
+    Convert a sequence of strings to a datetime64[s] array according to fmt.
+
+    Strings that do not match fmt (or that represent invalid dates) are
+    converted to NaT.
+    """
+    length, fields, literals = compile_format(fmt)
+    a = np.asarray(strings, dtype=np.str_).ravel()
+    n = a.size
+    rval = np.full(n, np.datetime64("NaT"), dtype="datetime64[s]")
+    width = a.dtype.itemsize // 4
+    if n == 0 or width < length:
+        return rval
+    codes = a.view(np.uint32).reshape(n, width)
+    valid = np.char.str_len(a) == length
+    for pos, c in literals:
+        valid &= codes[:, pos] == ord(c)
+    digits = codes[:, :length].astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    values = dict(DEFAULTS)
+    for name, start, stop in fields:
+        valid &= is_digit[:, start:stop].all(axis=1)
+        weights = 10 ** np.arange(stop - start - 1, -1, -1)
+        v = digits[:, start:stop] @ weights
+        lo, hi = BOUNDS[name]
+        valid &= (v >= lo) & (v <= hi)
+        values[name] = v
+    v = {k: np.where(valid, values[k], DEFAULTS[k]) for k in FIELD_NAMES}
+    months = (v["year"] - 1970) * 12 + v["month"] - 1
+    month_start = months.astype("datetime64[M]")
+    days = month_start.astype("datetime64[D]") + (v["day"] - 1)
+    valid &= days.astype("datetime64[M]") == month_start
+    secs = (days.astype("datetime64[s]") +
+            (3600 * v["hour"] + 60 * v["minute"] + v["second"]))
+    rval[valid] = secs[valid]
+    return rval
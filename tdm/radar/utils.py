@@ -13,22 +13,27 @@
 # limitations under the License.
 
 from datetime import datetime, timedelta
-from itertools import product
+from functools import lru_cache
 import itertools as it
 import os
+import tempfile
+import uuid
 import numpy as np
 
 import gdal
 from gdal import osr
 import imageio
 
+from tdm.utils import cache_key, get_cache_dir
+from . import catalog, cube, pack, timestamps
+
 gdal.UseExceptions()
 
-strptime = datetime.strptime
 splitext = os.path.splitext
 
 FMT = "%Y-%m-%d_%H:%M:%S"
 FMT_LEN = 4 + 5 * 3  # %Y is 4 chars, other fields are 2 chars
+parse_dt = timestamps.make_parser(FMT)
 MIN_DT, MAX_DT = datetime.min, datetime.max
 
 RAINFALL_FILL_VALUE = -1.0
@@ -39,6 +44,9 @@ A_PARAM, B_PARAM = 100, 1.5
 
 TIFF_EXT = frozenset((".tif", ".tiff"))
 
+# max number of points per TransformPoints call in get_lat_lon
+TRANSFORM_CHUNK_SIZE = 1 << 20
+
 
 class GeoAdapter(object):
 
@@ -55,8 +63,38 @@ class GeoAdapter(object):
         self.oX, self.oY = oX, oY
         self.pxlW, self.pxlH = factor * pxlW, factor * pxlH
 
-    def save_as_gtiff(self, fname, data, metadata=None):
-        raster = gdal.GetDriverByName('GTiff').Create(
+    def save_as_gtiff(self, fname, data, metadata=None, profile=None):
+        """\
+        Save data to fname as a GeoTIFF. If profile (a
+        tdm.geotiff.OutputProfile) is provided, the raster is built in
+        memory and written according to the profile.
+        """
+        if profile is None:
+            self.build_raster(data, metadata=metadata, fname=fname,
+                              driver_name="GTiff")
+        else:
+            profile.save(fname, self.build_raster(data, metadata=metadata))
+
+    def to_gtiff_bytes(self, data, metadata=None, profile=None):
+        """\
+        Same as save_as_gtiff, but render to an in-memory (/vsimem/) file
+        and return its contents, without touching the local disk.
+        """
+        fname = "/vsimem/%s.tif" % uuid.uuid4().hex
+        try:
+            self.save_as_gtiff(fname, data, metadata=metadata,
+                               profile=profile)
+            size = gdal.VSIStatL(fname).size
+            f = gdal.VSIFOpenL(fname, "rb")
+            try:
+                return gdal.VSIFReadL(1, size, f)
+            finally:
+                gdal.VSIFCloseL(f)
+        finally:
+            gdal.Unlink(fname)
+
+    def build_raster(self, data, metadata=None, fname="", driver_name="MEM"):
+        raster = gdal.GetDriverByName(driver_name).Create(
             fname, self.cols, self.rows, 1, gdal.GDT_Float32
         )
         band = raster.GetRasterBand(1)
@@ -70,6 +108,7 @@ class GeoAdapter(object):
         raster.SetProjection(self.wkt)
         if isinstance(metadata, dict):
             raster.SetMetadata(metadata)
+        return raster
 
     def compute_distance_field(self):
         x = self.pxlW * (np.arange(-(self.cols/2), (self.cols/2), 1) + 0.5)
@@ -83,8 +122,76 @@ class GeoAdapter(object):
     def ypos(self):
         return self.oY + self.pxlH * np.arange(self.rows)
 
+    def get_lat_lon(self):
+        """\
+        Same as get_lat_lon(self.sr, self.xpos(), self.ypos()), but cache
+        the result on disk (see tdm.utils.get_cache_dir).
+        """
+        cache_dir = get_cache_dir("latlon")
+        if cache_dir is None:
+            return get_lat_lon(self.sr, self.xpos(), self.ypos())
+        key = cache_key(self.wkt, self.oX, self.pxlW, self.oY, self.pxlH,
+                        self.cols, self.rows)
+        path = os.path.join(cache_dir, f"{key}.npz")
+        try:
+            with np.load(path) as cached:
+                return cached["lat"], cached["lon"]
+        except (OSError, KeyError, ValueError):
+            pass
+        lat, lon = get_lat_lon(self.sr, self.xpos(), self.ypos())
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, lat=lat, lon=lon)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return lat, lon
+
 
-def get_images(root, after=MIN_DT, before=MAX_DT):
+def parse_image_name(name):
+    """\
+    Get the datetime from a raw PNG radar image name, or None if the name
+    does not match the pattern described in get_images.
+    """
+    try:
+        return parse_dt(splitext(name)[0][-FMT_LEN:])
+    except ValueError:
+        return None
+
+
+def parse_image_names(names):
+    """\
+    Vectorized version of parse_image_name: return a datetime64[s] array,
+    with NaT for names that do not match.
+    """
+    return timestamps.parse_array(
+        [splitext(_)[0][-FMT_LEN:] for _ in names], FMT
+    )
+
+
+def scan_images(root, after=MIN_DT, before=MAX_DT):
+    """\
+    Same as get_images, but always scan the directory.
+    """
+    names, paths = [], []
+    for entry in os.scandir(root):
+        if entry.is_dir():
+            continue
+        names.append(entry.name)
+        paths.append(entry.path)
+    dts = parse_image_names(names)
+    selected = (~np.isnat(dts) &
+                (dts >= np.datetime64(after)) &
+                (dts <= np.datetime64(before)))
+    ls = list(zip(dts[selected].tolist(), it.compress(paths, selected)))
+    ls.sort()
+    return ls
+
+
+def get_images(root, after=MIN_DT, before=MAX_DT, use_catalog=True,
+               include_packs=False):
     """\
     Get the file names of raw PNG radar images. The pattern seen so far is:
 
@@ -93,20 +200,38 @@ def get_images(root, after=MIN_DT, before=MAX_DT):
     Assumes that the basename, after removing the '.png' extension, ends with
     the formatted datetime, allowing for any combination of characters before
     that. Returns (datetime, path) pairs, ignoring names that do not match.
+
+    If use_catalog is true, names are looked up in a persistent catalog that
+    is only updated when the directory changes (see tdm.radar.catalog).
+
+    If include_packs is true, images stored in packs (see tdm.radar.pack)
+    found in root are also included, as (datetime, PackedImage) pairs: these
+    must be read with get_image_data (or extracted with pack.extract). Loose
+    images take precedence over packed ones with the same timestamp. root can
+    also be a pack, in which case only its images are returned.
     """
-    ls = []
-    for entry in os.scandir(root):
-        if entry.is_dir():
-            continue
-        dt_string = splitext(entry.name)[0][-FMT_LEN:]
-        try:
-            dt = strptime(dt_string, FMT)
-        except ValueError:
-            continue
-        if dt < after or dt > before:
-            continue
-        ls.append((dt, entry.path))
-    ls.sort()
+    if pack.is_pack(root):
+        return pack.get_images(root, after=after, before=before)
+    packs = []
+    if use_catalog:
+        cat = catalog.open_catalog(root, parse_image_names)
+        if cat is not None:
+            with cat:
+                ls = cat.query(after, before)
+                if include_packs:
+                    packs = cat.find(pack.PACK_EXT)
+        else:
+            use_catalog = False
+    if not use_catalog:
+        ls = scan_images(root, after=after, before=before)
+        if include_packs:
+            packs = pack.find_packs(root)
+    if not packs:
+        return ls
+    loose_dts = {dt for dt, _ in ls}
+    packed = pack.get_packed_images(packs, after=after, before=before)
+    ls.extend(_ for _ in packed if _[0] not in loose_dts)
+    ls.sort(key=lambda _: _[0])
     return ls
 
 
@@ -120,29 +245,116 @@ def group_images(dt_path_pairs, delta, after=MIN_DT):
     return it.groupby(dt_path_pairs, grouper)
 
 
-def get_grouped_images(root, delta, after=MIN_DT, before=MAX_DT):
-    pairs = get_images(root, after=after, before=before)
+def get_grouped_images(root, delta, after=MIN_DT, before=MAX_DT,
+                       include_packs=False):
+    pairs = get_images(root, after=after, before=before,
+                       include_packs=include_packs)
     return group_images(pairs, delta, after=after)
 
 
 def get_image_data(path):
+    """\
+    Read a raw PNG radar image, which can also be a PackedImage or a
+    CubeImage (see cache_images), and return its signal as a masked array.
+    """
+    if isinstance(path, cube.CubeImage):
+        return cube.read_image(path)
+    if isinstance(path, pack.PackedImage):
+        path = pack.read_image(path)
     im = imageio.imread(path)
     signal = im[:, :, 0].view(np.ma.MaskedArray)
     signal.mask = im[:, :, 3] != 255
     return signal
 
 
+def cache_images(dt_path_pairs, executor=None):
+    """\
+    Store the decoded signal for the given images in memory-mapped cubes
+    (see tdm.radar.cube) and return (dt, CubeImage) pairs that can be
+    passed to get_image_data in place of the original ones.
+    """
+    return cube.cache_images(dt_path_pairs, get_image_data, executor=executor)
+
+
+def _zr(signal, a, b):
+    Z = 10**(0.1*(0.39216 * signal - 8.6))
+    return (Z/a)**(1/b)
+
+
+@lru_cache(maxsize=None)
+def get_rainfall_lut(a=A_PARAM, b=B_PARAM):
+    """\
+    Rainfall rate for each of the 256 possible 8-bit signal values.
+
+    The returned array is read-only, since it's shared by all callers that
+    use the same (a, b) parameters.
+    """
+    lut = _zr(np.arange(256, dtype=np.float64), a, b)
+    lut.setflags(write=False)
+    return lut
+
+
 def estimate_rainfall(masked_signal, a=A_PARAM, b=B_PARAM):
-    Z = 10**(0.1*(0.39216 * masked_signal - 8.6))
-    rf = (Z/a)**(1/b)
+    if masked_signal.dtype == np.uint8:
+        lut = get_rainfall_lut(a, b)
+        rf = np.ma.masked_array(lut.take(np.ma.getdata(masked_signal)),
+                                mask=np.ma.getmaskarray(masked_signal).copy())
+    else:
+        rf = _zr(masked_signal, a, b)
     rf.set_fill_value(RAINFALL_FILL_VALUE)
     return rf
 
 
+class RainfallAccumulator(object):
+    """\
+    Running masked mean of rainfall rate arrays.
+
+    Only the sum of valid values and the number of valid values seen so far
+    are kept for each pixel, so memory usage does not depend on the number
+    of arrays being averaged.
+    """
+
+    def __init__(self):
+        self.sum = None
+        self.count = None
+
+    def add(self, rf):
+        valid = ~np.ma.getmaskarray(rf)
+        if self.sum is None:
+            self.sum = np.zeros(rf.shape, dtype=np.float32)
+            self.count = np.zeros(rf.shape, dtype=np.float32)
+        np.add(self.sum, np.ma.getdata(rf), out=self.sum, where=valid)
+        self.count += valid
+
+    def mean(self):
+        if self.sum is None:
+            raise ValueError("no data to average")
+        valid = self.count > 0
+        avg = np.full(self.sum.shape, RAINFALL_FILL_VALUE, dtype=np.float32)
+        np.divide(self.sum, self.count, out=avg, where=valid)
+        return np.ma.masked_array(avg, mask=~valid,
+                                  fill_value=RAINFALL_FILL_VALUE)
+
+
 def avg_rainfall(groups):
+    """\
+    For each (dt, dt_path_pairs) group, yield dt and the average rainfall
+    rate over the group's images. Groups can be lazy iterators, such as the
+    ones returned by group_images.
+    """
+    return avg_rr((dt, ((_, estimate_rainfall(get_image_data(p)))
+                        for _, p in g)) for dt, g in groups)
+
+
+def avg_rr(groups):
+    """\
+    Same as avg_rainfall, but groups contain (dt, rainfall_rate) pairs.
+    """
     for dt, g in groups:
-        buf = [estimate_rainfall(get_image_data(path)) for _, path in g]
-        yield dt, np.ma.mean(buf, axis=0)
+        acc = RainfallAccumulator()
+        for _, rr in g:
+            acc.add(rr)
+        yield dt, acc.mean()
 
 
 def band_to_ma(band):
@@ -161,6 +373,56 @@ def band_to_ma(band):
     return np.ma.masked_array(band.ReadAsArray(), **kwargs)
 
 
+def _transform_grid(transform, xpos, ypos):
+    """\
+    Transform all (xpos[j], ypos[i]) points, feeding TransformPoints with
+    chunks of at most TRANSFORM_CHUNK_SIZE points. Return (lat, lon) arrays
+    of shape (len(ypos), len(xpos)).
+    """
+    nx, ny = len(xpos), len(ypos)
+    lat = np.empty((ny, nx), dtype=np.float32)
+    lon = np.empty((ny, nx), dtype=np.float32)
+    step = max(1, TRANSFORM_CHUNK_SIZE // nx)
+    for start in range(0, ny, step):
+        stop = min(start + step, ny)
+        pts = np.empty((stop - start, nx, 2), dtype=np.float64)
+        pts[..., 0] = xpos
+        pts[..., 1] = ypos[start:stop, None]
+        out = np.array(transform.TransformPoints(pts.reshape(-1, 2)))
+        lon[start:stop] = out[:, 0].reshape(-1, nx)
+        lat[start:stop] = out[:, 1].reshape(-1, nx)
+    return lat, lon
+
+
+def _transform_separable(transform, xpos, ypos, n_checks=16, tol=1e-9):
+    """\
+    If the transformation is separable (i.e., lon only depends on x and lat
+    only depends on y, as in unrotated cylindrical projections), return
+    (lat, lon) grids computed by transforming only the first row and column.
+    Otherwise, return None. Separability is checked on a diagonal sample.
+    """
+    x0, y0 = xpos[0], ypos[0]
+    row = np.array(transform.TransformPoints([(x, y0) for x in xpos]))
+    col = np.array(transform.TransformPoints([(x0, y) for y in ypos]))
+    if np.ptp(row[:, 1]) > tol or np.ptp(col[:, 0]) > tol:
+        return None
+    lon_x, lat_y = row[:, 0], col[:, 1]
+    n = min(n_checks, len(xpos), len(ypos))
+    i = np.linspace(0, len(ypos) - 1, n).astype(int)
+    j = np.linspace(0, len(xpos) - 1, n).astype(int)
+    sample = np.array(transform.TransformPoints(
+        [(xpos[b], ypos[a]) for a, b in zip(i, j)]
+    ))
+    if not (np.allclose(sample[:, 0], lon_x[j], rtol=0, atol=tol) and
+            np.allclose(sample[:, 1], lat_y[i], rtol=0, atol=tol)):
+        return None
+    lat = np.empty((len(ypos), len(xpos)), dtype=np.float32)
+    lon = np.empty_like(lat)
+    lat[...] = lat_y[:, None]
+    lon[...] = lon_x
+    return lat, lon
+
+
 def get_lat_lon(source_sr, xpos, ypos):
     """\
     Convert (x, y) points from source_sr to EPSG 4326.
@@ -172,10 +434,12 @@ def get_lat_lon(source_sr, xpos, ypos):
     target_sr = osr.SpatialReference()
     target_sr.ImportFromEPSG(4326)
     transform = osr.CoordinateTransformation(source_sr, target_sr)
-    lon, lat, _ = zip(*transform.TransformPoints(list(product(xpos, ypos))))
-    lon = np.array(lon).reshape(len(xpos), len(ypos)).T
-    lat = np.array(lat).reshape(len(xpos), len(ypos)).T
-    return lat, lon
+    xpos = np.asarray(xpos, dtype=np.float64)
+    ypos = np.asarray(ypos, dtype=np.float64)
+    rval = _transform_separable(transform, xpos, ypos)
+    if rval is None:
+        rval = _transform_grid(transform, xpos, ypos)
+    return rval
 
 
 def scan_gtiffs(gtiff_img_dir):
@@ -186,6 +450,6 @@ def scan_gtiffs(gtiff_img_dir):
         head, ext = splitext(e.name)
         if ext.lower() not in TIFF_EXT:
             continue
-        dt = strptime(head, FMT)
+        dt = parse_dt(head)
         rval[dt] = e.path
     return rval
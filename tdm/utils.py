@@ -15,7 +15,27 @@
 # The balanced partitioning functions have been copied verbatim from
 # https://github.com/crs4/pydoop-examples (should probably be added to Pydoop)
 
+import bisect
+import collections
+import errno
+import fcntl
+import hashlib
 import itertools
+import os
+import shutil
+
+CACHE_DIR_ENV = "TDM_CACHE_DIR"
+
+LINK_MODES = "copy", "hardlink", "symlink", "reflink"
+COPY_BUFSIZE = 1024 * 1024
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# errors meaning "can't do this here", for which we fall back to copying
+FALLBACK_ERRNOS = frozenset((
+    errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.EBADF,
+))
 
 
 def balanced_parts(L, N):
@@ -54,3 +74,171 @@ def balanced_split(seq, N):
     """
     for offset, length in balanced_chunks(len(seq), N):
         yield seq[offset: offset + length]
+
+
+def size_balanced_split(seq, sizes, N=None, target_size=None):
+    """\
+    Partition seq into contiguous groups with approximately the same total
+    size, where sizes[i] is the size of seq[i]. The number of groups is
+    either N or, if target_size is given instead, the number of groups of
+    approximately target_size needed to cover the total size. Order is
+    preserved and no group is empty.
+
+    Returns an iterator through the groups.
+
+    >>> list(size_balanced_split("abcdef", [4, 1, 1, 1, 1, 4], N=3))
+    ['a', 'bcde', 'f']
+    >>> list(size_balanced_split("abcdef", [4, 1, 1, 1, 1, 4], target_size=6))
+    ['abc', 'def']
+    """
+    L = len(seq)
+    if len(sizes) != L:
+        raise ValueError("seq and sizes must have the same length")
+    cum = list(itertools.accumulate(sizes))
+    total = cum[-1] if cum else 0
+    if (N is None) == (target_size is None):
+        raise ValueError("exactly one of N and target_size must be set")
+    if target_size is not None:
+        if target_size <= 0:
+            raise ValueError("target size must be positive")
+        N = max(1, min(L, -(-total // target_size)))
+    if not (1 <= N <= L):
+        raise ValueError("number of partitions must be between 1 and %d" % L)
+    cuts = [0]
+    for k in range(1, N):
+        t = total * k / N
+        i = bisect.bisect_left(cum, t)
+        # cut before i + 1 (prefix sum cum[i]) or before i (cum[i - 1])
+        c = i + 1
+        if i > 0 and t - cum[i - 1] <= cum[min(i, L - 1)] - t:
+            c = i
+        c = max(cuts[-1] + 1, min(c, L - (N - k)))
+        cuts.append(c)
+    cuts.append(L)
+    for b, e in zip(cuts, cuts[1:]):
+        yield seq[b: e]
+
+
+def ordered_map(executor, func, iterable, max_pending):
+    """\
+    Like executor.map, but consume iterable lazily, keeping at most
+    max_pending tasks in flight. Results are yielded in input order.
+    """
+    if max_pending < 1:
+        raise ValueError("max_pending must be at least 1")
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def get_cache_dir(subdir=None):
+    """\
+    Get (and create, if necessary) the directory where tdm caches data that
+    is expensive to compute and can be reused across runs. The location can
+    be set via the TDM_CACHE_DIR environment variable: setting it to an empty
+    string disables caching, in which case this function returns None.
+    """
+    root = os.environ.get(CACHE_DIR_ENV)
+    if root is None:
+        xdg_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        root = os.path.join(xdg_root, "tdm")
+    if not root:
+        return None
+    d = os.path.join(root, subdir) if subdir else root
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def cache_key(*parts):
+    """\
+    Compute a cache key from the string representation of parts.
+
+    >>> cache_key("foo", 1.5) == cache_key("foo", 1.5)
+    True
+    """
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(repr(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _copy_fd(fdi, fdo, size):
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    offset = 0
+    for func in copy_file_range, sendfile:
+        if func is None:
+            continue
+        try:
+            while offset < size:
+                if func is sendfile:
+                    n = func(fdo, fdi, offset, COPY_BUFSIZE)
+                else:
+                    n = func(fdi, fdo, COPY_BUFSIZE, offset_src=offset)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    # plain read/write loop, resuming from where the above left off
+    os.lseek(fdi, offset, os.SEEK_SET)
+    os.lseek(fdo, offset, os.SEEK_SET)
+    with open(fdi, "rb", closefd=False) as fi:
+        with open(fdo, "wb", closefd=False) as fo:
+            shutil.copyfileobj(fi, fo, COPY_BUFSIZE)
+    return size
+
+
+def _copy(src, dst, reflink=False):
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        if reflink:
+            try:
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+                return
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRNOS:
+                    raise
+        _copy_fd(fi.fileno(), fo.fileno(), os.fstat(fi.fileno()).st_size)
+
+
+def copy_file(src, dst, mode="copy", skip_existing=True):
+    """\
+    Copy (or link, depending on mode) src to dst.
+
+    Modes are "copy" (in-kernel copy with copy_file_range or sendfile, if
+    available), "hardlink", "symlink" (to the absolute path of src) and
+    "reflink" (copy-on-write clone, on file systems that support it). Modes
+    other than symlink fall back to copying if linking is not possible
+    (e.g., src and dst are on different devices).
+
+    If skip_existing is true and dst already exists with the same size as
+    src, do nothing. Return True if dst has been written, False otherwise.
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f"unknown mode: {mode!r}")
+    if os.path.lexists(dst):
+        if (skip_existing and os.path.exists(dst) and
+                os.path.getsize(dst) == os.path.getsize(src)):
+            return False
+        os.unlink(dst)
+    if mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return True
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    _copy(src, dst, reflink=(mode == "reflink"))
+    return True
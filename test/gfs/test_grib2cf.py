@@ -0,0 +1,128 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tdm.app.grib2cf import NCConcatenator, annotate, add_parser
+
+NLAT, NLON = 3, 4
+
+
+def make_nc(path, times, var_names):
+    with Dataset(path, "w") as ds:
+        ds.title = "test"
+        ds.createDimension("time", None)
+        ds.createDimension("latitude", NLAT)
+        ds.createDimension("longitude", NLON)
+        t = ds.createVariable("time", "f8", ("time",))
+        t.units = "seconds since 1970-01-01 00:00:00.0"
+        t[:] = times
+        lat = ds.createVariable("latitude", "f8", ("latitude",))
+        lat[:] = np.arange(NLAT)
+        for name in var_names:
+            v = ds.createVariable(name, "f4",
+                                  ("time", "latitude", "longitude"),
+                                  fill_value=9.999e20)
+            v.short_name = name
+            v[:] = [np.full((NLAT, NLON), _, dtype="f4") for _ in times]
+
+
+class TestNCConcatenator(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_concat(self):
+        paths = [os.path.join(self.wd, "%d.nc" % i) for i in range(3)]
+        make_nc(paths[0], [0], ["TMP_2maboveground"])
+        make_nc(paths[1], [3, 6], ["TMP_2maboveground", "APCP_surface"])
+        make_nc(paths[2], [9], ["TMP_2maboveground", "APCP_surface"])
+        out_path = os.path.join(self.wd, "out.nc")
+        with NCConcatenator(out_path) as concat:
+            for p in paths:
+                concat.append(p)
+        with Dataset(out_path) as ds:
+            self.assertEqual(ds.title, "test")
+            self.assertTrue(ds.dimensions["time"].isunlimited())
+            self.assertEqual(ds["time"][:].tolist(), [0, 3, 6, 9])
+            self.assertEqual(ds["latitude"][:].tolist(), list(range(NLAT)))
+            tmp = ds["TMP_2maboveground"]
+            self.assertEqual(tmp.short_name, "TMP_2maboveground")
+            self.assertEqual(tmp.chunking(), [1, NLAT, NLON])
+            self.assertEqual(tmp[:, 0, 0].tolist(), [0, 3, 6, 9])
+            apcp = ds["APCP_surface"][:]
+            self.assertTrue(apcp.mask[0].all())
+            self.assertEqual(apcp[1:, 0, 0].tolist(), [3, 6, 9])
+
+    def test_late_static_var(self):
+        paths = [os.path.join(self.wd, "%d.nc" % i) for i in range(2)]
+        make_nc(paths[0], [0], ["TMP_2maboveground"])
+        make_nc(paths[1], [3], ["TMP_2maboveground"])
+        with Dataset(paths[1], "a") as ds:
+            hgt = ds.createVariable("HGT_surface", "f4",
+                                    ("latitude", "longitude"))
+            hgt[:] = np.arange(NLAT * NLON).reshape(NLAT, NLON)
+        out_path = os.path.join(self.wd, "out.nc")
+        with NCConcatenator(out_path) as concat:
+            for p in paths:
+                concat.append(p)
+        with Dataset(out_path) as ds:
+            self.assertEqual(ds["HGT_surface"][:].ravel().tolist(),
+                             list(range(NLAT * NLON)))
+
+    def test_annotate(self):
+        path = os.path.join(self.wd, "0.nc")
+        make_nc(path, [0], ["TMP_2maboveground"])
+        annotate(path, {"product": "meteosim", "uid": None}, history="foo")
+        annotate(path, {"product_class": "gfs"}, history="bar")
+        with Dataset(path) as ds:
+            self.assertEqual(ds.title, "test")
+            self.assertEqual(ds.product, "meteosim")
+            self.assertEqual(ds.product_class, "gfs")
+            self.assertNotIn("uid", ds.ncattrs())
+            lines = ds.history.splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[0].endswith(": foo"))
+            self.assertTrue(lines[1].endswith(": bar"))
+
+
+class TestParser(unittest.TestCase):
+
+    def setUp(self):
+        parser = argparse.ArgumentParser()
+        add_parser(parser.add_subparsers())
+        self.parser = parser
+
+    def test_jobs(self):
+        args = self.parser.parse_args(["grib2cf", "-j", "3"])
+        self.assertEqual(args.jobs, 3)
+        for j in "0", "-1", "foo":
+            with self.assertRaises(SystemExit):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    self.parser.parse_args(["grib2cf", "-j", j])
+
+
+if __name__ == "__main__":
+    unittest.main()
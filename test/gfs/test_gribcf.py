@@ -0,0 +1,230 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime, timedelta
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tdm.gfs import gribcf
+
+LATS = [40.0, 39.5, 39.0]  # north to south, as in GFS files
+LONS = [8.0, 8.5, 9.0, 9.5]
+
+
+class FakeEccodes(object):
+    """\
+    Stand-in for the eccodes module. Fake GRIB files have one message per
+    line, as a JSON object mapping keys to values.
+    """
+
+    def __init__(self):
+        self.handles = {}
+        self.n_handles = 0
+        self.n_decoded = 0
+
+    def codes_grib_new_from_file(self, f, headers_only=False):
+        line = f.readline()
+        if not line:
+            return None
+        msg = json.loads(line)
+        if headers_only:
+            del msg["values"]
+        self.n_handles += 1
+        self.handles[self.n_handles] = msg
+        return self.n_handles
+
+    def codes_release(self, gid):
+        del self.handles[gid]
+
+    def codes_get(self, gid, key):
+        return self.handles[gid][key]
+
+    def codes_is_missing(self, gid, key):
+        return self.handles[gid].get(key) is None
+
+    def codes_get_array(self, gid, key):
+        return np.array(self.handles[gid][key])
+
+    def codes_get_values(self, gid):
+        self.n_decoded += 1
+        return np.array(self.handles[gid]["values"], dtype=np.float64)
+
+
+def make_msg(param, level, dt, values, bitmap=False, **extra):
+    (discipline, category, number), short_name = param
+    type_, scaled_value, scale_factor = level
+    return dict({
+        "discipline": discipline, "parameterCategory": category,
+        "parameterNumber": number, "shortName": short_name,
+        "name": short_name, "units": "K",
+        "typeOfFirstFixedSurface": type_,
+        "scaledValueOfFirstFixedSurface": scaled_value,
+        "scaleFactorOfFirstFixedSurface": scale_factor,
+        "typeOfSecondFixedSurface": 255,
+        "validityDate": int(dt.strftime("%Y%m%d")),
+        "validityTime": int(dt.strftime("%H%M")),
+        "gridType": "regular_ll", "numberOfDataPoints": len(values),
+        "distinctLatitudes": LATS, "distinctLongitudes": LONS,
+        "jScansPositively": 0, "bitmapPresent": int(bitmap),
+        "missingValue": 9999, "values": values,
+    }, **extra)
+
+
+TMP = (0, 0, 0), "t"
+APCP = (0, 1, 8), "tp"
+
+
+class TestGribCF(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_level_name(self):
+        self.assertEqual(gribcf.get_level_name(1, 0), "surface")
+        self.assertEqual(gribcf.get_level_name(103, 2), "2maboveground")
+        self.assertEqual(gribcf.get_level_name(100, 85000), "850mb")
+        self.assertEqual(gribcf.get_level_name(100, 40), "0.4mb")
+        self.assertEqual(gribcf.get_level_name(106, 0.1, 0.4),
+                         "0.1-0.4mbelowground")
+        self.assertEqual(gribcf.get_level_name(999, 5), "level999_5")
+
+    def test_writer(self):
+        t0 = datetime(2019, 3, 1)
+        times = [t0 + timedelta(hours=3 * _) for _ in range(3)]
+        lats, lons = np.linspace(38, 41, 4), np.linspace(8, 10, 3)
+        fields = {"TMP_2maboveground": {"units": "K"},
+                  "APCP_surface": {"units": "kg m**-2"}}
+        path = os.path.join(self.wd, "out.nc")
+        shape = (len(lats), len(lons))
+        with gribcf.CFWriter(path, times, fields, lats, lons) as w:
+            for i, t in enumerate(times):
+                w.write("TMP_2maboveground", t, np.full(shape, i, "f4"))
+            w.write("APCP_surface", times[2], np.ones(shape, "f4"))
+        with Dataset(path) as ds:
+            self.assertEqual(ds.Conventions, "CF-1.6")
+            self.assertTrue(ds.dimensions["time"].isunlimited())
+            t = ds["time"]
+            self.assertEqual(t[:].tolist(), [
+                (_ - gribcf.EPOCH).total_seconds() for _ in times
+            ])
+            self.assertEqual(ds["latitude"][:].tolist(), lats.tolist())
+            tmp = ds["TMP_2maboveground"]
+            self.assertEqual(tmp.units, "K")
+            self.assertEqual(tmp.chunking(), [1, len(lats), len(lons)])
+            self.assertTrue(tmp.filters()["zlib"])
+            self.assertEqual(tmp[:, 0, 0].tolist(), [0, 1, 2])
+            apcp = ds["APCP_surface"][:]
+            self.assertTrue(apcp.mask[:2].all())
+            self.assertEqual(apcp[2].tolist(), np.ones(shape).tolist())
+
+    def write_grib(self, name, msgs):
+        path = os.path.join(self.wd, name)
+        with io.open(path, "wt") as f:
+            for m in msgs:
+                f.write(json.dumps(m) + "\n")
+        return path
+
+    def test_convert(self):
+        t0 = datetime(2019, 3, 1, 6)
+        n = len(LATS) * len(LONS)
+        paths = []
+        for h in 0, 3:
+            dt = t0 + timedelta(hours=h)
+            values = [h + i for i in range(n)]
+            msgs = [
+                make_msg(TMP, (103, 2, 0), dt, values),
+                make_msg(TMP, (100, 40, 0), dt, [1.0] * n),  # 0.4 mb
+                make_msg(TMP, (100, 4000, 0), dt, [2.0] * n),  # 40 mb
+            ]
+            if h:
+                apcp = [0.5] * n
+                apcp[0] = 9999
+                msgs.append(make_msg(APCP, (1, None, None), dt, apcp,
+                                     bitmap=True))
+            paths.append(self.write_grib("f%03d" % h, msgs))
+        out = os.path.join(self.wd, "out.nc")
+        fake = FakeEccodes()
+        with mock.patch.object(gribcf, "eccodes", fake):
+            gribcf.convert(paths, out)
+        self.assertEqual(fake.n_decoded, 7)  # each message decoded once
+        self.assertEqual(fake.handles, {})
+        with Dataset(out) as ds:
+            self.assertEqual(set(ds.variables), {
+                "time", "latitude", "longitude", "TMP_2maboveground",
+                "TMP_0.4mb", "TMP_40mb", "APCP_surface",
+            })
+            self.assertEqual(ds["time"][:].tolist(), [
+                (t0 + timedelta(hours=h) - gribcf.EPOCH).total_seconds()
+                for h in (0, 3)
+            ])
+            self.assertEqual(ds["latitude"][:].tolist(), LATS[::-1])
+            self.assertEqual(ds["longitude"][:].tolist(), LONS)
+            # first row in the file is the northernmost one
+            exp = np.arange(n).reshape(len(LATS), len(LONS))[::-1]
+            tmp = ds["TMP_2maboveground"][:]
+            self.assertEqual(tmp[0].tolist(), exp.tolist())
+            self.assertEqual(tmp[1].tolist(), (exp + 3).tolist())
+            self.assertTrue((ds["TMP_0.4mb"][:] == 1).all())
+            self.assertTrue((ds["TMP_40mb"][:] == 2).all())
+            apcp = ds["APCP_surface"][:]
+            self.assertTrue(apcp.mask[0].all())
+            self.assertEqual(apcp.mask[1].sum(), 1)
+            self.assertTrue(apcp.mask[1, -1, 0])
+            self.assertEqual(apcp[1].sum(), 0.5 * (n - 1))
+
+    def test_duplicate(self):
+        # as in GFS files, with two accumulation windows ending at step 12
+        dt, n = datetime(2019, 3, 1, 12), len(LATS) * len(LONS)
+        path = self.write_grib("f012", [
+            make_msg(TMP, (103, 2, 0), dt, [3.0] * n),
+            make_msg(APCP, (1, None, None), dt, [1.0] * n, stepRange="6-12",
+                     typeOfStatisticalProcessing=1, lengthOfTimeRange=6),
+            make_msg(APCP, (1, None, None), dt, [2.0] * n, stepRange="0-12",
+                     typeOfStatisticalProcessing=1, lengthOfTimeRange=12),
+        ])
+        out = os.path.join(self.wd, "out.nc")
+        fake = FakeEccodes()
+        with mock.patch.object(gribcf, "eccodes", fake):
+            with self.assertLogs(gribcf.LOGGER, "WARNING") as cm:
+                gribcf.convert([path], out)
+        self.assertEqual(len(cm.output), 1)
+        self.assertIn("APCP_surface", cm.output[0])
+        self.assertEqual(fake.n_decoded, 2)  # dropped message not decoded
+        with Dataset(out) as ds:
+            self.assertEqual(set(ds.variables), {
+                "time", "latitude", "longitude", "TMP_2maboveground",
+                "APCP_surface",
+            })
+            self.assertEqual(len(ds["time"]), 1)
+            self.assertTrue((ds["APCP_surface"][:] == 2).all())
+            self.assertTrue((ds["TMP_2maboveground"][:] == 3).all())
+
+    @unittest.skipIf(gribcf.eccodes is not None, "ecCodes available")
+    def test_no_eccodes(self):
+        with self.assertRaises(RuntimeError):
+            gribcf.convert(["foo.grib2"], os.path.join(self.wd, "out.nc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,16 +11,379 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from ftplib import error_temp
+from unittest import mock
+
 from tdm.gfs.noaa import noaa_fetcher
+from tdm.gfs.noaa.noaa_fetcher import (
+    CycleWatcher, FTPPool, Manifest, DEFAULT_SUBSET, download,
+    download_ranges, get_part_path, parse_idx, parse_list_line, select_ranges
+)
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
+
+YEAR, MONTH, DAY, HOUR = 2019, 3, 1, 6
+DS = "gfs.2019030106"
+BASE_PATH = "/pub/data/nccf/com/gfs/prod/"
+HOURS = range(0, 30, 3)
+
+# (variable, level) for each message; a tuple for multi-field messages
+GRIB_FIELDS = [
+    ("PRMSL", "mean sea level"),
+    ("TMP", "2 m above ground"),
+    ("TMP", "surface"),
+    (("UGRD", "10 m above ground"), ("VGRD", "10 m above ground")),
+    ("APCP", "surface"),
+    ("TCDC", "surface"),
+    ("HGT", "500 mb"),
+]
+
+
+def make_grib(fields):
+    """\
+    Build a fake GRIB2 file (messages are GRIB ... 7777, as real ones) and
+    its inventory.
+    """
+    data, idx = io.BytesIO(), []
+    for i, field in enumerate(fields):
+        offset = data.tell()
+        data.write(b"GRIB" + os.urandom(100 + 10 * i) + b"7777")
+        subfields = field if isinstance(field[0], tuple) else [field]
+        for j, (var, level) in enumerate(subfields):
+            num = "%d.%d" % (i + 1, j + 1) if len(subfields) > 1 else i + 1
+            idx.append("%s:%d:d=2019030106:%s:%s:3 hour fcst:" %
+                       (num, offset, var, level))
+    return data.getvalue(), ("\n".join(idx) + "\n").encode()
+
+
+class LocalFTPServer(object):
+    """\
+    Anonymous, read-only FTP server on localhost, serving root. The idle
+    timeout for new connections can be changed via handler.timeout.
+    """
+
+    def __init__(self, root):
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(root)
+
+        class Handler(FTPHandler):
+            pass
+        Handler.authorizer = authorizer
+        self.handler = Handler
+        self.server = FTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.address[1]
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
 
+    def run(self):
+        while not self.stop.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False)
+        self.server.close_all()
 
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+
+
+@unittest.skipIf(FTPServer is None, "pyftpdlib not available")
 class TestNOAAFetcher(unittest.TestCase):
 
-    def runTest(self):
-        # TBD
-        self.assertIsNotNone(noaa_fetcher)
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.root = os.path.join(self.wd, "ftp")
+        self.ds_dir = os.path.join(self.root, BASE_PATH.strip("/"), DS)
+        os.makedirs(self.ds_dir)
+        self.data = {}
+        for h in range(0, 30, 3):
+            for ext in "", ".idx":
+                name = "gfs.t06z.pgrb2.0p50.f%03d%s" % (h, ext)
+                self.data[name] = os.urandom(1000 + 100 * h)
+        self.data["gfs.t06z.pgrb2.1p00.f000"] = b"foo"
+        for name, data in self.data.items():
+            with io.open(os.path.join(self.ds_dir, name), "wb") as f:
+                f.write(data)
+        self.out_dir = os.path.join(self.wd, "out")
+        os.makedirs(self.out_dir)
+        self.server = LocalFTPServer(self.root).__enter__()
+        logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+
+        class Fetcher(noaa_fetcher):
+            NOAA_FTP_SERVER = "127.0.0.1"
+            NOAA_FTP_PORT = self.server.port
+            NOAA_BASE_PATH = BASE_PATH
+            POLL_MIN = 0.01
+        self.fetcher = Fetcher(YEAR, MONTH, DAY, HOUR)
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.wd)
+
+    def test_parse_list_line(self):
+        line = "-rw-r--r--   1 ftp  ftp  123456 Mar 01 06:00 a b.grb2"
+        self.assertEqual(parse_list_line(line), ("a b.grb2", 123456))
+
+    def test_list(self):
+        entries = self.fetcher.list_files_in_path(BASE_PATH + DS)
+        self.assertEqual({k: v["size"] for k, v in entries.items()},
+                         {k: len(v) for k, v in self.data.items()})
+        self.assertTrue(self.fetcher.is_dataset_ready())
+
+    def test_fetch(self):
+        missing = self.fetcher.fetch("0p50", self.out_dir, nthreads=3,
+                                     hours=HOURS, tsleep=0.05)
+        self.assertEqual(missing, [])
+        exp = {k for k in self.data if "0p50" in k and not k.endswith("idx")}
+        self.assertEqual(set(os.listdir(self.out_dir)),
+                         exp | {Manifest.NAME})
+        for name in exp:
+            with io.open(os.path.join(self.out_dir, name), "rb") as f:
+                self.assertEqual(f.read(), self.data[name])
+
+    def test_pool(self):
+        names = sorted(self.data)
+        with self.fetcher.get_pool(2) as pool:
+            for name in names:
+                self.fetcher.fetch_file(BASE_PATH + DS, name, self.out_dir,
+                                        size=len(self.data[name]), pool=pool)
+            self.assertEqual(pool.n_connects, 1)
+        self.assertEqual(sorted(os.listdir(self.out_dir)), names)
+
+    def test_pool_stale(self):
+        # the server closes idle connections after the timeout
+        self.server.handler.timeout = 0.5
+        with FTPPool("127.0.0.1", self.server.port, size=1) as pool:
+            for _ in range(2):
+                with pool.connection() as ftp:
+                    self.assertIn(DS, ftp.nlst(BASE_PATH))
+                time.sleep(1.5)
+            self.assertEqual(pool.n_connects, 2)
+
+    def test_size_mismatch(self):
+        name = "gfs.t06z.pgrb2.1p00.f000"
+        target = os.path.join(self.out_dir, name)
+        with FTPPool("127.0.0.1", port=self.server.port) as pool:
+            with self.assertRaises(IOError):
+                download(pool, f"{BASE_PATH}{DS}/{name}", target, size=10)
+            # partial data is kept, to be resumed
+            self.assertEqual(os.listdir(self.out_dir),
+                             [os.path.basename(get_part_path(target))])
+            download(pool, f"{BASE_PATH}{DS}/{name}", target, size=3)
+        with io.open(target, "rb") as f:
+            self.assertEqual(f.read(), b"foo")
+
+    def test_resume_download(self):
+        name = "gfs.t06z.pgrb2.0p50.f027"
+        data = self.data[name]
+        target = os.path.join(self.out_dir, name)
+        # not the same data as on the server, to check that it's kept
+        with io.open(get_part_path(target), "wb") as f:
+            f.write(b"\0" * 500)
+        with FTPPool("127.0.0.1", port=self.server.port) as pool:
+            path = f"{BASE_PATH}{DS}/{name}"
+            download(pool, path, target, size=len(data))
+            with io.open(target, "rb") as f:
+                self.assertEqual(f.read(), b"\0" * 500 + data[500:])
+            with io.open(get_part_path(target), "wb") as f:
+                f.write(b"\0" * 500)
+            download(pool, path, target, size=len(data), resume=False)
+        with io.open(target, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(self.out_dir), [name])
+
+    def test_resume_ranges(self):
+        name = "gfs.t06z.pgrb2.0p25.f000"
+        data, idx = make_grib(GRIB_FIELDS)
+        with io.open(os.path.join(self.ds_dir, name), "wb") as f:
+            f.write(data)
+        ranges = select_ranges(parse_idx(idx.decode(), len(data)),
+                               DEFAULT_SUBSET)
+        self.assertGreaterEqual(len(ranges), 2)
+        exp = b"".join(data[s: e] for s, e in ranges)
+        target = os.path.join(self.out_dir, name)
+        path = f"{BASE_PATH}{DS}/{name}"
+        calls = []
+        module = sys.modules[noaa_fetcher.__module__]
+        read_range = module.read_range
+
+        def failing_read_range(ftp, path, start, end, callback, *args):
+            calls.append((start, end))
+            if len(calls) == 2:
+                callback(data[start: start + 10])
+                raise IOError("connection lost")
+            return read_range(ftp, path, start, end, callback, *args)
+
+        with FTPPool("127.0.0.1", port=self.server.port) as pool:
+            with mock.patch.object(module, "read_range",
+                                   failing_read_range):
+                with self.assertRaises(IOError):
+                    download_ranges(pool, path, target, ranges)
+            part = get_part_path(target)
+            self.assertEqual(os.stat(part).st_size,
+                             ranges[0][1] - ranges[0][0] + 10)
+            with mock.patch.object(module, "read_range",
+                                   side_effect=read_range) as rr:
+                download_ranges(pool, path, target, ranges)
+            starts = [_[0][2] for _ in rr.call_args_list]
+            self.assertEqual(starts, [ranges[1][0] + 10] +
+                             [s for s, _ in ranges[2:]])
+        with io.open(target, "rb") as f:
+            self.assertEqual(f.read(), exp)
+        self.assertEqual(os.listdir(self.out_dir), [name])
+
+    def test_resume_fetch(self):
+        self.fetcher.fetch("0p50", self.out_dir, nthreads=2, hours=HOURS,
+                           tsleep=0.05)
+        manifest = Manifest(self.out_dir)
+        names = sorted(manifest.files)
+        self.assertEqual(len(names), 10)
+        for name in names:
+            self.assertTrue(manifest.is_complete(name, len(self.data[name])))
+        modified, removed, truncated = names[:3]
+        with io.open(os.path.join(self.out_dir, modified), "r+b") as f:
+            f.write(b"foo")
+        os.unlink(os.path.join(self.out_dir, removed))
+        with io.open(os.path.join(self.out_dir, truncated), "r+b") as f:
+            f.truncate(10)
+        self.fetcher.fetch("0p50", self.out_dir, nthreads=2, hours=HOURS,
+                           tsleep=0.05, resume=True)
+        for name in names:
+            with io.open(os.path.join(self.out_dir, name), "rb") as f:
+                data = f.read()
+            if name == modified:
+                self.assertEqual(data[:3], b"foo")
+            else:
+                self.assertEqual(data, self.data[name])
+
+    def test_fetch_timeout(self):
+        missing = self.fetcher.fetch("0p50", self.out_dir, nthreads=2,
+                                     hours=range(0, 33, 3), tsleep=0.05,
+                                     timeout=0.2)
+        self.assertEqual(missing, ["gfs.t06z.pgrb2.0p50.f030"])
+        self.assertEqual(len(Manifest(self.out_dir).files), 10)
+
+    def test_fetch_subset(self):
+        gribs = {}
+        for h in 0, 3:
+            name = "gfs.t06z.pgrb2.0p25.f%03d" % h
+            gribs[name], idx = make_grib(GRIB_FIELDS)
+            for n, data in (name, gribs[name]), (name + ".idx", idx):
+                with io.open(os.path.join(self.ds_dir, n), "wb") as f:
+                    f.write(data)
+        # not indexed: never ready in subset mode
+        with io.open(os.path.join(self.ds_dir, "gfs.t06z.pgrb2.0p25.f006"),
+                     "wb") as f:
+            f.write(b"GRIB7777")
+        missing = self.fetcher.fetch("0p25", self.out_dir, hours=(0, 3, 6),
+                                     tsleep=0.05, timeout=0.3,
+                                     variables=DEFAULT_SUBSET)
+        self.assertEqual(missing, ["gfs.t06z.pgrb2.0p25.f006"])
+        for name, data in gribs.items():
+            with io.open(os.path.join(self.out_dir, name), "rb") as f:
+                subset = f.read()
+            msgs = [b"GRIB" + _ for _ in data.split(b"GRIB")[1:]]
+            self.assertEqual(subset, b"".join(msgs[1:2] + msgs[3:6]))
+        manifest = Manifest(self.out_dir)
+        self.assertEqual(set(manifest.files), set(gribs))
+
+
+class TestIdx(unittest.TestCase):
+
+    def test_parse(self):
+        data, idx = make_grib(GRIB_FIELDS)
+        records = parse_idx(idx.decode(), len(data))
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[0], ("PRMSL_meansealevel", 0, 108))
+        self.assertEqual(records[3][0], "UGRD_10maboveground")
+        self.assertEqual(records[3][1:], records[4][1:])
+        self.assertEqual(records[-1][2], len(data))
+        for name, start, end in records:
+            self.assertEqual(data[start: start + 4], b"GRIB")
+            self.assertEqual(data[end - 4: end], b"7777")
+
+    def test_select(self):
+        records = [("A", 0, 10), ("B", 10, 20), ("C", 20, 30),
+                   ("D", 30, 40), ("E", 30, 40), ("F", 40, 50)]
+        self.assertEqual(select_ranges(records, {"A", "C", "D", "E", "F"}),
+                         [(0, 10), (20, 50)])
+        self.assertEqual(select_ranges(records, {"B"}), [(10, 20)])
+        self.assertEqual(select_ranges(records, {"X"}), [])
+
+
+class TestCycleWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.listings = [
+            {},
+            {"a": 10},
+            {"a": 20, "b": 5},
+            {"a": 20, "b": 5},
+            {"a": 20, "b": 5, "c": 0},
+            {"a": 20, "b": 5, "c": 7},
+            {"a": 20, "b": 5, "c": 7},
+            {"a": 20, "b": 5, "c": 7},
+        ]
+        self.sleeps = []
+        self.now = 0
+
+    def list_files(self):
+        if isinstance(self.listings[0], Exception):
+            raise self.listings.pop(0)
+        return self.listings.pop(0) if len(self.listings) > 1 else \
+            self.listings[0]
+
+    def sleep(self, t):
+        self.sleeps.append(t)
+        self.now += t
+
+    def get_watcher(self):
+        return CycleWatcher(self.list_files, min_sleep=1, max_sleep=4,
+                            backoff=2, jitter=0, sleep=self.sleep,
+                            clock=lambda: self.now)
+
+    def test_watch(self):
+        watcher = self.get_watcher()
+        self.assertEqual(list(watcher.watch({"a", "b", "c"})),
+                         [("a", 20), ("b", 5), ("c", 7)])
+        self.assertEqual(self.sleeps, [2, 1, 1, 1, 1, 1])
+
+    def test_transient_errors(self):
+        self.listings[2:2] = [error_temp("421 timeout"), EOFError(),
+                              ConnectionResetError()]
+        watcher = self.get_watcher()
+        self.assertEqual(list(watcher.watch({"a", "b", "c"})),
+                         [("a", 20), ("b", 5), ("c", 7)])
+        self.assertEqual(self.sleeps, [2, 1, 2, 4, 4, 1, 1, 1, 1])
+
+    def test_no_expected(self):
+        watcher = self.get_watcher()
+        self.assertEqual(list(watcher.watch()),
+                         [("a", 20), ("b", 5), ("c", 7)])
+
+    def test_timeout(self):
+        watcher = self.get_watcher()
+        self.assertEqual(list(watcher.watch({"a", "d"}, timeout=20)),
+                         [("a", 20), ("b", 5), ("c", 7)])
+        self.assertEqual(self.sleeps, [2, 1, 1, 1, 1, 1, 1, 2, 4, 4])
+        self.assertLessEqual(sum(self.sleeps), 20)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import tdm.radar.catalog as catalog
+from tdm.utils import CACHE_DIR_ENV
+
+FMT = "%Y-%m-%d_%H:%M:%S"
+
+
+def parse(names):
+    rval = []
+    for n in names:
+        try:
+            rval.append(datetime.strptime(os.path.splitext(n)[0], FMT))
+        except ValueError:
+            rval.append(None)
+    return np.array(rval, dtype="datetime64[s]")
+
+
+class TestImageCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.root = os.path.join(self.wd, "images")
+        os.makedirs(self.root)
+        self.dts = [datetime(2018, 5, 1, 23, _) for _ in range(3)]
+        for dt in self.dts:
+            with io.open(os.path.join(self.root, dt.strftime(FMT) + ".png"),
+                         "wb"):
+                pass
+        with io.open(os.path.join(self.root, "README.txt"), "wb"):
+            pass
+        # make the last change older than the racy window
+        t = time.time() - 10
+        os.utime(self.root, (t, t))
+        env = {CACHE_DIR_ENV: os.path.join(self.wd, "cache")}
+        self.patcher = mock.patch.dict(os.environ, env)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.wd)
+
+    def test_location(self):
+        with catalog.open_catalog(self.root, parse) as cat:
+            db_path = cat.db_path
+        self.assertTrue(os.path.isfile(db_path))
+        self.assertFalse(db_path.startswith(self.root))
+        self.assertEqual(len(os.listdir(self.root)), len(self.dts) + 1)
+
+    def test_no_rescan(self):
+        mtime = os.stat(self.root).st_mtime_ns
+        with catalog.open_catalog(self.root, parse) as cat:
+            self.assertTrue(cat.is_fresh())
+        self.assertEqual(os.stat(self.root).st_mtime_ns, mtime)
+        with mock.patch.object(catalog.os, "scandir",
+                               side_effect=AssertionError("rescan")):
+            with catalog.open_catalog(self.root, parse) as cat:
+                ls = cat.query(datetime.min, datetime.max)
+        self.assertEqual([dt for dt, _ in ls], self.dts)
+
+    def test_update(self):
+        with catalog.open_catalog(self.root, parse) as cat:
+            pass
+        os.unlink(os.path.join(self.root, self.dts[0].strftime(FMT) + ".png"))
+        dt = datetime(2018, 5, 1, 23, 5)
+        with io.open(os.path.join(self.root, dt.strftime(FMT) + ".png"), "wb"):
+            pass
+        with catalog.open_catalog(self.root, parse) as cat:
+            ls = cat.query(datetime.min, datetime.max)
+        self.assertEqual([d for d, _ in ls], self.dts[1:] + [dt])
+
+    def test_find(self):
+        for name in "b.tdmpack", "a.tdmpack", "a.tdmidx":
+            with io.open(os.path.join(self.root, name), "wb"):
+                pass
+        t = time.time() - 10
+        os.utime(self.root, (t, t))
+        with catalog.open_catalog(self.root, parse) as cat:
+            pass
+        with mock.patch.object(catalog.os, "scandir",
+                               side_effect=AssertionError("rescan")):
+            with catalog.open_catalog(self.root, parse) as cat:
+                self.assertEqual(cat.find(".tdmpack"), [
+                    os.path.join(self.root, _)
+                    for _ in ("a.tdmpack", "b.tdmpack")
+                ])
+                ls = cat.query(datetime.min, datetime.max)
+        self.assertEqual([d for d, _ in ls], self.dts)
+
+    def test_concurrent_refresh(self):
+        db_path = catalog.get_db_path(self.root)
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def slow_parse(names):
+            time.sleep(0.2)
+            return parse(names)
+
+        def refresh():
+            try:
+                with catalog.ImageCatalog(self.root, slow_parse,
+                                          db_path=db_path) as cat:
+                    barrier.wait()
+                    cat.refresh(force=True)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=refresh) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        with catalog.ImageCatalog(self.root, parse) as cat:
+            ls = cat.query(datetime.min, datetime.max)
+        self.assertEqual([d for d, _ in ls], self.dts)
+
+
+if __name__ == "__main__":
+    unittest.main()
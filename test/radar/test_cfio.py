@@ -0,0 +1,72 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+from netCDF4 import Dataset
+import numpy as np
+import tdm.radar.cfio as cfio
+import tdm.radar.utils as utils
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(THIS_DIR, "data")
+
+
+@unittest.skipUnless(os.path.isdir(DATA_DIR), "requires sample data")
+class TestNCWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        footprint = os.path.join(DATA_DIR, "radarfootprint.tif")
+        self.ga = utils.GeoAdapter(footprint)
+        self.t0 = datetime(2018, 5, 1, 23, 0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def __random_rr(self):
+        shape = (self.ga.rows, self.ga.cols)
+        return np.ma.masked_array(np.random.random(shape).astype(np.float32),
+                                  mask=(np.random.random(shape) < 0.5))
+
+    def test_write(self):
+        nt, t_chunks = 13, 5
+        dts = [self.t0 + timedelta(minutes=i) for i in range(nt)]
+        rrs = [self.__random_rr() for _ in range(nt)]
+        path = os.path.join(self.wd, "rainfall.nc")
+        writer = cfio.NCWriter(path, self.ga, nt, self.t0, t_chunks=t_chunks)
+        for i in range(6):
+            writer.write(i, dts[i], rrs[i])
+        writer.write_block(6, dts[6:9], rrs[6:9])
+        for i in range(9, nt):
+            writer.write(i, dts[i], rrs[i])
+        writer.close()
+        ds = Dataset(path, "r")
+        t, rf_rate = ds.variables["time"], ds.variables["rainfall_rate"]
+        self.assertTrue(np.array_equal(t[:], 60 * np.arange(nt)))
+        exp_rr = np.ma.stack(rrs)
+        self.assertTrue(np.array_equal(np.ma.getmaskarray(rf_rate[:]),
+                                       exp_rr.mask))
+        self.assertTrue(np.ma.allclose(rf_rate[:], exp_rr, atol=1e-4))
+        ds.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent import futures
+from datetime import datetime, timedelta
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from tdm.radar import cube
+from tdm.utils import CACHE_DIR_ENV
+
+SHAPE = (6, 8)
+
+
+def decode(path):
+    with io.open(path, "rb") as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8).reshape(SHAPE)
+    return np.ma.masked_array(data, mask=(data > 200))
+
+
+class TestCube(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.old_cache_dir = os.environ.get(CACHE_DIR_ENV)
+        os.environ[CACHE_DIR_ENV] = os.path.join(self.wd, "cache")
+        start = datetime(2018, 5, 1, 23, 55, 4)
+        self.dt_path_pairs = []
+        for i in range(10):
+            dt = start + timedelta(seconds=60 * i)
+            path = os.path.join(self.wd, f"{i}.bin")
+            with io.open(path, "wb") as f:
+                f.write(os.urandom(SHAPE[0] * SHAPE[1]))
+            self.dt_path_pairs.append((dt, path))
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ[CACHE_DIR_ENV]
+        else:
+            os.environ[CACHE_DIR_ENV] = self.old_cache_dir
+        cube.open_cube.cache_clear()
+        shutil.rmtree(self.wd)
+
+    def check(self, pairs):
+        self.assertEqual([dt for dt, _ in pairs],
+                         [dt for dt, _ in self.dt_path_pairs])
+        for (_, image), (_, path) in zip(pairs, self.dt_path_pairs):
+            self.assertIsInstance(image, cube.CubeImage)
+            signal, exp_signal = cube.read_image(image), decode(path)
+            self.assertEqual(signal.dtype, np.uint8)
+            self.assertTrue(np.array_equal(signal.data, exp_signal.data))
+            self.assertTrue(np.array_equal(signal.mask, exp_signal.mask))
+            self.assertIsInstance(signal.base, np.memmap)
+
+    def test_cache(self):
+        pairs = cube.cache_images(self.dt_path_pairs, decode)
+        self.check(pairs)
+        self.assertEqual(len({image.path for _, image in pairs}), 2)
+        cube_path = pairs[0][1].path
+        _, _, index = cube.open_cube(cube_path)
+        self.assertEqual(index.tolist(),
+                         [dt for dt, _ in self.dt_path_pairs[:5]])
+        # cached: no decoding
+        self.assertEqual(cube.cache_images(self.dt_path_pairs, None), pairs)
+        # changing the source images invalidates the cube
+        os.utime(self.dt_path_pairs[0][1], ns=(0, 0))
+        new_pairs = cube.cache_images(self.dt_path_pairs, decode)
+        self.assertNotEqual(new_pairs[0][1].path, cube_path)
+        self.assertEqual(new_pairs[5:], pairs[5:])
+
+    def test_executor(self):
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pairs = cube.cache_images(self.dt_path_pairs, decode,
+                                      executor=executor)
+        self.check(pairs)
+
+    def test_disabled(self):
+        os.environ[CACHE_DIR_ENV] = ""
+        pairs = cube.cache_images(self.dt_path_pairs, decode)
+        self.assertIs(pairs, self.dt_path_pairs)
+
+
+if __name__ == '__main__':
+    unittest.main()
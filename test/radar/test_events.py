@@ -17,6 +17,7 @@ import unittest
 
 import numpy as np
 from tdm.radar.events import split as split_events
+from tdm.radar.events import split_bounds, split_stream, EventSplitter
 from tdm.radar.utils import FMT as DT_FMT
 
 
@@ -77,5 +78,47 @@ class TestEvents(unittest.TestCase):
         self.assertEqual(events, [])
 
 
+class TestArrayAndStream(unittest.TestCase):
+
+    def setUp(self):
+        N = 10000
+        deltas = np.random.normal(60, 5, N - 1)
+        deltas[[100, 1000, 5000]] = 60 * 60
+        deltas[[6000, 6001]] = 150  # below threshold
+        start = datetime(2018, 1, 1, 0, 0, 0)
+        self.dts = [start]
+        for d in deltas:
+            self.dts.append(self.dts[-1] + timedelta(seconds=d))
+        self.pairs = [(dt, i) for i, dt in enumerate(self.dts)]
+
+    def test_bounds(self):
+        dts = np.array(self.dts, dtype="datetime64[us]")
+        bounds = split_bounds(dts, min_len=100)
+        self.assertEqual(bounds.tolist(),
+                         [[0, 101], [101, 1001], [1001, 5001], [5001, 10000]])
+        bounds = split_bounds(dts, min_len=timedelta(hours=40))
+        self.assertEqual(bounds.tolist(), [[1001, 5001], [5001, 10000]])
+        self.assertEqual(split_bounds(dts[:0]).shape, (0, 2))
+
+    def test_stream(self):
+        for min_len in 0, 100, 40 * 60 * 60:
+            exp_events = list(split_events(self.pairs, min_len=min_len))
+            events = list(split_stream(iter(self.pairs), min_len=min_len))
+            self.assertEqual(events, exp_events)
+
+    def test_splitter(self):
+        splitter = EventSplitter(min_len=0)
+        start = datetime(2018, 1, 1, 0, 0, 0)
+        pairs = [(start + timedelta(minutes=i), i) for i in range(3)]
+        for dt, i in pairs:
+            self.assertIsNone(splitter.add(dt, i))
+        last = pairs[-1][0]
+        self.assertIsNone(splitter.check(last + timedelta(seconds=100)))
+        self.assertEqual(splitter.check(last + timedelta(hours=1)), pairs)
+        self.assertIsNone(splitter.flush())
+        splitter.add(last, 0)
+        self.assertRaises(ValueError, splitter.add, start, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
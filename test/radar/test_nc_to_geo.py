@@ -0,0 +1,99 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gdal
+from gdal import osr
+import numpy as np
+from tdm.app.radar_nc_to_geo import WarpPlan
+from tdm.utils import CACHE_DIR_ENV
+
+gdal.UseExceptions()
+
+# UTM 32N, 1 km pixels, over Sardinia
+GEO_TR = (450000.0, 1000.0, 0, 4500000.0, 0, -1000.0)
+SHAPE = (20, 30)
+T_SRS = "EPSG:4326"
+FILL_VALUE = -9999.0
+
+
+def direct_warp(data, geo_tr, wkt):
+    rows, cols = data.shape
+    raster = gdal.GetDriverByName("MEM").Create(
+        "", cols, rows, 1, gdal.GDT_Float32
+    )
+    raster.SetGeoTransform(geo_tr)
+    raster.SetProjection(wkt)
+    band = raster.GetRasterBand(1)
+    band.WriteArray(data.filled())
+    band.SetNoDataValue(FILL_VALUE)
+    warped = gdal.Warp("", raster, format="MEM", dstSRS=T_SRS,
+                       resampleAlg="near", dstNodata=FILL_VALUE)
+    return (warped.GetRasterBand(1).ReadAsArray(),
+            warped.GetGeoTransform(), warped.GetProjectionRef())
+
+
+class TestWarpPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.old_cache_dir = os.environ.get(CACHE_DIR_ENV)
+        os.environ[CACHE_DIR_ENV] = self.wd
+        sr = osr.SpatialReference()
+        sr.ImportFromEPSG(32632)
+        self.wkt = sr.ExportToWkt()
+        rng = np.random.RandomState(42)
+        values = rng.uniform(0, 100, SHAPE).astype(np.float32)
+        mask = rng.uniform(size=SHAPE) < 0.2
+        self.data = np.ma.masked_array(values, mask=mask,
+                                       fill_value=FILL_VALUE)
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ[CACHE_DIR_ENV]
+        else:
+            os.environ[CACHE_DIR_ENV] = self.old_cache_dir
+        shutil.rmtree(self.wd)
+
+    def check_plan(self, plan):
+        exp, exp_geo_tr, exp_wkt = direct_warp(self.data, GEO_TR, self.wkt)
+        out, fill_value = plan.apply(self.data)
+        self.assertEqual(fill_value, FILL_VALUE)
+        self.assertEqual(out.shape, exp.shape)
+        self.assertTrue((out == FILL_VALUE).any())  # nodata is covered
+        self.assertTrue(np.array_equal(out, exp))
+        self.assertTrue(np.allclose(plan.geo_tr, exp_geo_tr))
+        self.assertEqual(osr.SpatialReference(wkt=plan.wkt).ExportToWkt(),
+                         osr.SpatialReference(wkt=exp_wkt).ExportToWkt())
+
+    def test_apply(self):
+        self.check_plan(WarpPlan.compute(GEO_TR, self.wkt, SHAPE, T_SRS))
+
+    def test_cached(self):
+        plan = WarpPlan.get(GEO_TR, self.wkt, SHAPE, T_SRS)
+        self.check_plan(plan)
+        self.assertEqual(len(os.listdir(os.path.join(self.wd, "warp"))), 1)
+        cached = WarpPlan.get(GEO_TR, self.wkt, SHAPE, T_SRS)
+        self.assertIsNot(cached, plan)
+        self.assertTrue(np.array_equal(cached.index, plan.index))
+        self.check_plan(cached)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime, timedelta
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from tdm.radar import pack
+
+FMT = "%Y-%m-%d_%H:%M:%S"
+
+
+class TestPack(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.in_dir = os.path.join(self.wd, "in")
+        self.out_dir = os.path.join(self.wd, "out")
+        os.makedirs(self.in_dir)
+        os.makedirs(self.out_dir)
+        start = datetime(2018, 5, 1, 23, 55, 4)
+        self.dt_path_pairs = []
+        for i in range(10):
+            dt = start + timedelta(seconds=60 * i)
+            path = os.path.join(self.in_dir, f"{dt.strftime(FMT)}.png")
+            with io.open(path, "wb") as f:
+                f.write(os.urandom(100 + i))
+            self.dt_path_pairs.append((dt, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def check_images(self, root):
+        pairs = pack.get_images(root)
+        self.assertEqual([dt for dt, _ in pairs],
+                         [dt for dt, _ in self.dt_path_pairs])
+        for (_, image), (_, path) in zip(pairs, self.dt_path_pairs):
+            with io.open(path, "rb") as f:
+                self.assertEqual(pack.read_image(image), f.read())
+        return pairs
+
+    def test_pack_images(self):
+        n = pack.pack_images(self.dt_path_pairs, self.out_dir)
+        self.assertEqual(n, len(self.dt_path_pairs))
+        packs = pack.find_packs(self.out_dir)
+        self.assertEqual([os.path.basename(_) for _ in packs],
+                         ["2018-05-01.tdmpack", "2018-05-02.tdmpack"])
+        self.check_images(self.out_dir)
+        pairs = pack.get_images(packs[0])
+        self.assertEqual(len(pairs), 5)
+        after, before = self.dt_path_pairs[2][0], self.dt_path_pairs[6][0]
+        pairs = pack.get_images(self.out_dir, after=after, before=before)
+        self.assertEqual(len(pairs), 5)
+        # already packed images are skipped
+        n = pack.pack_images(self.dt_path_pairs, self.out_dir)
+        self.assertEqual(n, 0)
+        self.check_images(self.out_dir)
+
+    def test_append(self):
+        path = os.path.join(self.out_dir, "all.tdmpack")
+        for dt, p in self.dt_path_pairs[::-1]:
+            with pack.PackWriter(path) as writer, io.open(p, "rb") as f:
+                writer.add(dt, f.read())
+        self.check_images(path)
+
+    def test_truncated(self):
+        path = os.path.join(self.out_dir, "all.tdmpack")
+        pack.pack_images(self.dt_path_pairs, self.out_dir,
+                         get_name=lambda dt: "all.tdmpack")
+        # simulate an interrupted append
+        size = os.stat(path).st_size
+        with io.open(path, "r+b") as f:
+            f.truncate(size - 1)
+        with io.open(pack.get_index_path(path), "ab") as f:
+            f.write(b"\0" * 5)
+        self.assertEqual(len(pack.get_images(path)), 9)
+        with io.open(pack.get_index_path(path), "wb") as f:
+            f.write(b"foo")
+        self.assertRaises(ValueError, pack.read_index, path)
+
+    def test_append_truncated(self):
+        path = os.path.join(self.out_dir, "all.tdmpack")
+        index_path = pack.get_index_path(path)
+        pairs = self.dt_path_pairs
+
+        def add(pairs):
+            with pack.PackWriter(path) as writer:
+                for dt, p in pairs:
+                    with io.open(p, "rb") as f:
+                        writer.add(dt, f.read())
+
+        # interrupted append: unreferenced data, partial index record
+        add(pairs[:4])
+        with io.open(path, "ab") as f:
+            f.write(os.urandom(7))
+        with io.open(index_path, "ab") as f:
+            f.write(b"\0" * 5)
+        add(pairs[4:7])
+        self.assertEqual(os.path.getsize(index_path),
+                         len(pack.INDEX_MAGIC) + 7 * pack.INDEX_DTYPE.itemsize)
+        # damaged data file: the last record points past its end
+        with io.open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        add(pairs[6:])
+        self.check_images(path)
+        images = [image for _, image in pack.get_images(path)]
+        self.assertEqual(os.path.getsize(path),
+                         images[-1].offset + images[-1].size)
+
+    def test_read_range(self):
+        pack.pack_images(self.dt_path_pairs, self.out_dir)
+        pairs = pack.get_images(self.out_dir)[:5]
+        images = [image for _, image in pairs]
+        with io.open(images[0].path, "rb") as f:
+            data = pack.read_range(f, images[1:4])
+        self.assertEqual(data, [pack.read_image(_) for _ in images[1:4]])
+
+    def test_unpack(self):
+        pack.pack_images(self.dt_path_pairs, self.out_dir)
+        unpack_dir = os.path.join(self.wd, "unpacked")
+        os.makedirs(unpack_dir)
+        n = 0
+        for path in pack.find_packs(self.out_dir):
+            n += pack.unpack(path, unpack_dir, FMT)
+        self.assertEqual(n, len(self.dt_path_pairs))
+        for _, path in self.dt_path_pairs:
+            out_path = os.path.join(unpack_dir, os.path.basename(path))
+            with io.open(path, "rb") as f, io.open(out_path, "rb") as fo:
+                self.assertEqual(fo.read(), f.read())
+        n = pack.unpack(pack.find_packs(self.out_dir)[0], unpack_dir, FMT)
+        self.assertEqual(n, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
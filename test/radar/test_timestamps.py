@@ -0,0 +1,59 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from datetime import datetime, timedelta
+import unittest
+
+import numpy as np
+from tdm.radar import timestamps
+
+FMT = "%Y-%m-%d_%H:%M:%S"
+
+
+class TestTimestamps(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime(2018, 12, 31, 23, 50, 0)
+        self.dts = [start + timedelta(seconds=61 * i) for i in range(100)]
+
+    def test_parser(self):
+        for fmt in FMT, "%Y%m%dT%H%M%S", "%Y%m%d%H", "%%%m/%Y":
+            parse = timestamps.make_parser(fmt)
+            for dt in self.dts:
+                s = dt.strftime(fmt)
+                self.assertEqual(parse(s), datetime.strptime(s, fmt))
+        parse = timestamps.make_parser(FMT)
+        for s in ("2018-12-31_23:50", "2018-12-31_23:50:00.png",
+                  "2018-02-30_00:00:00", "2018-12-31T23:50:00",
+                  "2018-12- 1_23:50:00", "2018-12-31_24:00:00"):
+            self.assertRaises(ValueError, parse, s)
+
+    def test_bad_format(self):
+        for fmt in "%Y-%j", "%Y%", "%Y-%Y":
+            self.assertRaises(ValueError, timestamps.make_parser, fmt)
+
+    def test_array(self):
+        strings = [dt.strftime(FMT) for dt in self.dts]
+        bad = ["", "foo", "2018-02-29_00:00:00", "2018-12-31_23:50:60"]
+        a = timestamps.parse_array(strings + bad, FMT)
+        self.assertEqual(a.dtype, np.dtype("datetime64[s]"))
+        self.assertEqual(a[:len(strings)].tolist(), self.dts)
+        self.assertTrue(np.isnat(a[len(strings):]).all())
+        self.assertEqual(timestamps.parse_array([], FMT).size, 0)
+        self.assertTrue(np.isnat(timestamps.parse_array(["x"], FMT)).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
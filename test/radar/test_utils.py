@@ -14,6 +14,7 @@
 
 from datetime import datetime, timedelta
 import io
+import itertools
 import os
 import shutil
 import tempfile
@@ -21,7 +22,12 @@ import unittest
 
 import gdal
 import numpy as np
+from gdal import osr
+import tdm.geotiff as geotiff
+import tdm.radar.catalog as catalog
+import tdm.radar.pack as pack
 import tdm.radar.utils as utils
+from tdm.utils import CACHE_DIR_ENV
 
 gdal.UseExceptions()
 
@@ -57,6 +63,9 @@ class TestGetImages(unittest.TestCase):
 
     def setUp(self):
         self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.cache_dir = tempfile.mkdtemp(prefix="tdm_")
+        self.old_cache_dir = os.environ.get(CACHE_DIR_ENV)
+        os.environ[CACHE_DIR_ENV] = self.cache_dir
         self.info = []
         for name in self.SAMPLE:
             p = os.path.join(self.wd, "%s%s.png" % (self.TAG, name))
@@ -67,6 +76,11 @@ class TestGetImages(unittest.TestCase):
             pass
 
     def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ[CACHE_DIR_ENV]
+        else:
+            os.environ[CACHE_DIR_ENV] = self.old_cache_dir
+        shutil.rmtree(self.cache_dir)
         shutil.rmtree(self.wd)
 
     def test_get(self):
@@ -85,6 +99,38 @@ class TestGetImages(unittest.TestCase):
         self.assertEqual(len(ls), len(exp_res))
         self.assertEqual(ls, exp_res)
 
+    def test_catalog(self):
+        ls = utils.get_images(self.wd)
+        self.assertEqual(ls, self.info)
+        self.assertEqual(utils.get_images(self.wd, use_catalog=False), ls)
+        self.assertTrue(os.path.exists(catalog.get_db_path(self.wd)))
+        self.assertEqual(len(os.listdir(self.wd)), len(self.info) + 1)
+        os.unlink(self.info[0][1])
+        name = "2018-05-01_23:31:02"
+        p = os.path.join(self.wd, "%s%s.png" % (self.TAG, name))
+        with io.open(p, "wb"):
+            pass
+        exp_res = self.info[1:] + [(datetime.strptime(name, self.FMT), p)]
+        self.assertEqual(utils.get_images(self.wd), exp_res)
+        self.assertEqual(utils.get_images(self.wd, self.AFTER, self.BEFORE),
+                         self.info[2:-1])
+
+    def test_packs(self):
+        packed_dts = [datetime(2018, 5, 1, 23, 19, 4),  # also loose
+                      datetime(2018, 5, 1, 23, 40)]
+        with pack.PackWriter(os.path.join(self.wd, "x.tdmpack")) as w:
+            for dt in packed_dts:
+                w.add(dt, b"foo")
+        for use_catalog in True, False:
+            ls = utils.get_images(self.wd, use_catalog=use_catalog)
+            self.assertEqual(ls, self.info)
+            ls = utils.get_images(self.wd, use_catalog=use_catalog,
+                                  include_packs=True)
+            self.assertEqual(ls[:-1], self.info)
+            dt, p = ls[-1]
+            self.assertEqual(dt, packed_dts[-1])
+            self.assertIsInstance(p, pack.PackedImage)
+
     def test_get_grouped(self):
         delta = timedelta(minutes=5)
         exp_res = {
@@ -117,6 +163,52 @@ class TestGetImages(unittest.TestCase):
         self.assertEqual(res, exp_res)
 
 
+class TestEstimateRainfall(unittest.TestCase):
+
+    def test_lut(self):
+        a, b = 200, 1.6
+        data = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        signal = np.ma.masked_array(data, mask=(data % 3 == 0))
+        rf = utils.estimate_rainfall(signal, a=a, b=b)
+        Z = 10**(0.1*(0.39216 * signal.astype(np.float64) - 8.6))
+        exp_rf = (Z/a)**(1/b)
+        self.assertTrue(np.array_equal(rf.mask, signal.mask))
+        self.assertTrue(np.ma.allclose(rf, exp_rf))
+        self.assertEqual(rf.fill_value, utils.RAINFALL_FILL_VALUE)
+        self.assertIs(utils.get_rainfall_lut(a, b),
+                      utils.get_rainfall_lut(a, b))
+
+    def test_accumulator(self):
+        shape, n = (8, 10), 6
+        rfs = [np.ma.masked_array(100 * np.random.random(shape),
+                                  mask=(np.random.random(shape) < 0.5))
+               for _ in range(n)]
+        for rf in rfs:
+            rf.mask[0, :] = True
+        acc = utils.RainfallAccumulator()
+        for rf in rfs:
+            acc.add(rf)
+        avg = acc.mean()
+        exp_avg = np.ma.mean(rfs, axis=0)
+        self.assertTrue(np.array_equal(avg.mask, np.ma.getmaskarray(exp_avg)))
+        self.assertTrue(np.ma.allclose(avg, exp_avg))
+        self.assertEqual(avg.fill_value, utils.RAINFALL_FILL_VALUE)
+
+    def test_avg_rr(self):
+        shape = (4, 5)
+        t0 = datetime(2018, 5, 1)
+        pairs = [(t0 + timedelta(seconds=60 * i),
+                  np.ma.masked_array(np.full(shape, float(i))))
+                 for i in range(7)]
+        groups = utils.group_images(pairs, 180)
+        res = list(utils.avg_rr(groups))
+        self.assertEqual([dt for dt, _ in res],
+                         [t0, t0 + timedelta(seconds=180),
+                          t0 + timedelta(seconds=360)])
+        for (_, avg), exp in zip(res, (1., 4., 6.)):
+            self.assertTrue(np.ma.allclose(avg, exp))
+
+
 @unittest.skipUnless(os.path.isdir(DATA_DIR), "requires sample data")
 class TestSave(unittest.TestCase):
 
@@ -157,6 +249,111 @@ class TestSave(unittest.TestCase):
         self.assertTrue(np.array_equal(ma2.mask, ma.mask))
         self.assertTrue(np.ma.allclose(ma2, ma))
 
+    def test_gtiff_bytes(self):
+        signal = utils.get_image_data(self.raw_fn)
+        rain = utils.estimate_rainfall(signal)
+        ga = utils.GeoAdapter(self.template)
+        value = ga.to_gtiff_bytes(rain, metadata={"foo": "bar"})
+        out_fn = os.path.join(self.wd, "sample.tif")
+        with io.open(out_fn, "wb") as f:
+            f.write(value)
+        dataset = gdal.Open(out_fn)
+        self.assertEqual(dataset.GetMetadata().get("foo"), "bar")
+        ma = utils.band_to_ma(dataset.GetRasterBand(1))
+        self.assertTrue(np.array_equal(ma.mask, rain.mask))
+        self.assertTrue(np.ma.allclose(ma, rain))
+
+    def test_gtiff_profile(self):
+        signal = utils.get_image_data(self.raw_fn)
+        rain = utils.estimate_rainfall(signal)
+        ga = utils.GeoAdapter(self.template)
+        for cog in False, True:
+            profile = geotiff.OutputProfile(
+                tiled=True, block_size=128, compress="DEFLATE",
+                overviews=True, cog=cog
+            )
+            out_fn = os.path.join(self.wd, "sample_%s.tif" % cog)
+            ga.save_as_gtiff(out_fn, rain, profile=profile)
+            dataset = gdal.Open(out_fn)
+            band = dataset.GetRasterBand(1)
+            self.assertEqual(band.GetBlockSize(), [128, 128])
+            self.assertGreater(band.GetOverviewCount(), 0)
+            self.assertEqual(
+                dataset.GetMetadata("IMAGE_STRUCTURE").get("COMPRESSION"),
+                "DEFLATE"
+            )
+            ma = utils.band_to_ma(band)
+            self.assertTrue(np.array_equal(ma.mask, rain.mask))
+            self.assertTrue(np.ma.allclose(ma, rain))
+            self.assertEqual(dataset.GetGeoTransform(),
+                             (ga.oX, ga.pxlW, 0, ga.oY, 0, ga.pxlH))
+
+    def test_cog_uncompressed(self):
+        signal = utils.get_image_data(self.raw_fn)
+        rain = utils.estimate_rainfall(signal)
+        ga = utils.GeoAdapter(self.template)
+        profile = geotiff.OutputProfile(compress="NONE", cog=True)
+        out_fn = os.path.join(self.wd, "sample.tif")
+        ga.save_as_gtiff(out_fn, rain, profile=profile)
+        dataset = gdal.Open(out_fn)
+        self.assertIsNone(
+            dataset.GetMetadata("IMAGE_STRUCTURE").get("COMPRESSION")
+        )
+        ma = utils.band_to_ma(dataset.GetRasterBand(1))
+        self.assertTrue(np.array_equal(ma.mask, rain.mask))
+        self.assertTrue(np.ma.allclose(ma, rain))
+
+
+@unittest.skipUnless(os.path.isdir(DATA_DIR), "requires sample data")
+class TestLatLon(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.old_cache_dir = os.environ.get(CACHE_DIR_ENV)
+        os.environ[CACHE_DIR_ENV] = self.wd
+        footprint = os.path.join(DATA_DIR, "radarfootprint.tif")
+        self.ga = utils.GeoAdapter(footprint)
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ[CACHE_DIR_ENV]
+        else:
+            os.environ[CACHE_DIR_ENV] = self.old_cache_dir
+        shutil.rmtree(self.wd)
+
+    def test_cached(self):
+        xpos, ypos = self.ga.xpos(), self.ga.ypos()
+        exp_lat, exp_lon = utils.get_lat_lon(self.ga.sr, xpos, ypos)
+        self.assertEqual(exp_lat.shape, (len(ypos), len(xpos)))
+        self.assertEqual(exp_lon.shape, (len(ypos), len(xpos)))
+        for _ in range(2):
+            lat, lon = self.ga.get_lat_lon()
+            self.assertTrue(np.array_equal(lat, exp_lat))
+            self.assertTrue(np.array_equal(lon, exp_lon))
+        self.assertEqual(len(os.listdir(os.path.join(self.wd, "latlon"))), 1)
+
+    def test_per_pixel(self):
+        # compare with a plain per-pixel transform on a small grid
+        self.ga.cols, self.ga.rows = 7, 5
+        xpos, ypos = self.ga.xpos(), self.ga.ypos()
+        target_sr = osr.SpatialReference()
+        target_sr.ImportFromEPSG(4326)
+        transform = osr.CoordinateTransformation(self.ga.sr, target_sr)
+        lon, lat, _ = zip(*transform.TransformPoints(
+            list(itertools.product(xpos, ypos))
+        ))
+        exp_lon = np.array(lon).reshape(len(xpos), len(ypos)).T
+        exp_lat = np.array(lat).reshape(len(xpos), len(ypos)).T
+        for lat, lon in (
+                utils.get_lat_lon(self.ga.sr, xpos, ypos),
+                utils._transform_grid(transform, xpos, ypos),
+                self.ga.get_lat_lon(),
+                self.ga.get_lat_lon(),  # cached
+        ):
+            self.assertEqual(lat.shape, (len(ypos), len(xpos)))
+            self.assertTrue(np.allclose(lat, exp_lat, rtol=0, atol=1e-5))
+            self.assertTrue(np.allclose(lon, exp_lon, rtol=0, atol=1e-5))
+
 
 if __name__ == '__main__':
     unittest.main()
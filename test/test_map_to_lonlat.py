@@ -0,0 +1,138 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tdm.app import map_to_lonlat as m
+from tdm.utils import CACHE_DIR_ENV
+
+
+def make_nc(path, lats, lons, nt=2):
+    with Dataset(path, "w") as ds:
+        ds.title = "test"
+        ds.createDimension("time", None)
+        ds.createDimension("latitude", len(lats))
+        ds.createDimension("longitude", len(lons))
+        t = ds.createVariable("time", "f8", ("time",))
+        t.units = "seconds since 1970-01-01 00:00:00.0"
+        t[:] = np.arange(nt)
+        lat = ds.createVariable("latitude", "f8", ("latitude",))
+        lat.units = "degrees_north"
+        lat[:] = lats
+        lon = ds.createVariable("longitude", "f8", ("longitude",))
+        lon.units = "degrees_east"
+        lon[:] = lons
+        v = ds.createVariable("T", "f4", ("time", "latitude", "longitude"),
+                              fill_value=9.999e20)
+        v.units = "K"
+        # linear in lat and lon, so bilinear interpolation is exact
+        v[:] = [t + np.add.outer(2 * lats, lons) for t in range(nt)]
+
+
+class TestMapToLonLat(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        env = {CACHE_DIR_ENV: os.path.join(self.wd, "cache")}
+        self.patcher = mock.patch.dict(os.environ, env)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.wd)
+
+    def test_weights(self):
+        src_lats, src_lons = np.array([2., 1., 0.]), np.arange(4.)
+        lats, lons = np.array([0.5, 1.75, 3.]), np.array([0., 2.5])
+        idx, w, valid = m.compute_weights(src_lats, src_lons, lats, lons)
+        self.assertEqual(idx.shape, (6, 4))
+        self.assertTrue(np.allclose(w.sum(axis=1), 1))
+        self.assertEqual(valid.tolist(), [True] * 4 + [False] * 2)
+        a = np.add.outer(2 * src_lats, src_lons)
+        out = m.apply_weights(a, (idx, w, valid), (3, 2))
+        self.assertTrue(out.mask[2].all())
+        exp = np.add.outer(2 * lats[:2], lons)
+        self.assertTrue(np.allclose(out[:2], exp))
+
+    def test_masked(self):
+        a = np.ma.masked_array(np.ones((2, 2)), mask=[[1, 0], [0, 0]])
+        weights = m.compute_weights([0, 1], [0, 1], [0, 1], [0.5, 1])
+        out = m.apply_weights(a, weights, (2, 2))
+        self.assertEqual(out.mask.tolist(), [[True, False], [False, False]])
+
+    def test_wrap(self):
+        # global grid with longitudes in 0..360, as in GFS datasets
+        src_lats, src_lons = np.array([0., 10., 20.]), np.arange(0., 360, 30)
+        g = np.random.RandomState(0).uniform(size=src_lons.size)
+        a = np.add.outer(2 * src_lats, g)
+        lats = np.array([5., 15.])
+        lons = np.array([-45., -10., 0., 15., 335., 345., 359., 370.])
+        weights = m.compute_weights(src_lats, src_lons, lats, lons)
+        out = m.apply_weights(a, weights, (len(lats), len(lons)))
+        self.assertFalse(out.mask.any())
+        exp = np.add.outer(2 * lats,
+                           np.interp(lons, src_lons, g, period=360))
+        self.assertTrue(np.allclose(out, exp))
+        # regional grid: only the range is normalized
+        weights = m.compute_weights(src_lats, [340, 350, 360, 370],
+                                    lats, [-25, -15, 5, 35])
+        self.assertEqual(weights[2].tolist(), [False, True, True, False] * 2)
+
+    def test_cache_error(self):
+        args = np.arange(3.), np.arange(3.), [0.5], [0.5, 1.5]
+        with mock.patch.object(m.np, "savez", side_effect=OSError):
+            self.assertRaises(OSError, m.get_weights, *args)
+        self.assertEqual(os.listdir(os.path.join(self.wd, "cache", "remap")),
+                         [])
+
+    def test_cache(self):
+        args = np.arange(3.), np.arange(3.), [0.5], [0.5, 1.5]
+        exp = m.get_weights(*args)
+        cache_dir = os.path.join(self.wd, "cache", "remap")
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        with mock.patch.object(m, "compute_weights") as cw:
+            got = m.get_weights(*args)
+            cw.assert_not_called()
+        for a, b in zip(exp, got):
+            self.assertEqual(a.tolist(), b.tolist())
+
+    def test_map_to_region(self):
+        fin = os.path.join(self.wd, "in.nc")
+        fout = os.path.join(self.wd, "out.nc")
+        make_nc(fin, np.linspace(40, 38, 5), np.linspace(8, 10, 9))
+        m.map_to_region(fin, fout, 8.25, 0.5, 3, 38.5, 0.25, 4,
+                        engine="numpy")
+        lats, lons = 38.5 + 0.25 * np.arange(4), 8.25 + 0.5 * np.arange(3)
+        with Dataset(fout) as ds:
+            self.assertEqual(ds.title, "test")
+            self.assertEqual(ds["time"][:].tolist(), [0, 1])
+            self.assertTrue(np.allclose(ds["lat"][:], lats))
+            self.assertTrue(np.allclose(ds["lon"][:], lons))
+            self.assertEqual(ds["lat"].units, "degrees_north")
+            v = ds["T"]
+            self.assertEqual(v.dimensions, ("time", "lat", "lon"))
+            self.assertEqual(v.units, "K")
+            exp = np.add.outer(2 * lats, lons)
+            self.assertTrue(np.allclose(v[0], exp))
+            self.assertTrue(np.allclose(v[1], exp + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright 2018-2019 CRS4
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import gdal
+import numpy as np
+import xarray as xr
+
+from tdm.app import map_to_tree as m
+
+NT = 5
+
+
+def make_dataset(nt=NT):
+    times = np.datetime64("2019-01-01T00:00") + \
+        np.arange(nt) * np.timedelta64(1, "h")
+    lats = np.arange(38.0, 41.0, 0.5)
+    lons = np.arange(8.0, 10.0, 0.5)
+    data_vars = {}
+    for i, (_, _, var_names, _) in enumerate(m.FIELDS):
+        for j, name in enumerate(var_names):
+            # distinct for each variable, time step and grid point
+            values = 1000 * (len(m.FIELDS) * j + i) + np.arange(
+                nt * len(lats) * len(lons), dtype=np.float32
+            ).reshape(nt, len(lats), len(lons))
+            data_vars[name] = (("time", "lat", "lon"), values)
+    return xr.Dataset(data_vars,
+                      coords={"time": times, "lat": lats, "lon": lons})
+
+
+class TestDumpToTree(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.dataset = make_dataset()
+        self.details = {
+            "group": "meteosim", "class": "gfs", "name": "test", "uid": "0",
+            "lon_range": m.to_coord_range(self.dataset.coords["lon"]),
+            "lat_range": m.to_coord_range(self.dataset.coords["lat"]),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def check_tree(self, out_dir):
+        pbuilder = m.PathBuilder(out_dir, self.details)
+        lonlat = "%s_%s" % (self.details["lon_range"],
+                            self.details["lat_range"])
+        exp_paths = []
+        for k in range(NT):
+            ts = m.to_datetime(self.dataset.coords["time"][k])
+            for fname, _, var_names, offset in m.FIELDS:
+                path = pbuilder.build(ts, lonlat, "%s.tif" % fname)
+                exp_paths.append(path)
+                raster = gdal.Open(path)
+                self.assertEqual(raster.RasterCount, len(var_names))
+                for i, name in enumerate(var_names):
+                    band = raster.GetRasterBand(1 + i)
+                    exp = self.dataset[name].values[k][::-1] + offset
+                    self.assertTrue(np.allclose(band.ReadAsArray(), exp))
+        tifs = []
+        for d, _, names in os.walk(out_dir):
+            tifs.extend(os.path.join(d, _) for _ in names
+                        if _.endswith(".tif"))
+        self.assertCountEqual(tifs, exp_paths)
+        with open(pbuilder.build("description.json")) as f:
+            resources = json.load(f)["result"]["resources"]
+        self.assertEqual([_["url"] for _ in resources], exp_paths)
+
+    def test_t_batch(self):
+        # 1 and 5 divide the number of time steps, 2 and 7 don't
+        for t_batch in 1, 2, 5, 7:
+            out_dir = os.path.join(self.wd, "t_batch_%d" % t_batch)
+            m.dump_to_tree(out_dir, self.dataset, self.details, "",
+                           t_batch=t_batch)
+            self.check_tree(out_dir)
+
+    def test_workers(self):
+        out_dir = os.path.join(self.wd, "workers")
+        m.dump_to_tree(out_dir, self.dataset, self.details, "",
+                       workers=2, t_batch=2)
+        self.check_tree(out_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,8 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
+import os
+import shutil
+import tempfile
+import time
 import unittest
+
 import tdm
+from tdm.utils import (
+    copy_file, ordered_map, size_balanced_split, LINK_MODES
+)
 
 
 class TestTDM(unittest.TestCase):
@@ -22,8 +31,107 @@ class TestTDM(unittest.TestCase):
         self.assertIsNotNone(tdm.__version__)
 
 
+class TestOrderedMap(unittest.TestCase):
+
+    def test_order(self):
+        consumed = []
+
+        def gen(n):
+            for i in range(n):
+                consumed.append(i)
+                yield i
+
+        def f(i):
+            time.sleep(0.001 * (i % 3))
+            return i * i
+
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            res = ordered_map(executor, f, gen(20), 3)
+            self.assertEqual(next(res), 0)
+            self.assertLessEqual(len(consumed), 4)
+            self.assertEqual(list(res), [i * i for i in range(1, 20)])
+
+    def test_bad_max_pending(self):
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            with self.assertRaises(ValueError):
+                list(ordered_map(executor, abs, [1], 0))
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.wd = tempfile.mkdtemp(prefix="tdm_")
+        self.src = os.path.join(self.wd, "src")
+        self.data = os.urandom(1024 * 1024 + 1)
+        with open(self.src, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_modes(self):
+        for mode in LINK_MODES:
+            dst = os.path.join(self.wd, mode)
+            self.assertTrue(copy_file(self.src, dst, mode=mode))
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertFalse(copy_file(self.src, dst, mode=mode))
+        self.assertTrue(os.path.islink(os.path.join(self.wd, "symlink")))
+        self.assertTrue(os.path.samefile(
+            self.src, os.path.join(self.wd, "hardlink")
+        ))
+        self.assertRaises(ValueError, copy_file, self.src, "foo", "bar")
+
+    def test_overwrite(self):
+        dst = os.path.join(self.wd, "dst")
+        with open(dst, "wb") as f:
+            f.write(self.data[:10])
+        self.assertTrue(copy_file(self.src, dst))
+        with open(dst, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertTrue(copy_file(self.src, dst, skip_existing=False))
+
+
+class TestSizeBalancedSplit(unittest.TestCase):
+
+    def test_contiguous(self):
+        seq = list(range(100))
+        sizes = [(7 * i) % 13 + 1 for i in seq]
+        for N in 1, 3, 10, 100:
+            groups = list(size_balanced_split(seq, sizes, N=N))
+            self.assertEqual(len(groups), N)
+            self.assertTrue(all(groups))
+            self.assertEqual(sum(groups, []), seq)
+
+    def test_balance(self):
+        sizes = [10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 10]
+        groups = list(size_balanced_split(range(12), sizes, N=3))
+        self.assertEqual([list(_) for _ in groups],
+                         [[0], list(range(1, 11)), [11]])
+
+    def test_target_size(self):
+        sizes = [5] * 10
+        groups = list(size_balanced_split(range(10), sizes, target_size=20))
+        self.assertEqual(sorted(len(_) for _ in groups), [3, 3, 4])
+        groups = list(size_balanced_split(range(10), sizes, target_size=1000))
+        self.assertEqual(len(groups), 1)
+        groups = list(size_balanced_split(range(10), sizes, target_size=1))
+        self.assertEqual(len(groups), 10)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            list(size_balanced_split(range(3), [1, 1]))
+        with self.assertRaises(ValueError):
+            list(size_balanced_split(range(3), [1, 1, 1], N=4))
+        with self.assertRaises(ValueError):
+            list(size_balanced_split(range(3), [1, 1, 1], N=2, target_size=2))
+
+
 CASES = [
     TestTDM,
+    TestOrderedMap,
+    TestCopyFile,
+    TestSizeBalancedSplit,
 ]
 
 
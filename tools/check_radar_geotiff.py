@@ -41,7 +41,9 @@ def check(ga, rr, dt, gtiff_path):
 
 def main(args):
     gtiff_map = utils.scan_gtiffs(args.gtiff_dir)
-    dt_path_pairs = utils.get_images(args.png_dir)
+    dt_path_pairs = utils.get_images(args.png_dir, include_packs=True)
+    if args.cache_signal:
+        dt_path_pairs = utils.cache_images(dt_path_pairs)
     if args.resolution:
         groups = utils.group_images(dt_path_pairs, args.resolution)
         dt_rr_stream = utils.avg_rainfall(groups)
@@ -61,4 +63,7 @@ if __name__ == "__main__":
     parser.add_argument("footprint", metavar="GEOTIFF_FOOTPRINT")
     parser.add_argument("-r", "--resolution", metavar="N_SECONDS", type=int,
                         help="set to same value passed to the rainfall script")
+    parser.add_argument("--cache-signal", action="store_true",
+                        help="read the decoded signal from memory-mapped "
+                        "per-day cubes, building them if necessary")
     main(parser.parse_args(sys.argv[1:]))
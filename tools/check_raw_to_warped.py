@@ -57,7 +57,10 @@ def rm_f(*paths):
 
 
 def main(args):
-    dt_path_pairs = utils.get_images(args.png_img_dir)
+    dt_path_pairs = utils.get_images(args.png_img_dir,
+                                     include_packs=True)
+    if args.cache_signal:
+        dt_path_pairs = utils.cache_images(dt_path_pairs)
     ga = utils.GeoAdapter(args.footprint)
     gtiff_map = utils.scan_gtiffs(args.gtiff_img_dir)
     assert {_[0] for _ in dt_path_pairs}.issubset(gtiff_map)
@@ -83,4 +86,7 @@ if __name__ == "__main__":
     parser.add_argument("png_img_dir", metavar="PNG_IMG_DIR")
     parser.add_argument("footprint", metavar="GEOTIFF_FOOTPRINT")
     parser.add_argument("gtiff_img_dir", metavar="GEOTIFF_IMG_DIR")
+    parser.add_argument("--cache-signal", action="store_true",
+                        help="read the decoded signal from memory-mapped "
+                        "per-day cubes, building them if necessary")
     main(parser.parse_args(sys.argv[1:]))
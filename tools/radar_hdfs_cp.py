@@ -14,33 +14,50 @@
 
 """\
 Copy radar images to HDFS, converting file names to avoid illegal characters.
+
+With --packed, copy packs (see tdm.radar.pack) as they are instead.
 """
 
 import argparse
-import io
 import os
+import shutil
 import sys
 
 import pydoop.hdfs as hdfs
 
 from tdm.radar.utils import get_images
+import tdm.radar.pack as pack
+from tdm.utils import COPY_BUFSIZE
 
 # ISO 8601 basic
 OUT_FMT = "%Y%m%dT%H%M%S"
 
 
+def copy(fs, src, dst, overwrite=False):
+    size = pack.get_image_size(src)
+    if not overwrite and fs.exists(dst):
+        if fs.get_path_info(dst)["size"] == size:
+            return
+    with pack.open_image(src) as fi:
+        with fs.open_file(dst, "wb") as fo:
+            shutil.copyfileobj(fi, fo, COPY_BUFSIZE)
+
+
 def main(args):
     host, port, out_dir = hdfs.path.split(args.out_dir)
     fs = hdfs.hdfs(host, port)
     fs.create_directory(out_dir)
     join = os.path.join
+    if args.packed:
+        for path in pack.find_packs(args.in_dir):
+            # copy the data before the index, as in a local append
+            for p in path, pack.get_index_path(path):
+                copy(fs, p, join(out_dir, os.path.basename(p)),
+                     overwrite=args.overwrite)
+        return
     for dt, path in get_images(args.in_dir):
         out_path = join(out_dir, f"{dt.strftime(OUT_FMT)}.png")
-        if not args.overwrite and fs.exists(out_path):
-            continue
-        with io.open(path, "rb") as fi:
-            with fs.open_file(out_path, "wb") as fo:
-                fo.write(fi.read())
+        copy(fs, path, out_path, overwrite=args.overwrite)
 
 
 if __name__ == "__main__":
@@ -48,4 +65,6 @@ if __name__ == "__main__":
     parser.add_argument("in_dir", metavar="INPUT_DIR")
     parser.add_argument("out_dir", metavar="OUTPUT_DIR")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--packed", action="store_true",
+                        help="copy packs found in INPUT_DIR")
     main(parser.parse_args(sys.argv[1:]))
@@ -22,6 +22,7 @@ import argparse
 import os
 import sys
 
+from tdm.utils import copy_file, LINK_MODES
 import tdm.radar.utils as utils
 import cdo
 
@@ -83,8 +84,7 @@ def main(args):
         for dt, src in pairs:
             out_name = "%s.png" % strftime(dt, utils.FMT)
             dst = join(out_subd, out_name)
-            with open(src, "rb") as fi, open(dst, "wb") as fo:
-                fo.write(fi.read())
+            copy_file(src, dst, mode=args.link_mode)
         print()
 
 
@@ -93,4 +93,5 @@ if __name__ == "__main__":
     parser.add_argument("sim_dir", metavar="NETCDF_SIM_DIR")
     parser.add_argument("radar_dir", metavar="PNG_RADAR_DIR")
     parser.add_argument("-o", "--out-dir", metavar="DIR", default=os.getcwd())
+    parser.add_argument("--link-mode", choices=LINK_MODES, default="copy")
     main(parser.parse_args(sys.argv[1:]))